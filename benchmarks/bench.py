@@ -0,0 +1,441 @@
+"""Load benchmarks for Filey's hot paths.
+
+Starts the application in-process on an ephemeral port against generated
+fixtures, drives concurrent clients through each scenario and writes the
+results as JSON:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --scale full --fixtures /var/tmp/filey-bench --compare results.json
+
+Each scenario reports request count, errors, throughput, latency
+percentiles, the peak RSS reached while it ran and CPU time split between
+the server (every thread but the client's) and the benchmark client.
+``--compare`` checks the results against an earlier run and exits with
+status 1 when a scenario regressed by more than ``--tolerance``.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado
+import tornado.httpserver
+import tornado.httpclient
+import tornado.netutil
+import tornado.websocket
+
+from wb import main as wb_main
+
+TOKEN = "bench-token"
+SCALES = {
+    # entries in the big directory, size of the big file, upload size
+    "tiny": {"entries": 2_000, "file_size": 16 * 1024 ** 2, "upload_size": 1024 ** 2},
+    "small": {"entries": 50_000, "file_size": 256 * 1024 ** 2, "upload_size": 16 * 1024 ** 2},
+    "full": {"entries": 1_000_000, "file_size": 4 * 1024 ** 3, "upload_size": 256 * 1024 ** 2},
+}
+SCENARIOS = ("listing", "view", "download", "upload", "stream")
+# Throughput may drop and latency or CPU may grow by this fraction before --compare calls it a regression
+DEFAULT_TOLERANCE = 0.15
+
+
+# -- Fixtures ------------------------------------------------------------------
+
+def make_fixtures(root: str, entries: int, file_size: int) -> None:
+    """Create the fixture tree under ``root``, reusing whatever an earlier run already made."""
+    directory = os.path.join(root, "many")
+    marker = os.path.join(directory, f".complete-{entries}")
+    if not os.path.exists(marker):
+        os.makedirs(directory, exist_ok=True)
+        for index in range(entries):
+            path = os.path.join(directory, f"file-{index:07d}.txt")
+            if not os.path.exists(path):
+                with open(path, "w") as f:
+                    f.write(f"{index}\n")
+        open(marker, "w").close()
+
+    # Sparse, so multi-GB fixtures are quick to create; the server still reads every byte
+    big = os.path.join(root, "big.bin")
+    if not os.path.exists(big) or os.path.getsize(big) != file_size:
+        with open(big, "wb") as f:
+            f.truncate(file_size)
+
+    log = os.path.join(root, "big.log")
+    if not os.path.exists(log) or os.path.getsize(log) < min(file_size, 64 * 1024 ** 2):
+        line = b"2024-01-01T00:00:00.000Z INFO request handled in 12ms path=/some/where status=200\n"
+        with open(log, "wb") as f:
+            block = line * (1024 * 1024 // len(line))
+            for _ in range(max(min(file_size, 64 * 1024 ** 2) // len(block), 1)):
+                f.write(block)
+
+    os.makedirs(os.path.join(root, "uploads"), exist_ok=True)
+    open(os.path.join(root, "append.log"), "w").close()
+
+
+# -- In-process server -----------------------------------------------------------
+
+class Server:
+    """The application on an ephemeral port, served from its own thread and event loop."""
+
+    def __init__(self, root: str, config: dict):
+        wb_main.ROOT_DIR = os.path.realpath(root)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.settings = wb_main.configure(config)
+        self.settings["stall_threshold"] = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name="bench-server", daemon=True)
+        self.port = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        sock = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)[0]
+        self.port = sock.getsockname()[1]
+        server = tornado.httpserver.HTTPServer(wb_main.make_app(self.settings))
+        server.add_sockets([sock])
+        self.ready.set()
+        await self.stopped.wait()
+        server.stop()
+
+    def start(self) -> None:
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join()
+
+
+# -- Measurement -----------------------------------------------------------------
+
+def _percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _reset_peak_rss() -> None:
+    # Writing 5 to clear_refs resets VmHWM on Linux; elsewhere the peak covers the whole run
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class Sample:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.items = 0
+
+
+async def measure(scenario) -> dict:
+    """Run ``scenario`` (a coroutine function returning a Sample) and summarise it."""
+    _reset_peak_rss()
+    cpu, client_cpu, started = time.process_time(), time.thread_time(), time.perf_counter()
+    sample = await scenario()
+    elapsed = time.perf_counter() - started
+    client_cpu = time.thread_time() - client_cpu
+    cpu = time.process_time() - cpu
+    ordered = sorted(sample.latencies)
+    return {
+        "requests": len(ordered),
+        "errors": sample.errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(ordered) / elapsed, 2),
+        "throughput_mb_s": round(sample.bytes / elapsed / 1024 ** 2, 2),
+        "items_per_s": round(sample.items / elapsed, 2) if sample.items else None,
+        "latency_ms": {
+            "mean": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+            "p50": round(_percentile(ordered, 0.5) * 1000, 3),
+            "p99": round(_percentile(ordered, 0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        },
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "cpu_s": {"server": round(cpu - client_cpu, 3), "client": round(client_cpu, 3)},
+    }
+
+
+async def run_clients(concurrency: int, duration: float, request) -> Sample:
+    """Call ``request(sample)`` from ``concurrency`` clients until ``duration`` seconds have passed."""
+    sample = Sample()
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await request(sample)
+            except Exception:
+                sample.errors += 1
+                await asyncio.sleep(0.01)
+                continue
+            sample.latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return sample
+
+
+# -- Scenarios -------------------------------------------------------------------
+
+class Bench:
+    def __init__(self, base_url: str, cookie: str, args):
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http://", "ws://")
+        self.headers = {"Cookie": cookie}
+        self.args = args
+        self.client = tornado.httpclient.AsyncHTTPClient(max_clients=max(args.concurrency, 10))
+
+    async def fetch(self, path: str, headers: dict | None = None, **kwargs):
+        return await self.client.fetch(self.base_url + path, headers={**self.headers, **(headers or {})},
+                                       request_timeout=3600, **kwargs)
+
+    async def listing(self) -> Sample:
+        # Page through the big directory; every client starts over once it reaches the end
+        cursors = {}
+
+        async def request(sample):
+            key = id(asyncio.current_task())
+            cursor = cursors.get(key)
+            path = "/many?format=json&limit=500" + (f"&cursor={cursor}" if cursor else "")
+            response = await self.fetch(path)
+            cursors[key] = json.loads(response.body)["next"]
+            sample.bytes += len(response.body)
+            sample.items += 500
+        return await run_clients(self.args.concurrency, self.args.duration, request)
+
+    async def view(self) -> Sample:
+        size = os.path.getsize(os.path.join(wb_main.ROOT_DIR, "big.log"))
+
+        async def request(sample):
+            response = await self.fetch(f"/window/big.log?offset={random.randrange(size)}")
+            sample.bytes += len(response.body)
+        return await run_clients(self.args.concurrency, self.args.duration, request)
+
+    async def download(self) -> Sample:
+        async def request(sample):
+            def received(chunk):
+                sample.bytes += len(chunk)
+            await self.fetch("/big.bin?download=1", streaming_callback=received, headers={"Accept-Encoding": "identity"})
+        return await run_clients(self.args.concurrency, self.args.duration, request)
+
+    async def upload(self) -> Sample:
+        size = self.args.upload_size
+        boundary = "benchboundary"
+        block = os.urandom(256 * 1024)
+
+        async def request(sample):
+            name = f"upload-{random.getrandbits(64):016x}.bin"
+            head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{name}\"\r\n"
+                    f"Content-Type: application/octet-stream\r\n\r\n").encode()
+            tail = f"\r\n--{boundary}--\r\n".encode()
+
+            async def producer(write):
+                await write(head)
+                remaining = size
+                while remaining > 0:
+                    await write(block[:remaining])
+                    remaining -= len(block)
+                await write(tail)
+
+            await self.fetch(
+                "/upload?directory=uploads", method="POST", body_producer=producer, follow_redirects=False,
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}",
+                         "Content-Length": str(len(head) + size + len(tail))})
+            sample.bytes += size
+            os.remove(os.path.join(wb_main.ROOT_DIR, "uploads", name))
+        return await run_clients(self.args.concurrency, self.args.duration, request)
+
+    async def stream(self) -> Sample:
+        """Many sockets following one file that a writer thread appends to; latency is write to delivery."""
+        sample = Sample()
+        path = os.path.join(wb_main.ROOT_DIR, "append.log")
+        sockets = []
+        for _ in range(self.args.streams):
+            request = tornado.httpclient.HTTPRequest(self.ws_url + "/stream/append.log?lines=0", headers=self.headers)
+            sockets.append(await tornado.websocket.websocket_connect(request))
+
+        stop = threading.Event()
+
+        def append():
+            interval = 1 / self.args.append_rate
+            with open(path, "a") as f:
+                while not stop.wait(interval):
+                    f.write(f"ts={time.time():.6f} {'x' * 80}\n")
+                    f.flush()
+
+        async def read(connection):
+            pending = ""
+            while True:
+                message = await connection.read_message()
+                if message is None:
+                    return
+                received = time.time()
+                message = json.loads(message)
+                if message.get("type") != "data":
+                    continue
+                pending += message["text"]
+                *lines, pending = pending.split("\n")
+                for line in lines:
+                    if line.startswith("ts="):
+                        sample.latencies.append(received - float(line[3:].split(" ", 1)[0]))
+                        sample.bytes += len(line) + 1
+                        sample.items += 1
+
+        readers = [asyncio.ensure_future(read(connection)) for connection in sockets]
+        writer = threading.Thread(target=append, daemon=True)
+        writer.start()
+        await asyncio.sleep(self.args.duration)
+        stop.set()
+        writer.join()
+        # Let the last lines arrive
+        await asyncio.sleep(0.5)
+        for connection in sockets:
+            connection.close()
+        await asyncio.gather(*readers, return_exceptions=True)
+        return sample
+
+
+# -- Comparison -----------------------------------------------------------------
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Describe every metric that regressed by more than ``tolerance`` compared with ``baseline``."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        checks = [
+            ("throughput_rps", current["throughput_rps"], previous["throughput_rps"], -1),
+            ("throughput_mb_s", current["throughput_mb_s"], previous["throughput_mb_s"], -1),
+            ("latency p50", current["latency_ms"]["p50"], previous["latency_ms"]["p50"], 1),
+            ("latency p99", current["latency_ms"]["p99"], previous["latency_ms"]["p99"], 1),
+            ("peak_rss_mb", current["peak_rss_mb"], previous["peak_rss_mb"], 1),
+        ]
+        for label, now, before, direction in checks:
+            if not before:
+                continue
+            change = (now - before) / before
+            if change * direction > tolerance:
+                regressions.append(f"{name}: {label} {before} -> {now} ({change:+.0%})")
+    return regressions
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    server = Server(args.fixtures, config)
+    server.start()
+    try:
+        base_url = f"http://127.0.0.1:{server.port}"
+        client = tornado.httpclient.AsyncHTTPClient()
+        response = await client.fetch(base_url + "/login", method="POST", body=f"token={TOKEN}",
+                                      follow_redirects=False, raise_error=False)
+        bench = Bench(base_url, response.headers["Set-Cookie"].split(";")[0], args)
+        results = {}
+        for name in args.scenarios:
+            results[name] = await measure(getattr(bench, name))
+            print(f"{name}: {results[name]['throughput_rps']} req/s, {results[name]['throughput_mb_s']} MB/s, "
+                  f"p50 {results[name]['latency_ms']['p50']} ms, p99 {results[name]['latency_ms']['p99']} ms",
+                  file=sys.stderr)
+        return results
+    finally:
+        server.stop()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Filey's listing, view, download, upload and stream paths")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="Fixture sizes (default small)")
+    parser.add_argument("--fixtures", help="Directory for the fixtures, reused between runs (default: a temp dir)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients per scenario")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--streams", type=int, default=200, help="WebSockets in the stream scenario")
+    parser.add_argument("--append-rate", type=float, default=200, help="Lines per second appended to the streamed file")
+    parser.add_argument("--config", help="Filey JSON config to benchmark with")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="Earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    scale = SCALES[args.scale]
+    args.upload_size = scale["upload_size"]
+
+    temporary = None
+    if args.fixtures is None:
+        temporary = tempfile.TemporaryDirectory(prefix="filey-bench-")
+        args.fixtures = temporary.name
+    try:
+        print(f"Preparing fixtures in {args.fixtures} ...", file=sys.stderr)
+        make_fixtures(args.fixtures, scale["entries"], scale["file_size"])
+        scenarios = asyncio.run(run(args))
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+    results = {
+        "revision": _git_revision(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "tornado": tornado.version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {"scale": args.scale, **scale, "concurrency": args.concurrency, "duration": args.duration,
+                    "streams": args.streams, "append_rate": args.append_rate},
+        "scenarios": scenarios,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import io
+import os
+import zipfile
+import tarfile
+import tempfile
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.archive import ZipWriter, iter_tree
+
+# Checks the streaming archive writers and the archive download endpoint.
+
+TOKEN = "test-token"
+
+
+def build_zip(writer, entries):
+    out = []
+    for name, st, data in entries:
+        if data is None:
+            out.append(writer.add_directory(name, st))
+            continue
+        out.append(writer.begin_file(name, st))
+        for start in range(0, len(data), 7):
+            out.append(writer.write(data[start:start + 7]))
+        out.append(writer.end_file())
+    out.extend(writer.close())
+    return zipfile.ZipFile(io.BytesIO(b"".join(out)))
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_zip_writer_round_trips(store):
+    st = os.stat(__file__)
+    archive = build_zip(ZipWriter(store=store), [("d", st, None), ("d/a.txt", st, b"hello " * 100),
+                                                 ("d/b.gz", st, b"\x1f\x8b not really")])
+    assert archive.namelist() == ["d/", "d/a.txt", "d/b.gz"]
+    assert archive.read("d/a.txt") == b"hello " * 100
+    infos = {info.filename: info for info in archive.infolist()}
+    assert infos["d/a.txt"].compress_type == (zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED)
+    # Already-compressed formats are never deflated again
+    assert infos["d/b.gz"].compress_type == zipfile.ZIP_STORED
+    assert archive.testzip() is None
+
+
+def test_zip64_records_for_many_entries_and_large_files():
+    st = os.stat(__file__)
+    large = os.stat_result((st.st_mode, 0, 0, 1, 0, 0, 5 * 1024 ** 3, 0, int(st.st_mtime), 0))
+    entries = [(f"d{i}", st, None) for i in range(70000)] + [("big.bin", large, b"data")]
+    archive = build_zip(ZipWriter(), entries)
+    assert len(archive.infolist()) == 70001
+    assert archive.read("big.bin") == b"data"
+
+
+def test_iter_tree_is_sorted_and_relative_to_the_parent():
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "top", "b"))
+        open(os.path.join(root, "top", "a"), "w").close()
+        open(os.path.join(root, "top", "b", "c"), "w").close()
+        assert [name for _, name, _ in iter_tree(os.path.join(root, "top"))] == ["top", "top/a", "top/b", "top/b/c"]
+
+
+class ArchiveHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        os.makedirs(os.path.join(wb_main.ROOT_DIR, "logs", "old"))
+        with open(os.path.join(wb_main.ROOT_DIR, "logs", "app.log"), "wb") as f:
+            f.write(os.urandom(3000) + b"line\n" * 1000)
+        with open(os.path.join(wb_main.ROOT_DIR, "logs", "old", "app.log.1"), "wb") as f:
+            f.write(b"old\n")
+        os.symlink("old/app.log.1", os.path.join(wb_main.ROOT_DIR, "logs", "latest"))
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "archive_chunk_size": 1024})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_zip_and_tgz_downloads(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        with open(os.path.join(wb_main.ROOT_DIR, "logs", "app.log"), "rb") as f:
+            expected = f.read()
+
+        response = self.fetch("/archive/logs?format=zip", headers=headers)
+        self.assertEqual(response.headers["Content-Disposition"], 'attachment; filename="logs.zip"')
+        archive = zipfile.ZipFile(io.BytesIO(response.body))
+        self.assertEqual(archive.namelist(), ["logs/", "logs/app.log", "logs/latest", "logs/old/",
+                                              "logs/old/app.log.1"])
+        self.assertEqual(archive.read("logs/app.log"), expected)
+
+        response = self.fetch("/archive/logs?format=tgz", headers=headers)
+        with tarfile.open(fileobj=io.BytesIO(response.body), mode="r:gz") as archive:
+            self.assertEqual(archive.extractfile("logs/app.log").read(), expected)
+            self.assertEqual(archive.getmember("logs/latest").linkname, "old/app.log.1")
+
+        self.assertEqual(self.fetch("/archive/logs?format=rar", headers=headers).code, 400)
+        self.assertEqual(self.fetch("/archive/logs/app.log", headers=headers).code, 404)
@@ -0,0 +1,30 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import bench
+
+# Runs every benchmark scenario briefly, so the harness keeps working as the server changes.
+
+
+def test_every_scenario_reports_results(tmp_path, monkeypatch):
+    monkeypatch.setitem(bench.SCALES, "tiny", {"entries": 50, "file_size": 1024 ** 2, "upload_size": 64 * 1024})
+    output = tmp_path / "results.json"
+    assert bench.main(["--scale", "tiny", "--fixtures", str(tmp_path / "fixtures"), "--duration", "0.2",
+                       "--concurrency", "2", "--streams", "2", "--append-rate", "50", "--output", str(output)]) == 0
+    results = json.loads(output.read_text())
+    assert set(results["scenarios"]) == set(bench.SCENARIOS)
+    for name, scenario in results["scenarios"].items():
+        assert scenario["errors"] == 0, name
+        assert scenario["requests"] > 0, name
+        assert scenario["latency_ms"]["p99"] >= scenario["latency_ms"]["p50"]
+
+    # The same results never count as a regression; a halved throughput does
+    assert bench.compare(results, results, 0.15) == []
+    slower = json.loads(output.read_text())
+    slower["scenarios"]["view"]["throughput_rps"] /= 2
+    assert bench.compare(slower, results, 0.15) == ["view: throughput_rps "
+                                                   f"{results['scenarios']['view']['throughput_rps']} -> "
+                                                   f"{slower['scenarios']['view']['throughput_rps']} (-50%)"]
@@ -0,0 +1,145 @@
+import os
+import bz2
+import asyncio
+import gzip
+import json
+import lzma
+import random
+import tempfile
+import threading
+
+import pytest
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from wb import compressed
+from wb import main as wb_main
+from wb.compressed import open_uncompressed, get_compressed_index
+from wb.lineindex import LineIndex
+from wb.tail import tail_hub
+from wb.viewer import read_window
+
+# Checks that compressed logs read like their uncompressed content, from any offset.
+
+TOKEN = "test-token"
+CONTENT = b"".join(b"line %d %s\n" % (i, b"x" * (i % 37)) for i in range(50000))
+
+
+@pytest.fixture
+def small_index(monkeypatch):
+    # Small intervals so a test-sized file gets many checkpoints and its middle is outside the cached tail
+    monkeypatch.setattr(compressed, "READ_SIZE", 4096)
+    monkeypatch.setattr(compressed, "CHECKPOINT_INTERVAL", 32 * 1024)
+    monkeypatch.setattr(compressed, "MAX_CHECKPOINTS", 16)
+    monkeypatch.setattr(compressed, "TAIL_SIZE", 8 * 1024)
+    monkeypatch.setattr(compressed, "RECENT_SIZE", 16 * 1024)
+    compressed._indexes.clear()
+    yield
+    compressed._indexes.clear()
+
+
+@pytest.mark.parametrize("suffix,module", [(".gz", gzip), (".bz2", bz2), (".xz", lzma)])
+def test_random_reads_match_uncompressed_content(tmp_path, small_index, suffix, module):
+    path = str(tmp_path / ("app.log" + suffix))
+    half = len(CONTENT) // 2
+    # Two members back to back, as `cat a.gz b.gz` or pbzip2 produce
+    with open(path, "wb") as f:
+        f.write(module.compress(CONTENT[:half]) + module.compress(CONTENT[half:]))
+    f, size = open_uncompressed(path)
+    with f:
+        assert size == len(CONTENT)
+        rng = random.Random(1)
+        for _ in range(100):
+            pos, count = rng.randrange(size), rng.randrange(64 * 1024)
+            f.seek(pos)
+            assert f.read(count) == CONTENT[pos:pos + count]
+        f.seek(1000)
+        assert f.readline() == CONTENT[1000:CONTENT.index(b"\n", 1000) + 1]
+    index = get_compressed_index(path)
+    assert index.checkpoints[0] == (0, 0, None)
+    assert len(index.checkpoints) <= compressed.MAX_CHECKPOINTS
+    if suffix == ".gz":
+        # Thinned out as the file was indexed, but still spread over all of it
+        assert len(index.checkpoints) > compressed.MAX_CHECKPOINTS // 2
+
+
+def test_plain_files_and_misnamed_files_are_read_as_is(tmp_path):
+    path = str(tmp_path / "plain.gz")
+    with open(path, "wb") as f:
+        f.write(b"not compressed\n")
+    f, size = open_uncompressed(path)
+    with f:
+        assert (f.read(), size) == (b"not compressed\n", 15)
+
+
+def test_viewer_and_line_index_read_decompressed(tmp_path, small_index):
+    path = str(tmp_path / "app.log.1.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(CONTENT)
+    window = read_window(path, None, 100, backward=True)
+    assert (window["end"], window["size"]) == (len(CONTENT), len(CONTENT))
+    assert window["text"].endswith("line 49999 " + "x" * (49999 % 37) + "\n")
+    offset = len(CONTENT) // 2
+    window = read_window(path, offset, 1000)
+    assert window["text"].encode() == CONTENT[window["start"]:window["end"]]
+
+    result = LineIndex(path, stride=100).read_lines(25000, 2)
+    assert result["lines"] == ["line 25000 " + "x" * (25000 % 37), "line 25001 " + "x" * (25001 % 37)]
+    assert result["total_lines"] == 50000
+
+
+class CompressedStreamTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        with gzip.open(os.path.join(wb_main.ROOT_DIR, "app.log.1.gz"), "wb") as f:
+            f.write(CONTENT)
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    async def connect(self, path):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        url = self.get_url(path).replace("http://", "ws://")
+        return await websocket_connect(HTTPRequest(url, headers={"Cookie": cookie}))
+
+    @gen_test
+    async def test_history_is_decompressed(self):
+        connection = await self.connect("/stream/app.log.1.gz?lines=2&grep=line%204999")
+        message = json.loads(await connection.read_message())
+        self.assertEqual(message["text"].splitlines(), ["line 49998 " + "x" * (49998 % 37),
+                                                        "line 49999 " + "x" * (49999 % 37)])
+        self.assertEqual(message["end"], len(CONTENT))
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def test_multistream_indexes_off_the_ioloop(self):
+        compressed._indexes.clear()
+        build = compressed.CompressedIndex._build
+        threads = []
+
+        def recording_build(index, f):
+            threads.append(threading.current_thread())
+            return build(index, f)
+
+        compressed.CompressedIndex._build = recording_build
+        try:
+            connection = await self.connect("/multistream?glob=*.gz&lines=1")
+            self.assertEqual(json.loads(await connection.read_message())["type"], "source")
+            message = json.loads(await connection.read_message())
+        finally:
+            compressed.CompressedIndex._build = build
+        self.assertEqual(message["text"], "line 49999 " + "x" * (49999 % 37) + "\n")
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
@@ -0,0 +1,141 @@
+import os
+import gzip
+import zlib
+import tempfile
+
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.compression import Compressor, PrecompressedCache, compressible_file, negotiate
+
+# Checks content negotiation, streaming compression and the precompressed cache.
+
+TOKEN = "test-token"
+
+
+def test_negotiate():
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("deflate, gzip;q=0") is None
+    assert negotiate("identity") is None
+    assert negotiate("") is None
+    assert negotiate("*;q=0.5") is not None
+
+
+def test_streaming_gzip_is_readable_after_every_flush():
+    compressor = Compressor("gzip", 1)
+    decompressor = zlib.decompressobj(16 + 15)
+    output = b""
+    for line in (b"first line\n", b"second line\n"):
+        output += decompressor.decompress(compressor.compress(line) + compressor.flush())
+        assert output.endswith(line)
+    assert decompressor.decompress(compressor.finish()) == b""
+    assert decompressor.eof
+
+
+def test_compressible_file():
+    assert compressible_file("app.log")
+    assert compressible_file("data.csv")
+    assert not compressible_file("app.log.gz")
+    assert not compressible_file("photo.png")
+    assert not compressible_file("blob.bin")
+
+
+
+def test_cache_is_only_rescanned_when_it_may_be_full(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"x")
+    cache = PrecompressedCache(str(tmp_path / "cache"), max_size=2500)
+    scans = []
+    trim = cache.trim
+    cache.trim = lambda: scans.append(1) or trim()
+
+    def add(level):
+        writer = cache.create(str(source), os.stat(source), "gzip", level)
+        writer.write(b"y" * 1000)
+        writer.commit()
+    for level in range(2):
+        add(level)
+    # The first commit measures what is already there; the second still fits
+    assert len(scans) == 1
+    add(2)
+    assert len(scans) == 2
+    assert len(os.listdir(cache.directory)) == 2
+    assert cache.size == 2000
+
+
+def test_trim_leaves_fresh_temporary_files_alone(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"x")
+    cache = PrecompressedCache(str(tmp_path / "cache"), max_size=0)
+    writer = cache.create(str(source), os.stat(source), "gzip", 1)
+    writer.write(b"y" * 1000)
+    stale = tmp_path / "cache" / ".left-by-a-dead-worker.tmp"
+    stale.write_bytes(b"z" * 1000)
+    os.utime(stale, (0, 0))
+    cache.trim()
+    assert os.listdir(cache.directory) == [os.path.basename(writer.temp)]
+    assert cache.size == 0
+    writer.commit()
+
+class CompressionTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.data = b"".join(b"%d,some,csv,row\n" % i for i in range(20000))
+        with open(os.path.join(wb_main.ROOT_DIR, "data.csv"), "wb") as f:
+            f.write(self.data)
+        cache = PrecompressedCache(self.cache_dir.name, min_size=0)
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "download_chunk_size": 4096,
+                                 "compression_cache": cache})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+        self.cache_dir.cleanup()
+
+    def get(self, path, method="GET", **headers):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers["Cookie"] = response.headers["Set-Cookie"].split(";")[0]
+        return self.fetch(path, method=method, headers=headers, decompress_response=False)
+
+    def test_download_is_compressed_once_then_served_from_cache(self):
+        first = self.get("/data.csv?download=1", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertEqual(first.headers["Vary"], "Accept-Encoding")
+        self.assertTrue(first.headers["Etag"].endswith('-gzip"'))
+        self.assertEqual(gzip.decompress(first.body), self.data)
+        self.assertLess(len(first.body), len(self.data) // 3)
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+
+        second = self.get("/data.csv?download=1", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(int(second.headers["Content-Length"]), len(first.body))
+        not_modified = self.get("/data.csv?download=1", **{"Accept-Encoding": "gzip",
+                                                           "If-None-Match": first.headers["Etag"]})
+        self.assertEqual(not_modified.code, 304)
+
+    def test_head_describes_the_compressed_representation(self):
+        head = self.get("/data.csv?download=1", "HEAD", **{"Accept-Encoding": "gzip"})
+        get = self.get("/data.csv?download=1", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(head.code, 200)
+        self.assertEqual(head.headers["Content-Encoding"], "gzip")
+        self.assertEqual(head.headers["Etag"], get.headers["Etag"])
+        # Once a compressed copy is cached its length is known
+        head = self.get("/data.csv?download=1", "HEAD", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(int(head.headers["Content-Length"]), len(get.body))
+        self.assertNotEqual(self.get("/data.csv?download=1", "HEAD").headers["Etag"], get.headers["Etag"])
+
+    def test_identity_and_ranges_are_not_compressed(self):
+        response = self.get("/data.csv?download=1")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.body, self.data)
+        response = self.get("/data.csv?download=1", **{"Accept-Encoding": "gzip", "Range": "bytes=0-99"})
+        self.assertEqual((response.code, response.body), (206, self.data[:100]))
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_viewer_page_is_compressed(self):
+        response = self.get("/data.csv", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"some,csv,row", gzip.decompress(response.body))
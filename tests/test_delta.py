@@ -0,0 +1,146 @@
+import io
+import os
+import json
+import hashlib
+import tempfile
+import urllib.parse
+
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import delta
+from wb import main as wb_main
+from wb.delta import Signature, SignatureBuilder, DeltaApplier, encode_delta, get_signature
+
+# Checks that delta uploads rebuild files exactly while sending only what changed.
+
+TOKEN = "test-token"
+BLOCK_SIZE = 4096
+
+
+def apply(path, new, block_size=BLOCK_SIZE):
+    signature = get_signature(path, block_size)
+    stats = {}
+    ops = b"".join(encode_delta(signature, io.BytesIO(new), stats))
+    applier = DeltaApplier(path, block_size, (signature.size, signature.mtime_ns))
+    # Op boundaries must not matter to the server
+    for start in range(0, len(ops), 1000):
+        applier.feed(ops[start:start + 1000])
+    result = applier.finish(len(new), hashlib.sha256(new).hexdigest())
+    with open(path, "rb") as f:
+        assert f.read() == new
+    assert result["literal_bytes"] == stats["literal_bytes"]
+    return result
+
+
+def test_edits_send_little_literal_data(tmp_path):
+    path = str(tmp_path / "data.bin")
+    old = os.urandom(1024 * 1024 + 123)
+    with open(path, "wb") as f:
+        f.write(old)
+    assert apply(path, old)["literal_bytes"] == 0
+    # An insertion shifts everything after it; rolling the weak checksum finds the old blocks again
+    new = old[:300000] + b"inserted" + old[300000:700000] + old[710000:]
+    result = apply(path, new)
+    assert result["literal_bytes"] < 3 * BLOCK_SIZE
+    assert result["copied_bytes"] + result["literal_bytes"] == len(new)
+    assert apply(path, b"")["size"] == 0
+
+
+def test_rolled_checksum_matches_adler32():
+    data = os.urandom(3 * BLOCK_SIZE)
+    builder = SignatureBuilder(BLOCK_SIZE)
+    builder.feed(data[7:7 + BLOCK_SIZE])
+    signature = builder.finish(0)
+    # The only match is at an offset the encoder can only reach by rolling
+    ops = b"".join(encode_delta(signature, io.BytesIO(data)))
+    assert b"C" + (0).to_bytes(8, "big") + (1).to_bytes(4, "big") in ops
+
+
+def test_signature_cache_follows_size_and_mtime(tmp_path):
+    path = str(tmp_path / "data.bin")
+    cache_dir = str(tmp_path / "cache")
+    with open(path, "wb") as f:
+        f.write(os.urandom(50000))
+    first = get_signature(path, BLOCK_SIZE, cache_dir)
+    assert get_signature(path, BLOCK_SIZE, cache_dir).strong == first.strong
+    assert Signature.from_json(first.to_json()).weak == first.weak
+    with open(path, "r+b") as f:
+        f.write(b"changed")
+    os.utime(path, ns=(first.mtime_ns + 10 ** 9, first.mtime_ns + 10 ** 9))
+    assert get_signature(path, BLOCK_SIZE, cache_dir).strong != first.strong
+
+
+class DeltaHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.path = os.path.join(wb_main.ROOT_DIR, "data.bin")
+        self.old = os.urandom(512 * 1024)
+        with open(self.path, "wb") as f:
+            f.write(self.old)
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login",
+                                 "signature_cache_dir": os.path.join(self.root.name, ".signatures")})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def login(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        return {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+
+    def upload(self, headers, signature, new, base=True):
+        query = {"size": len(new), "sha256": hashlib.sha256(new).hexdigest(), "block_size": signature.block_size}
+        if base:
+            query.update(base_size=signature.size, base_mtime_ns=signature.mtime_ns)
+        body = b"".join(encode_delta(signature, io.BytesIO(new)))
+        return self.fetch("/delta/data.bin?" + urllib.parse.urlencode(query), method="POST", headers=headers,
+                          body=body)
+
+    def test_signature_then_delta_upload(self):
+        headers = self.login()
+        self.assertEqual(self.fetch("/delta/data.bin", follow_redirects=False).code, 302)
+        response = self.fetch(f"/delta/data.bin?block_size={BLOCK_SIZE}", headers=headers)
+        self.assertEqual(response.code, 200)
+        signature = Signature.from_json(json.loads(response.body))
+        self.assertEqual((signature.size, len(signature)), (len(self.old), len(self.old) // BLOCK_SIZE))
+
+        new = self.old[:1000] + b"edit" + self.old[1000:]
+        response = self.upload(headers, signature, new)
+        self.assertEqual(response.code, 200, response.body)
+        result = json.loads(response.body)
+        self.assertEqual(result["path"], "data.bin")
+        self.assertLess(result["literal_bytes"], 2 * BLOCK_SIZE)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), new)
+        self.assertEqual([name for name in os.listdir(wb_main.ROOT_DIR) if name != ".signatures"], ["data.bin"])
+
+        # The old signature no longer describes the file
+        response = self.upload(headers, signature, self.old)
+        self.assertEqual(response.code, 412)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), new)
+
+    def test_rebuilding_past_the_declared_size_is_refused(self):
+        headers = self.login()
+        signature = delta.get_signature(self.path, BLOCK_SIZE)
+        # Every op copies the whole old file again; only the declared size bounds what this writes
+        copy = b"C" + (0).to_bytes(8, "big") + len(signature).to_bytes(4, "big")
+        query = urllib.parse.urlencode({"size": len(self.old), "block_size": BLOCK_SIZE, "base_size": signature.size,
+                                        "base_mtime_ns": signature.mtime_ns})
+        response = self.fetch("/delta/data.bin?" + query, method="POST", headers=headers, body=copy * 100)
+        self.assertEqual(response.code, 422)
+        self.assertEqual(os.listdir(wb_main.ROOT_DIR), ["data.bin"])
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.old)
+
+    def test_rejects_bad_checksum_and_anonymous_uploads(self):
+        headers = self.login()
+        signature = delta.get_signature(self.path, BLOCK_SIZE)
+        query = urllib.parse.urlencode({"size": 3, "sha256": "0" * 64, "block_size": BLOCK_SIZE})
+        response = self.fetch("/delta/data.bin?" + query, method="POST", headers=headers, body=b"L\0\0\0\3abc")
+        self.assertEqual(response.code, 422)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.old)
+        self.assertEqual(self.upload({}, signature, b"x").code, 403)
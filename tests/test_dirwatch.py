@@ -0,0 +1,138 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from wb import dirwatch
+from wb import main as wb_main
+from wb.dirwatch import DirectoryWatcher, directory_hub
+
+# Checks that directory changes are coalesced into created/modified/deleted/renamed events.
+
+TOKEN = "test-token"
+
+
+class DirectoryWatcherTest(AsyncTestCase):
+    backend = "auto"
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp.name, "old.txt"), "w") as f:
+            f.write("old")
+        self.watcher = DirectoryWatcher(self.tmp.name, None, delay=0.05, interval=30, backend=self.backend)
+        self.events = []
+        self.watcher.subscribers.add(self)
+        self.io_loop.run_sync(self.watcher.start)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def on_directory_events(self, events):
+        self.events.extend(events)
+
+    async def wait_for(self, count):
+        for _ in range(200):
+            if len(self.events) >= count:
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"Timed out waiting for events, got {self.events}")
+
+    @gen_test
+    async def test_reports_changes(self):
+        with open(os.path.join(self.tmp.name, "new.txt"), "w") as f:
+            f.write("hello")
+        await self.wait_for(1)
+        self.assertEqual([(e["type"], e["entry"]["name"], e["entry"]["size"]) for e in self.events],
+                         [("created", "new.txt", 5)])
+
+        self.events.clear()
+        os.rename(os.path.join(self.tmp.name, "old.txt"), os.path.join(self.tmp.name, "moved.txt"))
+        os.remove(os.path.join(self.tmp.name, "new.txt"))
+        await self.wait_for(3 if self.backend == "poll" else 2)
+        kinds = sorted((e["type"], e.get("name") or e["entry"]["name"]) for e in self.events)
+        if self.backend == "poll":
+            self.assertEqual(kinds, [("created", "moved.txt"), ("deleted", "new.txt"), ("deleted", "old.txt")])
+        else:
+            self.assertEqual(kinds, [("deleted", "new.txt"), ("renamed", "moved.txt")])
+
+    @gen_test
+    async def test_directory_is_read_off_the_ioloop(self):
+        describe = dirwatch.describe
+        threads = []
+
+        def recording_describe(path, name):
+            threads.append(threading.current_thread())
+            return describe(path, name)
+
+        dirwatch.describe = recording_describe
+        try:
+            for i in range(3):
+                open(os.path.join(self.tmp.name, f"{i}.txt"), "w").close()
+            await self.wait_for(3)
+        finally:
+            dirwatch.describe = describe
+        self.assertEqual(sorted(e["entry"]["name"] for e in self.events), ["0.txt", "1.txt", "2.txt"])
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+
+class PollingDirectoryWatcherTest(DirectoryWatcherTest):
+    backend = "poll"
+
+    @gen_test
+    async def test_polls_run_off_the_ioloop(self):
+        scan = self.watcher._scan
+        threads = []
+
+        def recording_scan():
+            threads.append(threading.current_thread())
+            return scan()
+
+        self.watcher._scan = recording_scan
+        await self.watcher._poll()
+        self.assertEqual(threads, [threads[0]])
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class DirectoryWatchHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "directory_batch_delay": 0.01})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    async def connect(self):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        url = self.get_url("/watch/").replace("http://", "ws://")
+        return await websocket_connect(HTTPRequest(url, headers={"Cookie": cookie}))
+
+    @gen_test
+    async def test_viewers_share_one_watcher(self):
+        first, second = await self.connect(), await self.connect()
+        self.assertEqual(len(directory_hub.watchers), 1)
+        watcher, = directory_hub.watchers.values()
+        while len(watcher.subscribers) < 2:
+            await asyncio.sleep(0.01)
+        os.mkdir(os.path.join(wb_main.ROOT_DIR, "spool"))
+        for connection in (first, second):
+            message = json.loads(await connection.read_message())
+            self.assertEqual(message["events"][0]["type"], "created")
+            self.assertTrue(message["events"][0]["entry"]["is_dir"])
+        first.close()
+        second.close()
+        while directory_hub.watchers:
+            await asyncio.sleep(0.01)
@@ -0,0 +1,85 @@
+import os
+import json
+import tempfile
+
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.download import parse_range_header
+
+# Exercises streamed downloads, Range requests and conditional GETs
+# against an in-process application.
+
+TOKEN = "test-token"
+
+
+def test_parse_range_header():
+    assert parse_range_header("bytes=0-9", 100) == [(0, 9)]
+    assert parse_range_header("bytes=-10", 100) == [(90, 99)]
+    assert parse_range_header("bytes=95-", 100) == [(95, 99)]
+    assert parse_range_header("bytes=0-4,3-9,50-59", 100) == [(0, 9), (50, 59)]
+    assert parse_range_header("bytes=200-300", 100) == []
+    assert parse_range_header("items=0-1", 100) is None
+    assert parse_range_header("bytes=5-1", 100) is None
+
+
+class DownloadTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.data = bytes(range(256)) * 1024
+        with open(os.path.join(wb_main.ROOT_DIR, "blob.bin"), "wb") as f:
+            f.write(self.data)
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "download_chunk_size": 4096})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def login(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        return response.headers["Set-Cookie"].split(";")[0]
+
+    def download(self, **headers):
+        headers["Cookie"] = self.login()
+        return self.fetch("/blob.bin?download=1", headers=headers)
+
+    def test_full_download(self):
+        response = self.download()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+    def test_single_range(self):
+        response = self.download(Range="bytes=1000-1999")
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.data[1000:2000])
+        self.assertEqual(response.headers["Content-Range"], f"bytes 1000-1999/{len(self.data)}")
+
+    def test_multi_range(self):
+        response = self.download(Range="bytes=0-9,100-109")
+        self.assertEqual(response.code, 206)
+        self.assertTrue(response.headers["Content-Type"].startswith("multipart/byteranges"))
+        self.assertIn(self.data[0:10], response.body)
+        self.assertIn(self.data[100:110], response.body)
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.body))
+
+    def test_unsatisfiable_range(self):
+        response = self.download(Range=f"bytes={len(self.data)}-")
+        self.assertEqual(response.code, 416)
+
+    def test_conditional_get(self):
+        etag = self.download().headers["Etag"]
+        self.assertEqual(self.download(**{"If-None-Match": etag}).code, 304)
+        stale = self.download(**{"If-Range": '"stale"', "Range": "bytes=0-9"})
+        self.assertEqual(stale.code, 200)
+        self.assertEqual(len(stale.body), len(self.data))
+
+    def test_view_renders_window(self):
+        cookie = self.login()
+        response = self.fetch("/blob.bin", headers={"Cookie": cookie})
+        self.assertEqual(response.code, 200)
+        window = json.loads(self.fetch("/window/blob.bin?offset=0&length=100", headers={"Cookie": cookie}).body)
+        self.assertEqual(window["size"], len(self.data))
+        self.assertLessEqual(window["end"], 100)
@@ -0,0 +1,106 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.executors import Executors, ExecutorBusy, OperationPool
+
+# Checks the per-class executors: isolation, queue limits and statistics.
+
+TOKEN = "test-token"
+
+
+def test_saturated_class_does_not_delay_another():
+    pools = Executors()
+    pools.configure({"bulk": {"threads": 1, "max_queue": 4}, "metadata": {"threads": 1}})
+    release = threading.Event()
+
+    async def scenario():
+        blocked = [asyncio.ensure_future(pools.run("bulk", release.wait)) for _ in range(3)]
+        # The metadata thread is free even though every bulk thread is busy
+        assert await asyncio.wait_for(pools.run("metadata", sum, [1, 2]), 1) == 3
+        stats = pools.stats()["bulk"]
+        assert (stats["running"], stats["queued"]) == (1, 2)
+        release.set()
+        await asyncio.gather(*blocked)
+
+    asyncio.run(scenario())
+    stats = pools.stats()
+    assert stats["bulk"]["completed"] == 3
+    assert stats["metadata"]["completed"] == 1
+    assert stats["bulk"]["wait"]["max_ms"] > 0
+
+
+def test_rejects_beyond_max_queue_and_counts_cancellations():
+    pool = OperationPool("bulk", 1, max_queue=1)
+    release = threading.Event()
+    running = pool.submit(release.wait)
+    while not pool.running:
+        pass
+    queued = pool.submit(release.wait)
+    with pytest.raises(ExecutorBusy):
+        pool.submit(release.wait)
+    assert queued.cancel()
+    assert pool.stats()["queued"] == 0
+    release.set()
+    running.result()
+    stats = pool.stats()
+    assert (stats["submitted"], stats["completed"], stats["rejected"]) == (2, 2, 1)
+    pool.shutdown()
+
+
+def test_unknown_class_is_rejected():
+    with pytest.raises(ValueError):
+        Executors().configure({"gpu": {"threads": 1}})
+
+
+class StatsHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        os.makedirs(os.path.join(wb_main.ROOT_DIR, "tree", "sub"))
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_delete_runs_on_the_bulk_executor(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        before = json.loads(self.fetch("/stats", headers=headers).body)["executors"]["bulk"]["submitted"]
+        response = self.fetch("/delete", method="POST", body="path=tree", headers=headers)
+        self.assertEqual(response.code, 202)
+        stats = json.loads(self.fetch("/stats", headers=headers).body)["executors"]
+        self.assertEqual(stats["bulk"]["submitted"], before + 1)
+        self.assertEqual(set(stats), {"metadata", "read", "write", "scan", "bulk"})
+
+    def test_first_line_index_scan_runs_on_the_scan_executor(self):
+        with open(os.path.join(wb_main.ROOT_DIR, "app.log"), "w") as f:
+            f.writelines(f"line {i}\n" for i in range(100))
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        submitted = []
+        for _ in range(2):
+            self.assertEqual(self.fetch("/lines/app.log?line=50&count=1", headers=headers).code, 200)
+            stats = json.loads(self.fetch("/stats", headers=headers).body)["executors"]
+            submitted.append((stats["scan"]["submitted"], stats["read"]["submitted"]))
+        # Only the first lookup scans the file; later ones are light reads
+        self.assertEqual(submitted[1][0], submitted[0][0])
+        self.assertEqual(submitted[1][1], submitted[0][1] + 1)
+
+    def test_delta_signature_runs_on_the_scan_executor(self):
+        with open(os.path.join(wb_main.ROOT_DIR, "data.bin"), "wb") as f:
+            f.write(os.urandom(64 * 1024))
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        before = json.loads(self.fetch("/stats", headers=headers).body)["executors"]["scan"]["submitted"]
+        self.assertEqual(self.fetch("/delta/data.bin", headers=headers).code, 200)
+        stats = json.loads(self.fetch("/stats", headers=headers).body)["executors"]
+        self.assertEqual(stats["scan"]["submitted"], before + 1)
@@ -0,0 +1,102 @@
+import os
+import json
+import tempfile
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import grep
+from wb import main as wb_main
+from wb.grep import compile_pattern, iter_files, scan_file
+
+# Checks the content search: per-file scanning, tree walking and the streamed handler.
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def tree():
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "logs", "old"))
+        with open(os.path.join(root, "logs", "app.log"), "wb") as f:
+            f.write(b"start\nERROR one\nok\nERROR two ERROR again\n")
+        with open(os.path.join(root, "logs", "old", "app.log"), "wb") as f:
+            f.write(b"error lower case\n" + b"x" * 100)
+        with open(os.path.join(root, "logs", "notes.txt"), "wb") as f:
+            f.write(b"ERROR in a text file\n")
+        with open(os.path.join(root, "logs", "core.bin"), "wb") as f:
+            f.write(b"\0\0ERROR\n")
+        yield root
+
+
+def test_scan_file_reports_line_numbers_once_per_line(tree):
+    pattern, flags = compile_pattern("ERROR")
+    result = scan_file(os.path.join(tree, "logs", "app.log"), pattern, flags)
+    assert result["matches"] == [(2, "ERROR one"), (4, "ERROR two ERROR again")]
+    assert not result["truncated"]
+    assert scan_file(os.path.join(tree, "logs", "app.log"), pattern, flags, max_matches=1)["truncated"]
+
+
+def test_scan_file_skips_binary_and_honours_flags(tree):
+    pattern, flags = compile_pattern("ERROR")
+    assert scan_file(os.path.join(tree, "logs", "core.bin"), pattern, flags) is None
+    assert scan_file(os.path.join(tree, "logs", "old", "app.log"), pattern, flags) is None
+    pattern, flags = compile_pattern("^err.r", regex=True, ignore_case=True)
+    assert scan_file(os.path.join(tree, "logs", "old", "app.log"), pattern, flags)["matches"] == [
+        (1, "error lower case")]
+
+
+def test_iter_files_filters_by_name_and_size(tree):
+    relative = lambda paths: [os.path.relpath(path, tree) for path in paths]
+    assert relative(iter_files(tree, "*.log")) == ["logs/app.log", "logs/old/app.log"]
+    assert relative(iter_files(tree, "*.log", max_size=50)) == ["logs/app.log"]
+
+
+def test_rejects_bad_patterns():
+    with pytest.raises(ValueError):
+        compile_pattern("(", regex=True)
+    with pytest.raises(ValueError):
+        compile_pattern("x*", regex=True)
+
+
+class GrepHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        os.mkdir(os.path.join(wb_main.ROOT_DIR, "logs"))
+        for i in range(5):
+            with open(os.path.join(wb_main.ROOT_DIR, "logs", f"{i}.log"), "w") as f:
+                f.write(f"line\nneedle {i}\n")
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "grep_workers": 2})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_streams_matches_then_summary(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        response = self.fetch("/grep/logs?q=needle&glob=*.log", headers=headers)
+        self.assertEqual(response.code, 200)
+        lines = [json.loads(line) for line in response.body.decode().splitlines()]
+        self.assertEqual(sorted((line["path"], line["line"]) for line in lines[:-1]),
+                         [(f"logs/{i}.log", 2) for i in range(5)])
+        self.assertEqual(lines[-1], {"done": True, "files_scanned": 5, "matches": 5, "truncated": False})
+        response = self.fetch("/grep/logs?q=needle&max_matches=2", headers=headers)
+        self.assertEqual(json.loads(response.body.decode().splitlines()[-1])["truncated"], True)
+        self.assertEqual(self.fetch("/grep/logs?q=(&regex=1", headers=headers).code, 400)
+        self.assertEqual(self.fetch("/grep/../etc?q=x", headers=headers).code, 403)
+        self.assertEqual(self.fetch("/grep/logs?q=needle", follow_redirects=False).code, 302)
+
+    def test_a_dead_worker_is_reported_and_the_pool_replaced(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        pool = grep.get_pool(2)
+        with pytest.raises(grep.BrokenProcessPool):
+            pool.submit(os._exit, 1).result()
+        response = self.fetch("/grep/logs?q=needle", headers=headers)
+        self.assertEqual((response.code, response.reason), (503, "Search workers failed"))
+        self.assertIsNot(grep.get_pool(2), pool)
+        response = self.fetch("/grep/logs?q=needle", headers=headers)
+        self.assertEqual(json.loads(response.body.decode().splitlines()[-1])["matches"], 5)
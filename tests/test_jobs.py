@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import errno
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import pytest
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from wb import jobs
+from wb import main as wb_main
+from wb.jobs import Job, JobCancelled, copy_tree, move, remove_tree
+from wb.metrics import JOBS
+
+# Checks the background job operations and the job endpoints.
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def tree():
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "src", "a", "b"))
+        with open(os.path.join(root, "src", "one.txt"), "wb") as f:
+            f.write(b"x" * 1000)
+        with open(os.path.join(root, "src", "a", "b", "two.txt"), "wb") as f:
+            f.write(b"y" * 24)
+        os.symlink("a", os.path.join(root, "src", "link"))
+        yield root
+
+
+def test_copy_tree_reports_progress_and_keeps_symlinks(tree, monkeypatch):
+    monkeypatch.setattr(jobs, "COPY_CHUNK_SIZE", 100)
+    job = Job("copy", "src", "dst")
+    copy_tree(job, os.path.join(tree, "src"), os.path.join(tree, "dst"))
+    assert (job.phase, job.entries, job.entries_total, job.bytes, job.bytes_total) == ("copying", 6, 6, 1024, 1024)
+    with open(os.path.join(tree, "dst", "a", "b", "two.txt"), "rb") as f:
+        assert f.read() == b"y" * 24
+    assert os.readlink(os.path.join(tree, "dst", "link")) == "a"
+    assert sorted(os.listdir(tree)) == ["dst", "src"]
+
+
+def test_cancelled_copy_leaves_nothing_behind(tree, monkeypatch):
+    monkeypatch.setattr(jobs, "COPY_CHUNK_SIZE", 100)
+    job = Job("copy", "src", "dst")
+    advance = job.advance
+
+    def cancel_midway(entries=0, size=0):
+        if job.phase == "copying" and job.bytes >= 300:
+            job.cancelled.set()
+        advance(entries, size)
+    job.advance = cancel_midway
+    with pytest.raises(JobCancelled):
+        copy_tree(job, os.path.join(tree, "src"), os.path.join(tree, "dst"))
+    assert sorted(os.listdir(tree)) == ["src"]
+
+
+def test_move_across_devices_copies_then_deletes(tree, monkeypatch):
+    rename = os.rename
+
+    def cross_device(source, target):
+        if source.endswith("src"):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        rename(source, target)
+    monkeypatch.setattr(os, "rename", cross_device)
+    job = Job("move", "src", "moved")
+    move(job, os.path.join(tree, "src"), os.path.join(tree, "moved"))
+    assert sorted(os.listdir(tree)) == ["moved"]
+    assert job.phase == "deleting"
+    assert os.path.getsize(os.path.join(tree, "moved", "one.txt")) == 1000
+
+
+def test_remove_tree_does_not_follow_symlinks(tree):
+    os.makedirs(os.path.join(tree, "keep"))
+    open(os.path.join(tree, "keep", "file"), "w").close()
+    os.symlink(os.path.join(tree, "keep"), os.path.join(tree, "src", "outside"))
+    job = Job("delete", "src")
+    remove_tree(job, os.path.join(tree, "src"))
+    assert sorted(os.listdir(tree)) == ["keep"]
+    assert os.listdir(os.path.join(tree, "keep")) == ["file"]
+    assert (job.entries, job.bytes) == (7, 1024)
+
+
+
+def test_cancelling_a_queued_job_counts_it(tmp_path):
+    job = Job("delete", "src", state_dir=str(tmp_path))
+    job.future = Future()
+    before = JOBS.values.get(("delete", "cancelled"), 0)
+    job.cancel()
+    assert job.state == "cancelled"
+    assert JOBS.values[("delete", "cancelled")] == before + 1
+
+class JobHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        os.makedirs(os.path.join(wb_main.ROOT_DIR, "tree", "sub"))
+        os.makedirs(os.path.join(wb_main.ROOT_DIR, "dest"))
+        with open(os.path.join(wb_main.ROOT_DIR, "tree", "sub", "file.txt"), "w") as f:
+            f.write("hello")
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "job_progress_interval": 20})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def login(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        return {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+
+    def wait_for(self, headers, job):
+        deadline = time.monotonic() + 5
+        while job["state"] in ("queued", "running") and time.monotonic() < deadline:
+            time.sleep(0.01)
+            job = json.loads(self.fetch(f"/jobs/{job['id']}", headers=headers).body)
+        return job
+
+    def test_copy_move_and_delete_jobs(self):
+        headers = self.login()
+        response = self.fetch("/copy", method="POST", body="path=tree&destination=dest", headers=headers)
+        self.assertEqual(response.code, 202)
+        job = self.wait_for(headers, json.loads(response.body))
+        self.assertEqual((job["state"], job["target"], job["bytes"]), ("done", "dest/tree", 5))
+        self.assertTrue(os.path.isfile(os.path.join(wb_main.ROOT_DIR, "dest", "tree", "sub", "file.txt")))
+
+        response = self.fetch("/move", method="POST", body="path=tree&destination=dest", headers=headers)
+        self.assertEqual(response.code, 409)
+        response = self.fetch("/move", method="POST", body="path=tree&destination=tree/sub", headers=headers)
+        self.assertEqual(response.code, 400)
+        response = self.fetch("/rename", method="POST", body="path=tree&new_name=renamed", headers=headers)
+        self.assertEqual(self.wait_for(headers, json.loads(response.body))["state"], "done")
+
+        response = self.fetch("/delete", method="POST", body="path=renamed", headers=headers)
+        job = self.wait_for(headers, json.loads(response.body))
+        self.assertEqual((job["kind"], job["state"], job["entries"]), ("delete", "done", 3))
+        self.assertEqual(sorted(os.listdir(wb_main.ROOT_DIR)), ["dest"])
+        jobs_list = json.loads(self.fetch("/jobs", headers=headers).body)["jobs"]
+        self.assertEqual([job["kind"] for job in jobs_list][-3:], ["copy", "rename", "delete"])
+        self.assertEqual(self.fetch("/delete", method="POST", body="path=", headers=headers).code, 403)
+
+    @gen_test
+    async def test_events_end_with_the_final_status(self):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        response = await self.http_client.fetch(self.get_url("/delete"), method="POST", body="path=tree",
+                                                headers=headers)
+        job = json.loads(response.body)
+        url = self.get_url(f"/jobs/{job['id']}/events").replace("http://", "ws://")
+        ws = await websocket_connect(HTTPRequest(url, headers=headers))
+        states = []
+        while True:
+            message = await ws.read_message()
+            if message is None:
+                break
+            states.append(json.loads(message)["state"])
+        self.assertEqual(states[-1], "done")
+
+    def test_state_files_are_read_off_the_ioloop(self):
+        headers = self.login()
+        state_dir = os.path.join(self.root.name, ".jobs")
+        wb_main.job_manager.configure(state_dir)
+        read_status = jobs.read_status
+        threads = []
+
+        def recording_read_status(state_dir, job_id):
+            threads.append(threading.current_thread())
+            return read_status(state_dir, job_id)
+
+        jobs.read_status = recording_read_status
+        try:
+            # Stands in for a job run by another worker
+            jobs.write_status(state_dir, "abcd", {**Job("delete", "x").status(), "id": "abcd", "pid": None})
+            self.assertEqual(json.loads(self.fetch("/jobs/abcd", headers=headers).body)["kind"], "delete")
+            self.assertIn("abcd", [job["id"] for job in json.loads(self.fetch("/jobs", headers=headers).body)["jobs"]])
+        finally:
+            jobs.read_status = read_status
+            wb_main.job_manager.configure(None)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from wb.linefilter import LineFilter, FilterState
+
+# Checks line selection and grep-style context against a line-by-line reference.
+
+LINES = [b"%s request %d\n" % (random.Random(i).choice([b"INFO", b"WARN", b"ERROR"]), i) for i in range(300)]
+
+
+def reference(line_filter, lines, before, after):
+    selected = [bool(line_filter.regex.search(line)) != line_filter.invert for line in lines]
+    keep = set()
+    for i, hit in enumerate(selected):
+        if hit:
+            keep.update(range(max(i - before, 0), min(i + after + 1, len(lines))))
+    return b"".join(lines[i] for i in sorted(keep))
+
+
+def feed_in_blocks(state, lines, sizes):
+    data = b"".join(lines)
+    out = []
+    pos = 0
+    for size in sizes:
+        end = data.rfind(b"\n", 0, pos + size) + 1
+        if end <= pos:
+            continue
+        for offset, run in state.feed(pos, data[pos:end]):
+            assert data[offset:offset + len(run)] == run
+            out.append(run)
+        pos = end
+    out.extend(run for _, run in state.feed(pos, data[pos:]))
+    return b"".join(out)
+
+
+@pytest.mark.parametrize("invert", [False, True])
+@pytest.mark.parametrize("before,after", [(0, 0), (2, 0), (0, 3), (2, 2)])
+def test_context_across_blocks(invert, before, after):
+    line_filter = LineFilter(["ERROR", "WARN request 1"], invert=invert, before=before, after=after)
+    expected = reference(line_filter, LINES, before, after)
+    for block in (17, 64, 1000, 100000):
+        assert feed_in_blocks(FilterState(line_filter), LINES, [block] * 1000) == expected
+
+
+def test_select_merges_adjacent_lines():
+    data = b"a\nb\nx\nb\n"
+    assert LineFilter(["a", "b"]).select(data) == [(0, 4), (6, 8)]
+    assert LineFilter(["a", "b"], invert=True).select(data) == [(4, 6)]
+    assert LineFilter(["A"], ignore_case=True).select(data) == [(0, 2)]
+    assert LineFilter(["a.b"], literal=True).select(b"axb\na.b\n") == [(4, 8)]
+
+
+def test_rejects_bad_filters():
+    for kwargs in ({"patterns": []}, {"patterns": ["("]}, {"patterns": ["x"], "before": 1000}):
+        with pytest.raises(ValueError):
+            LineFilter(**kwargs)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+from wb.lineindex import LineIndex
+
+# Checks line lookups through the sparse index, incremental extension on
+# append, rebuilds on truncation, and reuse of the on-disk sidecar.
+
+
+def write(path, data, mode="wb"):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def test_line_lookup_and_append():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "log")
+        write(path, b"".join(b"line %d\n" % i for i in range(2500)))
+        index = LineIndex(path, stride=100, cache_dir=os.path.join(tmp, "cache"))
+        result = index.read_lines(1234, 3)
+        assert result["lines"] == ["line 1234", "line 1235", "line 1236"]
+        assert result["total_lines"] == 2500
+        assert len(index.offsets) == 26
+
+        write(path, b"".join(b"line %d\n" % i for i in range(2500, 2600)), "ab")
+        scanned = index.scanned
+        assert index.read_lines(2550, 1)["lines"] == ["line 2550"]
+        assert index.lines == 2600 and index.scanned > scanned
+
+
+def test_partial_last_line_and_truncation():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "log")
+        write(path, b"a\nb\nc")
+        index = LineIndex(path, stride=2)
+        assert index.read_lines(0, 10)["lines"] == ["a", "b", "c"]
+        assert index.lines == 2
+        write(path, b"x\n")
+        assert index.read_lines(0, 10)["lines"] == ["x"]
+        assert index.lines == 1
+
+
+def test_sidecar_reused():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "log")
+        cache_dir = os.path.join(tmp, "cache")
+        write(path, b"".join(b"%d\n" % i for i in range(1000)))
+        LineIndex(path, stride=10, cache_dir=cache_dir).refresh()
+        assert len(os.listdir(cache_dir)) == 1
+        index = LineIndex(path, stride=10, cache_dir=cache_dir)
+        index.identity = (os.stat(path).st_dev, os.stat(path).st_ino)
+        index._load()
+        assert index.lines == 1000
+        assert index.read_lines(999, 1)["lines"] == ["999"]
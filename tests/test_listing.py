@@ -0,0 +1,104 @@
+import os
+import json
+import tempfile
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import listing
+from wb import main as wb_main
+from wb.listing import list_directory
+
+# Checks the scandir listing engine's sorting, cursor pagination and cache.
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    # Treat every listing as settled so the cache is used even right after writing
+    monkeypatch.setattr(listing, "RACY_NS", -10 ** 18)
+    with tempfile.TemporaryDirectory() as root:
+        for i in range(25):
+            with open(os.path.join(root, f"f{i:02d}"), "wb") as f:
+                f.write(b"x" * ((i * 7) % 11))
+            os.utime(os.path.join(root, f"f{i:02d}"), ns=(0, (i * 13 % 25) * 10 ** 9))
+        os.mkdir(os.path.join(root, "sub"))
+        yield root
+
+
+def walk(root, **kwargs):
+    names, cursor = [], None
+    while True:
+        page = list_directory(root, cursor=cursor, limit=4, **kwargs)
+        names.extend(entry["name"] for entry in page["entries"])
+        cursor = page["next"]
+        if cursor is None:
+            return names
+
+
+@pytest.mark.parametrize("sort", ["name", "size", "mtime"])
+@pytest.mark.parametrize("reverse", [False, True])
+def test_pages_cover_the_sorted_listing(directory, sort, reverse):
+    def key(name):
+        st = os.stat(os.path.join(directory, name))
+        return {"name": (name,), "size": (st.st_size, name), "mtime": (st.st_mtime_ns, name)}[sort]
+    expected = sorted(os.listdir(directory), key=key, reverse=reverse)
+    assert walk(directory, sort=sort, reverse=reverse) == expected
+
+
+def test_listing_is_cached_until_the_directory_changes(directory):
+    first = listing.get_listing(directory)
+    assert listing.get_listing(directory) is first
+    open(os.path.join(directory, "new"), "w").close()
+    os.utime(directory, ns=(0, first.identity[2] + 1))
+    assert "new" in walk(directory)
+
+
+def test_rejects_bad_arguments(directory):
+    with pytest.raises(ValueError):
+        list_directory(directory, sort="color")
+    with pytest.raises(ValueError):
+        list_directory(directory, cursor="not a cursor")
+
+
+class ListingHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        for name in ("a.log", "b.log", "c.log"):
+            open(os.path.join(wb_main.ROOT_DIR, name), "w").close()
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_json_and_html_pages(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        page = json.loads(self.fetch("/?format=json&limit=2", headers=headers).body)
+        self.assertEqual([entry["name"] for entry in page["entries"]], ["a.log", "b.log"])
+        page = json.loads(self.fetch(f"/?format=json&cursor={page['next']}", headers=headers).body)
+        self.assertEqual(([entry["name"] for entry in page["entries"]], page["next"]), (["c.log"], None))
+        html = self.fetch("/?limit=1", headers=headers).body.decode()
+        self.assertIn("a.log", html)
+        self.assertNotIn("b.log", html)
+        self.assertEqual(self.fetch("/?cursor=bogus", headers=headers).code, 400)
+
+    def test_sibling_directories_are_outside_the_root(self):
+        # A sibling sharing the root's name as a prefix (root2 next to root) must not be reachable
+        sibling = wb_main.ROOT_DIR + "2"
+        os.mkdir(sibling)
+        try:
+            with open(os.path.join(sibling, "secret.txt"), "w") as f:
+                f.write("secret")
+            response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+            headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+            name = os.path.basename(sibling)
+            response = self.fetch(f"/%2E%2E/{name}/secret.txt?download=1", headers=headers)
+            self.assertEqual(response.code, 403)
+        finally:
+            os.remove(os.path.join(sibling, "secret.txt"))
+            os.rmdir(sibling)
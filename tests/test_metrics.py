@@ -0,0 +1,87 @@
+import os
+import time
+import tempfile
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.metrics import Registry, StallDetector
+
+# Checks the metric types, the Prometheus output and the IOLoop stall detector.
+
+TOKEN = "test-token"
+
+
+def test_histogram_buckets_are_cumulative_and_merged_across_processes():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("handler",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, "Main")
+    other = Registry()
+    other.histogram("latency_seconds", "Latency.", ("handler",), buckets=(0.1, 1)).observe(0.05, "Main")
+    text = registry.render([other.snapshot()])
+    assert 'latency_seconds_bucket{handler="Main",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{handler="Main",le="1"} 3' in text
+    assert 'latency_seconds_bucket{handler="Main",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{handler="Main"} 4' in text
+    assert "# TYPE latency_seconds histogram" in text
+
+
+def test_counter_labels_are_escaped():
+    registry = Registry()
+    registry.counter("things_total", "Things.", ("name",)).inc('a "b"\\c', amount=2)
+    assert 'things_total{name="a \\"b\\"\\\\c"} 2' in registry.render()
+
+
+class BlockingHandler(tornado.web.RequestHandler):
+    def get(self):
+        time.sleep(0.3)
+        self.write("done")
+
+
+class MetricsHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        with open(os.path.join(wb_main.ROOT_DIR, "a.txt"), "w") as f:
+            f.write("hello\n")
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_requests_are_counted_per_handler(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        self.assertEqual(self.fetch("/a.txt?download=1", headers=headers).code, 200)
+        self.assertEqual(self.fetch("/metrics").code, 403)
+        self.assertEqual(self.fetch("/metrics", headers={"Authorization": "Bearer t\u00f6ken"}).code, 403)
+        response = self.fetch("/metrics", headers={"Authorization": f"Bearer {TOKEN}"})
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        text = response.body.decode()
+        self.assertIn('filey_http_requests_total{handler="MainHandler",method="GET",code="200"}', text)
+        self.assertIn('filey_http_request_duration_seconds_count{handler="MainHandler",method="GET"}', text)
+        self.assertIn('filey_http_response_bytes_total{handler="MainHandler"}', text)
+        self.assertIn("filey_executor_queued", text)
+
+
+class StallDetectorTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.detector = StallDetector(threshold=0.1)
+        self.detector.start()
+        return tornado.web.Application([(r"/block", BlockingHandler)])
+
+    def tearDown(self):
+        self.detector.stop()
+        super().tearDown()
+
+    def test_blocked_loop_is_reported_with_the_handler(self):
+        with self.assertLogs("wb.metrics", "WARNING") as logs:
+            self.assertEqual(self.fetch("/block").body, b"done")
+        self.assertEqual(self.detector.stalls, 1)
+        self.assertIn("BlockingHandler (GET /block)", logs.output[0])
+        self.assertIn("time.sleep(0.3)", logs.output[0])
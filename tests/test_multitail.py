@@ -0,0 +1,38 @@
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from wb.multitail import Source, TimestampMerger, parse_timestamp
+
+# Checks the timestamp k-way merge used by /multistream.
+
+
+def test_parse_timestamp():
+    assert parse_timestamp(b"2024-05-01T12:00:00.5Z x") == b"2024-05-01T12:00:00.500000000"
+    assert parse_timestamp(b"[2024-05-01 12:00:00,123] x") == b"2024-05-01T12:00:00.123000000"
+    assert parse_timestamp(b"  at Foo.bar()") is None
+
+
+class TimestampMergerTest(AsyncTestCase):
+    @gen_test
+    async def test_waits_for_all_sources_or_delay(self):
+        emitted = []
+        merger = TimestampMerger(lambda source, offset, data: emitted.append((source.name, offset, data)),
+                                 delay=0.05)
+        a, b = Source("a", None), Source("b", None)
+        merger.add_source(a)
+        merger.add_source(b)
+
+        merger.add(a, 0, b"2024-01-01T00:00:02 a1\n  trace\n2024-01-01T00:00:05 a2\n")
+        self.assertEqual(emitted, [])
+        merger.add(b, 100, b"2024-01-01T00:00:01 b1\n2024-01-01T00:00:03 b2\n")
+        # a2 stays queued: b may still produce something older
+        self.assertEqual(emitted, [
+            ("b", 100, b"2024-01-01T00:00:01 b1\n"),
+            ("a", 0, b"2024-01-01T00:00:02 a1\n  trace\n"),
+            ("b", 123, b"2024-01-01T00:00:03 b2\n"),
+        ])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(emitted[-1], ("a", 31, b"2024-01-01T00:00:05 a2\n"))
+        merger.close()
@@ -0,0 +1,140 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from wb import main as wb_main
+from wb import search
+from wb.search import PathIndex
+
+# Checks the filename index: trigram and glob queries and incremental updates.
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def index():
+    with tempfile.TemporaryDirectory() as root:
+        for service in ("api", "web", "db"):
+            os.makedirs(os.path.join(root, "logs", service))
+            for name in ("app.log", "error.log", "app.log.1"):
+                open(os.path.join(root, "logs", service, name), "w").close()
+        open(os.path.join(root, "README"), "w").close()
+        index = PathIndex(root)
+        index.build()
+        yield index
+
+
+def paths(result):
+    return sorted(r["path"] for r in result["results"])
+
+
+def test_substring_and_glob_queries(index):
+    assert paths(index.search("ERROR")) == [f"logs/{s}/error.log" for s in ("api", "db", "web")]
+    assert paths(index.search("*.log.1")) == [f"logs/{s}/app.log.1" for s in ("api", "db", "web")]
+    assert paths(index.search("web/app")) == ["logs/web/app.log", "logs/web/app.log.1"]
+    assert paths(index.search("logs/a*/app.log")) == ["logs/api/app.log"]
+    assert paths(index.search("db")) == ["logs/db"]
+    assert index.search("log", limit=2)["truncated"]
+    assert index.search("nothing-like-this")["results"] == []
+
+
+def test_short_queries_scan_a_bounded_number_of_entries(index, monkeypatch):
+    assert paths(index.search("db")) == ["logs/db"]
+    assert not index.search("db")["truncated"]
+    # Entries are numbered in walk order, so the bound leaves the later ones out
+    monkeypatch.setattr(search, "MAX_SHORT_QUERY_SCAN", 3)
+    result = index.search("db")
+    assert result["truncated"]
+    assert len(paths(result)) <= 1
+
+
+def test_incremental_updates(index):
+    root = index.root
+    os.makedirs(os.path.join(root, "new", "deep"))
+    open(os.path.join(root, "new", "deep", "fresh.txt"), "w").close()
+    index.add(os.path.join(root, "new", "deep", "fresh.txt"))
+    assert paths(index.search("fresh")) == ["new/deep/fresh.txt"]
+
+    os.rename(os.path.join(root, "logs", "api"), os.path.join(root, "logs", "gateway"))
+    index.rename(os.path.join(root, "logs", "api"), os.path.join(root, "logs", "gateway"))
+    assert "logs/gateway/error.log" in paths(index.search("error"))
+    assert "logs/api/error.log" not in paths(index.search("error"))
+
+    index.remove(os.path.join(root, "logs"))
+    assert paths(index.search("log")) == []
+    live = index.stats()["entries"]
+    index.compact()
+    assert index.stats()["entries"] == live
+    assert index.stats()["deleted_entries"] == 0
+    assert paths(index.search("fresh")) == ["new/deep/fresh.txt"]
+
+
+def test_rescan_picks_up_changes_on_disk(index):
+    root = index.root
+    open(os.path.join(root, "logs", "db", "slow.log"), "w").close()
+    os.remove(os.path.join(root, "README"))
+    # Make sure the mtime differs even on filesystems with coarse timestamps
+    for directory in (root, os.path.join(root, "logs", "db")):
+        os.utime(directory, ns=(0, 12345))
+    index.rescan()
+    assert paths(index.search("slow")) == ["logs/db/slow.log"]
+    assert index.search("README")["results"] == []
+
+
+class SearchHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        open(os.path.join(wb_main.ROOT_DIR, "report.csv"), "w").close()
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        index = search.current_path_index(wb_main.ROOT_DIR)
+        if index is not None:
+            index.stop()
+            index.thread.join()
+        super().tearDown()
+        self.root.cleanup()
+
+    def test_search_and_delete(self):
+        response = self.fetch("/login", method="POST", body=f"token={TOKEN}", follow_redirects=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        self.fetch("/search?q=report", headers=headers)
+        index = search.current_path_index(wb_main.ROOT_DIR)
+        while not index.complete:
+            index.thread.join(0.01)
+        result = json.loads(self.fetch("/search?q=report", headers=headers).body)
+        self.assertEqual(paths(result), ["report.csv"])
+        self.fetch("/delete", method="POST", body="path=report.csv", headers=headers, follow_redirects=False)
+        self.assertEqual(json.loads(self.fetch("/search?q=report", headers=headers).body)["results"], [])
+        self.assertEqual(json.loads(self.fetch("/search/stats", headers=headers).body)["entries"], 0)
+
+    @gen_test
+    async def test_search_waits_for_the_index_off_the_ioloop(self):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        headers = {"Cookie": response.headers["Set-Cookie"].split(";")[0]}
+        index = search.get_path_index(wb_main.ROOT_DIR)
+        while not index.complete:
+            await asyncio.sleep(0.01)
+        # A compaction holds the index lock like this for as long as the rebuild takes
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with index.lock:
+                locked.set()
+                release.wait()
+
+        threading.Thread(target=hold_lock).start()
+        locked.wait()
+        pending = asyncio.ensure_future(self.http_client.fetch(self.get_url("/search?q=report"), headers=headers))
+        await asyncio.sleep(0.1)
+        self.assertFalse(pending.done())
+        release.set()
+        self.assertEqual(paths(json.loads((await pending).body)), ["report.csv"])
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from wb import tail
+from wb import main as wb_main
+from wb.linefilter import LineFilter
+from wb.tail import tail_hub
+
+# Exercises /stream/ WebSocket tails against an in-process application.
+
+TOKEN = "test-token"
+
+
+class StreamTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.log_path = os.path.join(wb_main.ROOT_DIR, "app.log")
+        with open(self.log_path, "w") as f:
+            f.writelines(f"line {i}\n" for i in range(500))
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login"})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    async def connect(self, query=""):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        url = self.get_url("/stream/app.log" + query).replace("http://", "ws://")
+        return await websocket_connect(HTTPRequest(url, headers={"Cookie": cookie}))
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    def append(self, text):
+        with open(self.log_path, "a") as f:
+            f.write(text)
+
+    @gen_test
+    async def test_history_and_shared_watcher(self):
+        first = await self.connect()
+        history = await self.read(first)
+        self.assertEqual(history["text"].splitlines(), [f"line {i}" for i in range(400, 500)])
+        self.assertEqual(history["end"], os.path.getsize(self.log_path))
+
+        second = await self.connect("?lines=3")
+        self.assertEqual((await self.read(second))["text"], "line 497\nline 498\nline 499\n")
+        self.assertEqual(len(tail_hub.watchers), 1)
+
+        self.append("new line\n")
+        watcher, = tail_hub.watchers.values()
+        await watcher.check()
+        self.assertEqual((await self.read(first))["text"], "new line\n")
+        self.assertEqual((await self.read(second))["text"], "new line\n")
+
+        first.close()
+        second.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def test_resume_from_offset(self):
+        connection = await self.connect("?lines=1")
+        frame = await self.read(connection)
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+        self.append("missed 1\nmissed 2\n")
+        connection = await self.connect(f"?from_offset={frame['end']}&file={frame['file']}")
+        resumed = await self.read(connection)
+        self.assertEqual((resumed["offset"], resumed["text"]), (frame["end"], "missed 1\nmissed 2\n"))
+        connection.close()
+
+        connection = await self.connect(f"?lines=1&from_offset={frame['end']}&file=0:0")
+        self.assertEqual((await self.read(connection))["type"], "reset")
+        self.assertEqual((await self.read(connection))["text"], "missed 2\n")
+        connection.close()
+
+        connection = await self.connect("?from_offset=-5")
+        self.assertEqual(await self.read(connection), {"type": "error", "message": "from_offset must not be negative"})
+        connection.close()
+
+    @gen_test
+    async def test_filtered_stream(self):
+        first = await self.connect("?grep=line+4%5B0-9%5D9$&lines=3")
+        history = await self.read(first)
+        self.assertEqual(history["text"], "line 479\nline 489\nline 499\n")
+        self.assertEqual(history["end"], os.path.getsize(self.log_path))
+        second = await self.connect("?grep=line+4%5B0-9%5D9$&lines=1")
+        self.assertEqual((await self.read(second))["text"], "line 499\n")
+        watcher, = tail_hub.watchers.values()
+        self.assertEqual(len(watcher.filters), 1)
+
+        self.append("line 409\nskip me\nline 419\n")
+        await watcher.check()
+        for connection in (first, second):
+            frame = await self.read(connection)
+            self.assertEqual(frame["text"], "line 409\nline 419\n")
+            self.assertEqual(frame["end"], os.path.getsize(self.log_path))
+        first.close()
+        second.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+        self.append("nope\nline 429\nnope\n")
+        connection = await self.connect(f"?grep=429&context=1&from_offset={frame['end']}&file={frame['file']}")
+        self.assertEqual((await self.read(connection))["text"], "nope\nline 429\nnope\n")
+        connection.close()
+
+        bad = await self.connect("?grep=(")
+        self.assertEqual((await self.read(bad))["type"], "error")
+
+    @gen_test
+    async def test_filtered_history_is_scanned_off_the_ioloop(self):
+        # A slow regex over many small blocks stands in for a long backwards scan of a big file
+        select = LineFilter.select
+
+        def slow_select(line_filter, data, start=0):
+            time.sleep(0.01)
+            return select(line_filter, data, start)
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        original = tail.FILTER_BLOCK_SIZE
+        tail.FILTER_BLOCK_SIZE = 128
+        LineFilter.select = slow_select
+        task = asyncio.ensure_future(ticker())
+        try:
+            connection = await self.connect("?grep=line+1$&lines=1")
+            self.assertEqual((await self.read(connection))["text"], "line 1\n")
+        finally:
+            task.cancel()
+            LineFilter.select = select
+            tail.FILTER_BLOCK_SIZE = original
+        # About 40 blocks at 10ms each; the loop kept running while they were scanned
+        self.assertGreater(ticks, 20)
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+
+class MultiStreamTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        for name, stamps in (("api", ["00", "02"]), ("web", ["01", "03"])):
+            os.makedirs(os.path.join(wb_main.ROOT_DIR, "logs", name))
+            with open(os.path.join(wb_main.ROOT_DIR, "logs", name, "app.log"), "w") as f:
+                f.writelines(f"2024-01-01T00:00:{stamp} {name}\n" for stamp in stamps)
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "multistream_rescan_interval": 20})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    async def connect(self, query):
+        response = await self.http_client.fetch(self.get_url("/login"), method="POST", body=f"token={TOKEN}",
+                                                follow_redirects=False, raise_error=False)
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        url = self.get_url("/multistream" + query).replace("http://", "ws://")
+        return await websocket_connect(HTTPRequest(url, headers={"Cookie": cookie}))
+
+    async def read_data(self, connection, count):
+        messages = []
+        while len(messages) < count:
+            message = json.loads(await connection.read_message())
+            if message["type"] == "data":
+                messages.append(message)
+        return [(m["source"], m["text"]) for m in messages]
+
+    @gen_test
+    async def test_merges_by_timestamp_and_picks_up_new_files(self):
+        connection = await self.connect("?glob=logs/*/app.log&merge=timestamp")
+        self.assertEqual(await self.read_data(connection, 4), [
+            ("logs/api/app.log", "2024-01-01T00:00:00 api\n"),
+            ("logs/web/app.log", "2024-01-01T00:00:01 web\n"),
+            ("logs/api/app.log", "2024-01-01T00:00:02 api\n"),
+            ("logs/web/app.log", "2024-01-01T00:00:03 web\n"),
+        ])
+
+        os.makedirs(os.path.join(wb_main.ROOT_DIR, "logs", "db"))
+        with open(os.path.join(wb_main.ROOT_DIR, "logs", "db", "app.log"), "w") as f:
+            f.write("2024-01-01T00:00:04 db\n")
+        source = json.loads(await connection.read_message())
+        self.assertEqual((source["type"], source["source"]), ("source", "logs/db/app.log"))
+        self.assertEqual(await self.read_data(connection, 1), [("logs/db/app.log", "2024-01-01T00:00:04 db\n")])
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def test_deleted_files_stop_holding_up_the_merge(self):
+        # Long enough that lines only come out once every remaining file has something queued
+        self._app.settings["multistream_merge_delay"] = 60
+        connection = await self.connect("?glob=logs/*/app.log&merge=timestamp")
+        self.assertEqual(len(await self.read_data(connection, 3)), 3)
+        os.remove(os.path.join(wb_main.ROOT_DIR, "logs", "web", "app.log"))
+        message = json.loads(await connection.read_message())
+        while message["type"] != "removed":
+            message = json.loads(await connection.read_message())
+        self.assertEqual(message["source"], "logs/web/app.log")
+        with open(os.path.join(wb_main.ROOT_DIR, "logs", "api", "app.log"), "a") as f:
+            f.write("2024-01-01T00:00:05 api\n")
+        self.assertEqual(await self.read_data(connection, 1), [("logs/api/app.log", "2024-01-01T00:00:05 api\n")])
+        connection.close()
+        while tail_hub.watchers:
+            await asyncio.sleep(0.01)
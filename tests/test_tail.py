@@ -0,0 +1,209 @@
+import io
+import os
+import asyncio
+import tempfile
+import threading
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from wb import tail
+from wb.linefilter import LineFilter, FilterState
+from wb.tail import read_tail, TailWatcher, FrameCoalescer, FilteredTail
+
+# Checks the backward block reader used for stream history and the shared
+# tail watcher's handling of appends, rotation and truncation.
+
+
+def test_read_tail_matches_last_lines():
+    lines = [b"line %d\n" % i for i in range(5000)]
+    data = b"".join(lines)
+    for count in (0, 1, 10, 4999, 5000, 6000):
+        offset, tail = read_tail(io.BytesIO(data), count, block_size=100)
+        expected = b"".join(lines[-count:]) if count else b""
+        assert tail == expected
+        assert data[offset:] == expected
+
+
+def test_read_tail_partial_last_line():
+    offset, tail = read_tail(io.BytesIO(b"a\nb\nc"), 2, block_size=1)
+    assert tail == b"b\nc"
+    assert offset == 2
+
+
+def test_read_tail_respects_end_and_max_bytes():
+    data = b"a\nb\nc\nd\n"
+    assert read_tail(io.BytesIO(data), 1, end=4)[1] == b"b\n"
+    offset, tail = read_tail(io.BytesIO(b"x" * 1000 + b"\n"), 1, block_size=10, max_bytes=100)
+    assert len(tail) <= 100 and offset > 0
+
+
+class Collector:
+    def __init__(self):
+        self.events = []
+
+    def on_tail_data(self, offset, data):
+        self.events.append((offset, data))
+
+    def on_tail_reset(self, reason):
+        self.events.append(reason)
+
+
+class TailWatcherTest(AsyncTestCase):
+    backend = "auto"
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "app.log")
+        self.write("old\n")
+        self.watcher = TailWatcher(self.path, None, backend=self.backend, interval=20)
+        self.collector = Collector()
+        self.watcher.subscribers.add(self.collector)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def write(self, text, mode="a"):
+        with open(self.path, mode) as f:
+            f.write(text)
+
+    async def wait_for(self, count):
+        for _ in range(200):
+            if len(self.collector.events) >= count:
+                return self.collector.events
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"Timed out waiting for events, got {self.collector.events}")
+
+    @gen_test
+    async def test_follows_appends_rotation_and_truncation(self):
+        self.assertEqual(self.watcher.history(10), (0, b"old\n"))
+        self.write("one\n")
+        await self.wait_for(1)
+        self.assertEqual(self.collector.events, [(4, b"one\n")])
+
+        os.rename(self.path, self.path + ".1")
+        self.write("new\n", "w")
+        await self.wait_for(3)
+        self.assertEqual(self.collector.events[1:], ["rotated", (0, b"new\n")])
+
+        self.write("", "w")
+        self.write("x\n")
+        await self.wait_for(5)
+        self.assertEqual(self.collector.events[3:], ["truncated", (0, b"x\n")])
+
+    @gen_test
+    async def test_filtered_history_across_blocks(self):
+        self.write("".join(f"{'ERROR' if i % 7 == 0 else 'INFO'} {i}\n" for i in range(1000)))
+        await self.watcher.check()
+        lines = open(self.path, "rb").read().splitlines(keepends=True)
+        filtered = FilteredTail(self.watcher, LineFilter(["ERROR"], before=1))
+        original = tail.FILTER_BLOCK_SIZE
+        tail.FILTER_BLOCK_SIZE = 50
+        try:
+            runs = filtered.history(5)
+        finally:
+            tail.FILTER_BLOCK_SIZE = original
+        hits = [i for i, line in enumerate(lines) if line.startswith(b"ERROR")][-5:]
+        expected = b"".join(lines[j] for i in hits for j in (i - 1, i))
+        self.assertEqual(b"".join(data for _, data in runs), expected)
+
+
+    @gen_test
+    async def test_live_data_is_filtered_off_the_ioloop_in_order(self):
+        filtered = FilteredTail(self.watcher, LineFilter(["ERROR"]))
+        self.watcher.subscribers = {filtered}
+        filtered.subscribers.add(self.collector)
+        feed = FilterState.feed
+        threads = []
+
+        def recording_feed(state, offset, data):
+            threads.append(threading.current_thread())
+            return feed(state, offset, data)
+
+        FilterState.feed = recording_feed
+        try:
+            for i in range(5):
+                self.watcher.publish(f"ERROR {i}\nINFO {i}\n".encode())
+            await self.wait_for(5)
+        finally:
+            FilterState.feed = feed
+        self.assertEqual([data for _, data in self.collector.events], [f"ERROR {i}\n".encode() for i in range(5)])
+        self.assertNotIn(threading.main_thread(), threads)
+
+class PollingTailWatcherTest(TailWatcherTest):
+    backend = "poll"
+
+
+class FrameCoalescerTest(AsyncTestCase):
+    @gen_test
+    async def test_batches_and_drops_when_behind(self):
+        frames, skipped, unsent = [], [], []
+
+        def send_frame(offset, data, end):
+            self.assertEqual(end, offset + len(data))
+            frames.append((offset, data))
+            future = asyncio.get_running_loop().create_future()
+            unsent.append(future)
+            return future
+
+        coalescer = FrameCoalescer(send_frame, lambda offset, count: skipped.append((offset, count)),
+                                   frame_size=10, delay=0.01, high_water=40)
+        coalescer.push(0, b"a\n")
+        coalescer.push(2, b"b\n")
+        self.assertEqual(frames, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(frames, [(0, b"a\nb\n")])
+
+        coalescer.push(4, b"0123\n5678\n")
+        self.assertEqual(frames[1:], [(4, b"0123\n5678\n")])
+        coalescer.push(14, b"x" * 20 + b"\n")
+        coalescer.push(35, b"dropped\n")
+        self.assertEqual(skipped, [])
+
+        for future in unsent:
+            future.set_result(None)
+        await asyncio.sleep(0)
+        coalescer.push(43, b"z\n")
+        coalescer.flush()
+        self.assertEqual(skipped, [(35, 8)])
+        self.assertEqual(frames[-1], (43, b"z\n"))
+        self.assertTrue(all(len(data) <= 10 for _, data in frames))
+        self.assertEqual(b"".join(data for _, data in frames[2:5]), b"x" * 20 + b"\n")
+
+    @gen_test
+    async def test_drops_are_reported_when_the_file_goes_quiet(self):
+        frames, skipped, unsent = [], [], []
+
+        def send_frame(offset, data, end):
+            frames.append((offset, data))
+            future = asyncio.get_running_loop().create_future()
+            unsent.append(future)
+            return future
+
+        coalescer = FrameCoalescer(send_frame, lambda offset, count: skipped.append((offset, count)),
+                                   frame_size=10, delay=0.01, high_water=20)
+        coalescer.push(0, b"0123456789")
+        coalescer.push(10, b"0123456789")
+        coalescer.push(20, b"dropped\n")
+        self.assertEqual(skipped, [])
+        # Nothing else is written; the client still learns about the gap once it has caught up
+        unsent[0].set_result(None)
+        await asyncio.sleep(0)
+        self.assertEqual(skipped, [(20, 8)])
+        unsent[1].set_result(None)
+        await asyncio.sleep(0)
+        self.assertEqual(skipped, [(20, 8)])
+
+    @gen_test
+    async def test_frames_span_gaps_between_runs(self):
+        frames = []
+        coalescer = FrameCoalescer(lambda offset, data, end: frames.append((offset, data, end)),
+                                   lambda offset, count: None, frame_size=6, delay=0.01)
+        coalescer.push(0, b"a\n")
+        coalescer.push(10, b"b\n")
+        coalescer.push(20, b"c\nd\n")
+        coalescer.flush()
+        self.assertEqual(frames, [(0, b"a\nb\nc\n", 22), (22, b"d\n", 24)])
@@ -0,0 +1,138 @@
+import os
+import json
+import uuid
+import hashlib
+import tempfile
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from wb import main as wb_main
+from wb.multipart import MultipartError, MultipartParser
+
+# Exercises the streaming multipart parser and the spooling UploadHandler
+# against an in-process application.
+
+TOKEN = "test-token"
+
+
+def encode_multipart(boundary, fields, files):
+    body = b""
+    for name, value in fields:
+        body += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n").encode()
+    for name, filename, data in files:
+        body += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                 f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode()
+
+
+def test_parser_handles_any_chunking():
+    boundary = "b0undary"
+    payload = os.urandom(3000) + b"\r\n--b0und" + os.urandom(100)
+    body = encode_multipart(boundary, [("directory", "sub")], [("files", "a/b.bin", payload)])
+    for chunk_size in (1, 7, 64, 4096):
+        parts = []
+        parser = MultipartParser(boundary.encode(),
+                                 lambda headers: parts.append([headers, b""]),
+                                 lambda data: parts[-1].__setitem__(1, parts[-1][1] + data),
+                                 lambda: None)
+        for i in range(0, len(body), chunk_size):
+            parser.feed(body[i:i + chunk_size])
+        parser.close()
+        assert [p[1] for p in parts] == [b"sub", payload]
+
+
+def test_parser_rejects_malformed_part_headers():
+    for headers in (b"Content-Disposition: form-data; name=\"\xff\"", b"no colon here"):
+        parser = MultipartParser(b"b", lambda headers: None, lambda data: None, lambda: None)
+        with pytest.raises(MultipartError):
+            parser.feed(b"--b\r\n" + headers + b"\r\n\r\ndata\r\n--b--\r\n")
+
+
+class UploadTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.root = tempfile.TemporaryDirectory()
+        wb_main.ROOT_DIR = os.path.realpath(self.root.name)
+        wb_main.ACCESS_TOKEN = TOKEN
+        self.state = tempfile.TemporaryDirectory()
+        return wb_main.make_app({"cookie_secret": TOKEN, "login_url": "/login", "max_upload_file_size": 1024,
+                                 "upload_state_dir": self.state.name})
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+        self.state.cleanup()
+
+    def upload(self, fields, files, query=""):
+        cookie = self.fetch("/login", method="POST", body=f"token={TOKEN}",
+                            follow_redirects=False).headers["Set-Cookie"].split(";")[0]
+        boundary = uuid.uuid4().hex
+        return self.fetch("/upload" + query, method="POST", follow_redirects=False,
+                          body=encode_multipart(boundary, fields, files),
+                          headers={"Cookie": cookie, "Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+    def test_drag_and_drop_upload(self):
+        response = self.upload([("directory", "dest")], [("files", "nested/x.txt", b"hello"), ("files", "y.txt", b"world")])
+        self.assertEqual(response.code, 200)
+        with open(os.path.join(wb_main.ROOT_DIR, "dest", "nested", "x.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"hello")
+        self.assertEqual(sorted(os.listdir(os.path.join(wb_main.ROOT_DIR, "dest"))), ["nested", "y.txt"])
+
+    def test_form_upload_redirects(self):
+        response = self.upload([], [("file", "../escape.txt", b"data")], query="?directory=d")
+        self.assertEqual(response.code, 302)
+        self.assertTrue(os.path.exists(os.path.join(wb_main.ROOT_DIR, "d", "escape.txt")))
+
+    def test_traversal_rejected(self):
+        response = self.upload([], [("files", "../../escape.txt", b"data")])
+        self.assertEqual(response.code, 403)
+
+    def test_file_size_limit(self):
+        response = self.upload([], [("files", "big.bin", b"x" * 2048)])
+        self.assertEqual(response.code, 413)
+        self.assertEqual(os.listdir(wb_main.ROOT_DIR), [])
+
+    def test_write_errors_are_reported_and_cleaned_up(self):
+        with open(os.path.join(wb_main.ROOT_DIR, "blocker"), "wb"):
+            pass
+        # The second part's directory can't be created because a file is in the way
+        response = self.upload([], [("files", "ok.txt", b"fine"), ("files", "blocker/x.txt", b"data")])
+        self.assertEqual(response.code, 500)
+        self.assertIn(b"Could not store the upload", response.body)
+        self.assertEqual(sorted(os.listdir(wb_main.ROOT_DIR)), ["blocker", "ok.txt"])
+
+    def test_chunked_session(self):
+        cookie = self.fetch("/login", method="POST", body=f"token={TOKEN}",
+                            follow_redirects=False).headers["Set-Cookie"].split(";")[0]
+        headers = {"Cookie": cookie}
+        data = os.urandom(1000)
+        response = self.fetch("/upload/sessions", method="POST", headers=headers,
+                              body="directory=up&path=big.bin&size=1000&chunk_size=300")
+        self.assertEqual(response.code, 201)
+        session = json.loads(response.body)
+        self.assertEqual(session["chunks"], 4)
+        base = "/upload/sessions/" + session["id"]
+
+        for index in (3, 1, 0):
+            response = self.fetch(f"{base}/chunks/{index}", method="PUT", headers=headers,
+                                  body=data[index * 300:(index + 1) * 300])
+            self.assertEqual(response.code, 204)
+        status = json.loads(self.fetch(base, headers=headers).body)
+        self.assertEqual(status["received"], [0, 1, 3])
+        self.assertEqual(self.fetch(base + "/finalize", method="POST", headers=headers, body="").code, 409)
+
+        self.fetch(f"{base}/chunks/2", method="PUT", headers=headers, body=data[600:900])
+        response = self.fetch(base + "/finalize", method="POST", headers=headers,
+                              body="sha256=" + hashlib.sha256(data).hexdigest())
+        self.assertEqual(response.code, 200)
+        with open(os.path.join(wb_main.ROOT_DIR, "up", "big.bin"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(os.path.join(wb_main.ROOT_DIR, "up")), ["big.bin"])
+
+        # A retried finalize gets the same answer, but only for the same content
+        retry = self.fetch(base + "/finalize", method="POST", headers=headers,
+                           body="sha256=" + hashlib.sha256(data).hexdigest())
+        self.assertEqual((retry.code, retry.body), (200, response.body))
+        self.assertEqual(self.fetch(base + "/finalize", method="POST", headers=headers, body="sha256=" + "0" * 64).code,
+                         422)
+        self.assertEqual(self.fetch(base, headers=headers).code, 404)
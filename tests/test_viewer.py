@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+from wb.viewer import read_window
+
+# Checks that viewer windows are line aligned and chain together without gaps.
+
+
+def make_file(content):
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_forward_windows_cover_file():
+    content = b"".join(b"line %d\n" % i for i in range(1000))
+    path = make_file(content)
+    try:
+        text, offset = "", 0
+        while offset < len(content):
+            window = read_window(path, offset, 100)
+            assert window["text"].endswith("\n")
+            text += window["text"]
+            offset = window["end"]
+        assert text.encode() == content
+    finally:
+        os.remove(path)
+
+
+def test_backward_windows_cover_file():
+    content = b"".join(b"line %d\n" % i for i in range(1000))
+    path = make_file(content)
+    try:
+        text, offset = "", None
+        while offset != 0:
+            window = read_window(path, offset, 100, backward=True)
+            assert window["start"] == 0 or content[window["start"] - 1:window["start"]] == b"\n"
+            text = window["text"] + text
+            offset = window["start"]
+        assert text.encode() == content
+    finally:
+        os.remove(path)
+
+
+def test_window_does_not_split_utf8():
+    path = make_file("é".encode() * 100)
+    try:
+        window = read_window(path, 0, 51)
+        assert window["end"] == 50
+        assert "�" not in window["text"]
+    finally:
+        os.remove(path)
@@ -0,0 +1,110 @@
+import os
+import time
+import signal
+import asyncio
+import tempfile
+import threading
+
+import tornado.web
+import tornado.httpclient
+import tornado.httpserver
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from wb.jobs import JobManager
+from wb.workers import RequestTracker, Supervisor, drain
+
+# Checks request draining, worker supervision and jobs shared between processes.
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    async def get(self):
+        for _ in range(5):
+            self.write(b"x" * 1024)
+            await self.flush()
+            await asyncio.sleep(0.05)
+
+
+class DrainTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([(r"/slow", SlowHandler)])
+
+    def get_http_server(self):
+        self.tracker = RequestTracker(self._app)
+        return tornado.httpserver.HTTPServer(self.tracker, **self.get_httpserver_options())
+
+    @gen_test
+    async def test_in_flight_request_finishes_before_drain_returns(self):
+        response = asyncio.ensure_future(self.http_client.fetch(self.get_url("/slow")))
+        while not self.tracker.active:
+            await asyncio.sleep(0.01)
+        self.assertTrue(await drain(self.http_server, self.tracker, timeout=5))
+        self.assertEqual(len((await response).body), 5 * 1024)
+        self.assertFalse(self.tracker.active)
+
+    @gen_test
+    async def test_drain_gives_up_after_the_timeout(self):
+        response = asyncio.ensure_future(self.http_client.fetch(self.get_url("/slow")))
+        while not self.tracker.active:
+            await asyncio.sleep(0.01)
+        self.assertFalse(await drain(self.http_server, self.tracker, timeout=0.05))
+        with self.assertRaises(tornado.httpclient.HTTPClientError):
+            await response
+
+
+def test_supervisor_restarts_crashed_workers_and_stops_on_sigterm():
+    with tempfile.TemporaryDirectory() as state:
+        def worker(index):
+            open(os.path.join(state, str(os.getpid())), "w").close()
+            crashed = os.path.join(state, "crashed")
+            if index == 0 and not os.path.exists(crashed):
+                open(crashed, "w").close()
+                os._exit(3)
+            signal.pause()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Supervisor(2, worker, drain_timeout=1).run()
+            finally:
+                os._exit(0)
+        try:
+            deadline = time.monotonic() + 10
+            # Two workers, plus the one that replaced the crashed worker
+            while len(os.listdir(state)) < 4 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            workers = [int(name) for name in os.listdir(state) if name.isdigit()]
+            assert len(workers) == 3
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        for worker_pid in workers:
+            try:
+                os.kill(worker_pid, 0)
+            except ProcessLookupError:
+                continue
+            raise AssertionError(f"worker {worker_pid} is still running")
+
+
+def test_jobs_are_visible_and_cancellable_from_another_process():
+    release = threading.Event()
+
+    def operation(job):
+        job.start_phase("waiting")
+        while not release.wait(0.01):
+            job.publish(force=True)
+            job.check()
+
+    with tempfile.TemporaryDirectory() as state:
+        # Two managers sharing a directory stand in for two workers
+        owner, other = JobManager(state), JobManager(state)
+        job = owner.submit("test", operation, (), "source")
+        stored = other.get(job.id)
+        assert stored is not None
+        assert [status["id"] for status in other.list()] == [job.id]
+        stored.cancel()
+        job.future.result(timeout=5)
+        assert job.state == "cancelled"
+        assert stored.status()["state"] == "cancelled"
+        assert stored.done
+        assert other.get("0123456789abcdef") is None
@@ -0,0 +1,238 @@
+import os
+import stat
+import time
+import zlib
+import struct
+import tarfile
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+FORMATS = {
+    "zip": ("application/zip", ".zip"),
+    "tar": ("application/x-tar", ".tar"),
+    "tgz": ("application/gzip", ".tar.gz"),
+}
+# Deflating these again only costs CPU; their entries are stored as they are
+COMPRESSED_EXTENSIONS = frozenset((
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".rar", ".jar", ".whl",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".mov", ".webm", ".avi",
+    ".pdf", ".docx", ".xlsx", ".pptx",
+))
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_FLAGS = 0x0800  # file names are UTF-8
+_ZIP_DESCRIPTOR = 0x0008  # CRC and sizes follow the data
+_MADE_BY_UNIX = 3 << 8
+
+
+def iter_tree(root: str):
+    """Yield ``(path, name, st)`` for everything under ``root``, depth first and sorted, without following symlinks.
+
+    ``name`` is relative to the parent of ``root``, so archives unpack into a
+    directory named like the one downloaded.
+    """
+    base = os.path.dirname(root)
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        yield path, os.path.relpath(path, base), st
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                with os.scandir(path) as it:
+                    names = sorted(entry.name for entry in it)
+            except OSError:
+                continue
+            pending.extend(os.path.join(path, name) for name in reversed(names))
+
+
+def _dos_time(mtime: float) -> tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))
+    if t.tm_year < 1980:
+        t = time.localtime(315532800 + 86400)
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+class ZipWriter:
+    """Produces a ZIP archive incrementally, entry by entry.
+
+    Each method returns the archive bytes that follow, so nothing is ever
+    buffered beyond one chunk. CRCs and compressed sizes go in a data
+    descriptor after each file. Entries, offsets and sizes that do not fit in
+    32 bits use ZIP64 records.
+    """
+
+    def __init__(self, store: bool = False, level: int = 6):
+        self.store = store
+        self.level = level
+        self.offset = 0
+        # The central directory needs one small record per entry; everything else is streamed
+        self.entries = []
+        self.current = None
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def _local_header(self, name: bytes, mtime: float, method: int, flags: int, zip64: bool,
+                      crc: int = 0, size: int = 0) -> bytes:
+        dos_time, dos_date = _dos_time(mtime)
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            csize = usize = _ZIP64_LIMIT
+        else:
+            csize = usize = size
+        return struct.pack("<IHHHHHIIIHH", 0x04034B50, 45 if zip64 else 20, flags, method, dos_time, dos_date,
+                           crc, csize, usize, len(name), len(extra)) + name + extra
+
+    def _add_complete(self, name: str, st: os.stat_result, data: bytes, mode: int) -> bytes:
+        encoded = name.encode("utf-8", "surrogateescape")
+        crc = zlib.crc32(data)
+        self.entries.append((encoded, st.st_mtime, 0, _ZIP_FLAGS, crc, len(data), len(data), self.offset, mode))
+        return self._emit(self._local_header(encoded, st.st_mtime, 0, _ZIP_FLAGS, False, crc, len(data)) + data)
+
+    def add_directory(self, name: str, st: os.stat_result) -> bytes:
+        return self._add_complete(name.rstrip("/") + "/", st, b"", st.st_mode)
+
+    def add_symlink(self, name: str, st: os.stat_result, target: str) -> bytes:
+        # Stored the way Info-ZIP does: the link target is the entry's data
+        return self._add_complete(name, st, target.encode("utf-8", "surrogateescape"), st.st_mode)
+
+    def begin_file(self, name: str, st: os.stat_result) -> bytes:
+        encoded = name.encode("utf-8", "surrogateescape")
+        store = self.store or os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+        # Deflate can grow incompressible data slightly, so leave room below the 32-bit limit
+        zip64 = st.st_size >= _ZIP64_LIMIT - (0 if store else st.st_size // 1000 + 1024)
+        flags = _ZIP_FLAGS | _ZIP_DESCRIPTOR
+        method = 0 if store else 8
+        self.current = {"name": encoded, "mtime": st.st_mtime, "method": method, "flags": flags, "crc": 0,
+                        "csize": 0, "usize": 0, "offset": self.offset, "mode": st.st_mode, "zip64": zip64,
+                        "compressor": None if store else zlib.compressobj(self.level, zlib.DEFLATED, -15)}
+        return self._emit(self._local_header(encoded, st.st_mtime, method, flags, zip64))
+
+    def write(self, data: bytes) -> bytes:
+        entry = self.current
+        entry["crc"] = zlib.crc32(data, entry["crc"])
+        entry["usize"] += len(data)
+        if entry["compressor"] is not None:
+            data = entry["compressor"].compress(data)
+        entry["csize"] += len(data)
+        return self._emit(data)
+
+    def end_file(self) -> bytes:
+        entry, self.current = self.current, None
+        compressor = entry.pop("compressor")
+        tail = compressor.flush() if compressor is not None else b""
+        entry["csize"] += len(tail)
+        if entry.pop("zip64"):
+            descriptor = struct.pack("<IIQQ", 0x08074B50, entry["crc"], entry["csize"], entry["usize"])
+        else:
+            descriptor = struct.pack("<IIII", 0x08074B50, entry["crc"], entry["csize"], entry["usize"])
+        self.entries.append((entry["name"], entry["mtime"], entry["method"], entry["flags"], entry["crc"],
+                             entry["csize"], entry["usize"], entry["offset"], entry["mode"]))
+        return self._emit(tail + descriptor)
+
+    def close(self):
+        """Yield the central directory and end records, in pieces of about ``DEFAULT_CHUNK_SIZE``."""
+        start = self.offset
+        piece = []
+        piece_size = 0
+        for name, mtime, method, flags, crc, csize, usize, offset, mode in self.entries:
+            dos_time, dos_date = _dos_time(mtime)
+            zip64_fields = [value for value in (usize, csize, offset) if value >= _ZIP64_LIMIT]
+            extra = b""
+            if zip64_fields:
+                extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            record = struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014B50, _MADE_BY_UNIX | version, version, flags, method,
+                dos_time, dos_date, crc, min(csize, _ZIP64_LIMIT), min(usize, _ZIP64_LIMIT), len(name),
+                len(extra), 0, 0, 0, (mode & 0xFFFF) << 16 | (0x10 if stat.S_ISDIR(mode) else 0),
+                min(offset, _ZIP64_LIMIT)) + name + extra
+            piece.append(record)
+            piece_size += len(record)
+            if piece_size >= DEFAULT_CHUNK_SIZE:
+                yield self._emit(b"".join(piece))
+                piece, piece_size = [], 0
+        end = self.offset + piece_size
+        size = end - start
+        count = len(self.entries)
+        if count >= 0xFFFF or start >= _ZIP64_LIMIT or size >= _ZIP64_LIMIT:
+            piece.append(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, _MADE_BY_UNIX | 45, 45, 0, 0, count, count,
+                                     size, start))
+            piece.append(struct.pack("<IIQI", 0x07064B50, 0, end, 1))
+        piece.append(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(size, _ZIP64_LIMIT), min(start, _ZIP64_LIMIT), 0))
+        yield self._emit(b"".join(piece))
+
+
+class TarWriter:
+    """Produces a POSIX (pax) tar archive incrementally, optionally gzip-compressed.
+
+    Sizes are taken from the stat result when an entry starts; a file that
+    shrinks while it is read is padded with zeros and one that grows is cut
+    off, so the archive stays well-formed.
+    """
+
+    def __init__(self, gzip: bool = False, level: int = 6):
+        # wbits 16 + 15 produces a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + 15) if gzip else None
+        self.remaining = 0
+        self.size = 0
+
+    def _emit(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) if self.compressor is not None else data
+
+    def _header(self, name: str, st: os.stat_result, kind: bytes, size: int = 0, linkname: str = "") -> bytes:
+        info = tarfile.TarInfo(name)
+        info.type = kind
+        info.size = size
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        info.linkname = linkname
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def add_directory(self, name: str, st: os.stat_result) -> bytes:
+        return self._emit(self._header(name, st, tarfile.DIRTYPE))
+
+    def add_symlink(self, name: str, st: os.stat_result, target: str) -> bytes:
+        return self._emit(self._header(name, st, tarfile.SYMTYPE, linkname=target))
+
+    def begin_file(self, name: str, st: os.stat_result) -> bytes:
+        self.remaining = self.size = st.st_size
+        return self._emit(self._header(name, st, tarfile.REGTYPE, st.st_size))
+
+    def write(self, data: bytes) -> bytes:
+        data = data[:self.remaining]
+        self.remaining -= len(data)
+        return self._emit(data)
+
+    def end_file(self) -> bytes:
+        padding = self.remaining + (-self.size % tarfile.BLOCKSIZE)
+        self.remaining = 0
+        return self._emit(b"\0" * padding)
+
+    def close(self):
+        data = self._emit(b"\0" * (2 * tarfile.BLOCKSIZE))
+        if self.compressor is not None:
+            data += self.compressor.flush()
+        yield data
+
+
+def make_writer(kind: str, store: bool = False):
+    if kind == "zip":
+        return ZipWriter(store=store)
+    return TarWriter(gzip=kind == "tgz", level=0 if store else 6)
+
+
+def read_entry(writer, fd: int, offset: int, size: int) -> bytes:
+    # Runs in an executor thread: reading and compressing both stay off the IOLoop
+    data = os.pread(fd, size, offset)
+    if len(data) < size:
+        # Truncated since it was listed; keep the size already announced in the header
+        data += bytes(size - len(data))
+    return writer.write(data)
@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import time
+import hashlib
+import secrets
+import tempfile
+import contextlib
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Sessions untouched for this long are treated as abandoned
+SESSION_TTL = 24 * 60 * 60
+# How long a finalized session is remembered, so a retried finalize gets the same answer
+COMPLETED_TTL = 60 * 60
+
+SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def default_state_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), "filey-uploads")
+
+
+class UploadSessionError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadSession:
+    """A resumable upload assembled in place.
+
+    The data file is preallocated next to the final path and every chunk is
+    written straight to its offset, so finalizing is a single rename. Session
+    metadata and the list of stored chunks live in ``state_dir`` as plain files,
+    which keeps sessions valid across restarts and between worker processes.
+    """
+
+    def __init__(self, state_dir: str, session_id: str, meta: dict):
+        self.state_dir = state_dir
+        self.id = session_id
+        self.path = meta["path"]
+        self.temp_path = meta["temp_path"]
+        self.size = meta["size"]
+        self.chunk_size = meta["chunk_size"]
+        self.created = meta["created"]
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.state_dir, self.id + ".json")
+
+    @property
+    def chunks_path(self) -> str:
+        return os.path.join(self.state_dir, self.id + ".chunks")
+
+    @property
+    def done_path(self) -> str:
+        return os.path.join(self.state_dir, self.id + ".done")
+
+    @property
+    def chunk_count(self) -> int:
+        return max((self.size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    @classmethod
+    def create(cls, state_dir: str, path: str, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> "UploadSession":
+        if size < 0:
+            raise UploadSessionError(400, "Invalid size")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadSessionError(400, f"chunk_size must be between 1 and {MAX_CHUNK_SIZE}")
+        os.makedirs(state_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        session_id = secrets.token_hex(16)
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{session_id}.part")
+        with open(temp_path, "wb") as f:
+            # Sparse preallocation; chunks fill it in at their offsets
+            f.truncate(size)
+        meta = {"path": path, "temp_path": temp_path, "size": size, "chunk_size": chunk_size, "created": time.time()}
+        session = cls(state_dir, session_id, meta)
+        with open(session.meta_path, "w") as f:
+            json.dump(meta, f)
+        open(session.chunks_path, "ab").close()
+        return session
+
+    @classmethod
+    def load(cls, state_dir: str, session_id: str) -> "UploadSession":
+        if not SESSION_ID_RE.match(session_id):
+            raise UploadSessionError(404, "Unknown upload session")
+        try:
+            with open(os.path.join(state_dir, session_id + ".json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadSessionError(404, "Unknown upload session")
+        return cls(state_dir, session_id, meta)
+
+    @staticmethod
+    def completed(state_dir: str, session_id: str) -> dict | None:
+        """The record ``finalize`` left for ``session_id`` (path, size and sha256), or None."""
+        if not SESSION_ID_RE.match(session_id):
+            return None
+        try:
+            with open(os.path.join(state_dir, session_id + ".done")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def chunk_range(self, index: int) -> tuple[int, int]:
+        if not 0 <= index < self.chunk_count:
+            raise UploadSessionError(416, f"Chunk index out of range: {index}")
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size)
+
+    def open_chunk(self) -> int:
+        return os.open(self.temp_path, os.O_WRONLY)
+
+    def record_chunk(self, index: int) -> None:
+        # O_APPEND writes of a few bytes are atomic, so concurrent PUTs never interleave
+        fd = os.open(self.chunks_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, b"%d\n" % index)
+        finally:
+            os.close(fd)
+
+    def received(self) -> list[int]:
+        try:
+            with open(self.chunks_path, "rb") as f:
+                return sorted({int(line) for line in f if line.strip()})
+        except OSError:
+            return []
+
+    def status(self) -> dict:
+        received = self.received()
+        received_bytes = sum(end - start for start, end in map(self.chunk_range, received))
+        return {
+            "id": self.id,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunk_count,
+            "received": received,
+            "received_bytes": received_bytes,
+        }
+
+    def finalize(self, sha256: str | None = None) -> None:
+        missing = set(range(self.chunk_count)) - set(self.received())
+        if self.size and missing:
+            raise UploadSessionError(409, f"{len(missing)} chunks missing")
+        if sha256:
+            digest = hashlib.sha256()
+            with open(self.temp_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != sha256.lower():
+                raise UploadSessionError(422, "Checksum mismatch")
+        os.replace(self.temp_path, self.path)
+        record = {"path": self.path, "size": self.size, "sha256": sha256.lower() if sha256 else None}
+        temp = self.done_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(record, f)
+        os.replace(temp, self.done_path)
+        self.discard(keep_data=True)
+
+    def discard(self, keep_data: bool = False) -> None:
+        paths = [self.meta_path, self.chunks_path]
+        if not keep_data:
+            paths.append(self.temp_path)
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+def expire_sessions(state_dir: str, ttl: float = SESSION_TTL) -> None:
+    try:
+        names = os.listdir(state_dir)
+    except OSError:
+        return
+    now = time.time()
+    cutoff = now - ttl
+    for name in names:
+        if name.endswith(".done"):
+            path = os.path.join(state_dir, name)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(path) < now - COMPLETED_TTL:
+                    os.remove(path)
+            continue
+        if not name.endswith(".json"):
+            continue
+        session_id = name[:-5]
+        try:
+            session = UploadSession.load(state_dir, session_id)
+            last_used = max(os.path.getmtime(session.chunks_path), session.created)
+        except (UploadSessionError, OSError):
+            continue
+        if last_used < cutoff:
+            session.discard()
@@ -0,0 +1,318 @@
+import io
+import os
+import bz2
+import lzma
+import zlib
+import bisect
+import threading
+from collections import OrderedDict
+
+# File name endings and leading bytes of the formats read transparently; both must match
+_FORMATS = {
+    "gzip": ((".gz", ".tgz"), b"\x1f\x8b"),
+    "bzip2": ((".bz2", ".tbz2"), b"BZh"),
+    "xz": ((".xz", ".txz"), b"\xfd7zXZ\x00"),
+}
+READ_SIZE = 256 * 1024
+# Uncompressed distance between saved decompressor states; doubled whenever there would be too many
+CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+# Each gzip checkpoint holds a copy of the inflate state (about 40KiB)
+MAX_CHECKPOINTS = 128
+# The end of the data is kept in memory, so tail views and stream history never inflate anything
+TAIL_SIZE = 1024 * 1024
+# Recently read output a reader keeps, so short backward seeks don't restart from a checkpoint
+RECENT_SIZE = 2 * 1024 * 1024
+MAX_CACHED_INDEXES = 8
+
+
+def _named_format(path: str) -> str | None:
+    name = path.lower()
+    for fmt, (suffixes, magic) in _FORMATS.items():
+        if name.endswith(suffixes):
+            return fmt
+    return None
+
+
+def compression_format(path: str, head: bytes | None = None) -> str | None:
+    """The compression format of ``path`` ("gzip", "bzip2" or "xz"), or None for anything else."""
+    fmt = _named_format(path)
+    if fmt is None:
+        return None
+    if head is None:
+        try:
+            with open(path, "rb") as f:
+                head = f.read(8)
+        except OSError:
+            return None
+    return fmt if head.startswith(_FORMATS[fmt][1]) else None
+
+
+def _decompressor(fmt: str):
+    if fmt == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if fmt == "bzip2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+
+class _Stream:
+    """Incremental decompression of ``f`` from a known state, member after member.
+
+    ``in_pos`` is the file offset of the first input byte the decompressor has
+    not been given yet and ``out_pos`` the uncompressed offset of the next
+    output byte. gzip, bzip2 and xz all allow several compressed members
+    back to back (``cat a.gz b.gz``, pbzip2); a member that does not start
+    with the format's magic bytes ends the data, like trailing padding does.
+    """
+
+    def __init__(self, f, fmt: str, in_pos: int = 0, out_pos: int = 0, decompressor=None):
+        self.f = f
+        self.format = fmt
+        self.in_pos = in_pos
+        self.out_pos = out_pos
+        self.decompressor = decompressor or _decompressor(fmt)
+        self.pending = b""
+        # The last call stopped at its output limit, so the decompressor may hold more output
+        self.full = decompressor is not None
+        self.member_start = (in_pos, out_pos) if decompressor is None else None
+        self.finished = False
+        f.seek(in_pos)
+
+    def _input(self) -> bytes:
+        data = self.f.read(READ_SIZE)
+        self.in_pos += len(data)
+        return data
+
+    def read(self, size: int) -> bytes:
+        """Up to ``size`` bytes of output; empty only at the end of the data."""
+        while not self.finished:
+            d = self.decompressor
+            if d.eof:
+                # zlib also leaves the input past the end in unconsumed_tail; unused_data has all of it
+                if not self._next_member(d.unused_data):
+                    self.finished = True
+                    break
+                continue
+            if self.pending:
+                data, self.pending = self.pending, b""
+            elif self.full or (self.format != "gzip" and not d.needs_input):
+                data = b""
+            else:
+                data = self._input()
+                if not data:
+                    # Truncated (or still being written); what was decompressed so far is all there is
+                    self.finished = True
+                    break
+            out = d.decompress(data, size)
+            if self.format == "gzip":
+                self.pending = d.unconsumed_tail
+            self.full = len(out) == size
+            if out:
+                self.out_pos += len(out)
+                return out
+        return b""
+
+    def _next_member(self, rest: bytes) -> bool:
+        magic = _FORMATS[self.format][1]
+        while len(rest) < len(magic):
+            data = self._input()
+            if not data:
+                break
+            rest += data
+        if not rest.startswith(magic):
+            return False
+        self.member_start = (self.in_pos - len(rest), self.out_pos)
+        self.decompressor = _decompressor(self.format)
+        self.pending = rest
+        self.full = False
+        return True
+
+    def checkpoint(self) -> tuple:
+        """``(out_pos, in_pos, decompressor)`` to resume from later; gzip only, other decompressors can't be copied."""
+        return self.out_pos, self.in_pos - len(self.pending), self.decompressor.copy()
+
+
+class CompressedIndex:
+    """Uncompressed size, checkpoints and tail of one compressed file.
+
+    Built with one streaming pass over the file. ``checkpoints`` are
+    ``(out_pos, in_pos, decompressor)`` tuples, sorted by ``out_pos``, to
+    resume decompressing from; ``decompressor`` is None at the start of a
+    member, where a fresh one will do. For gzip a copy of the inflate state is
+    also saved every ``interval`` bytes of output; bzip2 and xz decompressors
+    can't be copied, so within one member they always start from its
+    beginning. The index is rebuilt when the file changes.
+    """
+
+    def __init__(self, path: str, fmt: str):
+        self.path = path
+        self.format = fmt
+        self.lock = threading.Lock()
+        self.identity = None
+        self.size = 0
+        self.checkpoints = []
+        self.positions = []
+        self.tail = b""
+        self.tail_start = 0
+
+    def refresh(self) -> None:
+        with self.lock, open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            if identity != self.identity:
+                self._build(f)
+                self.identity = identity
+
+    def _build(self, f) -> None:
+        stream = _Stream(f, self.format)
+        checkpoints = [(0, 0, None)]
+        interval = CHECKPOINT_INTERVAL
+        next_mark = interval
+        member = stream.member_start
+        tail = bytearray()
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            tail += data
+            if len(tail) > 2 * TAIL_SIZE:
+                del tail[:-TAIL_SIZE]
+            if stream.member_start is not member:
+                member = stream.member_start
+                if member[1] >= next_mark:
+                    checkpoints.append((member[1], member[0], None))
+                    next_mark = member[1] + interval
+            if self.format == "gzip" and stream.out_pos >= next_mark:
+                checkpoints.append(stream.checkpoint())
+                next_mark = stream.out_pos + interval
+            if len(checkpoints) > MAX_CHECKPOINTS:
+                checkpoints = checkpoints[::2]
+                interval *= 2
+        self.size = stream.out_pos
+        self.checkpoints = checkpoints
+        self.positions = [checkpoint[0] for checkpoint in checkpoints]
+        self.tail = bytes(tail[-TAIL_SIZE:])
+        self.tail_start = self.size - len(self.tail)
+
+    def checkpoint_before(self, offset: int) -> tuple:
+        return self.checkpoints[bisect.bisect_right(self.positions, offset) - 1]
+
+
+class _CompressedRaw(io.RawIOBase):
+    """Seekable, read-only view of a compressed file's uncompressed data."""
+
+    def __init__(self, index: CompressedIndex):
+        self.index = index
+        self.file = open(index.path, "rb")
+        self.pos = 0
+        self.stream = None
+        self.recent = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.index.size
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self.pos = pos
+        return pos
+
+    def readinto(self, buffer) -> int:
+        index = self.index
+        pos = self.pos
+        if pos >= index.size:
+            return 0
+        if pos >= index.tail_start:
+            data = index.tail[pos - index.tail_start:pos - index.tail_start + len(buffer)]
+        else:
+            data = self._read_at(pos, len(buffer))
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        stream = self.stream
+        recent_start = stream.out_pos - len(self.recent) if stream is not None else 0
+        if stream is not None and recent_start <= pos < stream.out_pos:
+            return bytes(self.recent[pos - recent_start:pos - recent_start + size])
+        out_pos, in_pos, decompressor = self.index.checkpoint_before(pos)
+        # Carry on from where we are unless a checkpoint is closer
+        if stream is None or not out_pos <= stream.out_pos <= pos:
+            decompressor = decompressor.copy() if decompressor is not None else None
+            stream = self.stream = _Stream(self.file, self.index.format, in_pos, out_pos, decompressor)
+            self.recent = bytearray()
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                return b""
+            self.recent += data
+            if len(self.recent) > RECENT_SIZE:
+                del self.recent[:-RECENT_SIZE]
+            if stream.out_pos > pos:
+                start = pos - (stream.out_pos - len(data))
+                return data[start:start + size]
+
+    def close(self) -> None:
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+_indexes: "OrderedDict[str, CompressedIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_compressed_index(path: str, fmt: str | None = None) -> CompressedIndex:
+    """The up to date index of ``path``; the first call (and the first after a change) decompresses it once."""
+    fmt = fmt or compression_format(path)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None or index.format != fmt:
+            index = _indexes[path] = CompressedIndex(path, fmt)
+        _indexes.move_to_end(path)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    index.refresh()
+    return index
+
+
+def needs_indexing(path: str) -> bool:
+    """True if reading ``path`` may first have to decompress all of it; decided from its name, without any I/O."""
+    if _named_format(path) is None:
+        return False
+    with _indexes_lock:
+        index = _indexes.get(path)
+        return index is None or index.identity is None
+
+
+def open_uncompressed(path: str):
+    """Open ``path`` for reading its content, decompressed if it is compressed.
+
+    Returns ``(file, size)``: a seekable binary file and the size of what it
+    reads, which for a compressed file is the uncompressed size.
+    """
+    f = open(path, "rb")
+    try:
+        fmt = compression_format(path, f.read(8))
+        if fmt is None:
+            f.seek(0)
+            return f, os.fstat(f.fileno()).st_size
+    except BaseException:
+        f.close()
+        raise
+    f.close()
+    index = get_compressed_index(path, fmt)
+    return io.BufferedReader(_CompressedRaw(index), READ_SIZE), index.size
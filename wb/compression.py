@@ -0,0 +1,298 @@
+import os
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+import mimetypes
+
+import tornado.web
+
+from .archive import COMPRESSED_EXTENSIONS
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+# Responses shorter than this are not worth the Content-Encoding overhead
+MIN_LENGTH = 1024
+# Files smaller than this are compressed per request rather than cached
+DEFAULT_CACHE_MIN_SIZE = 64 * 1024
+DEFAULT_CACHE_SIZE = 1024 ** 3
+# The cache directory is rescanned when what was added since the last scan could put it over its size,
+# and at least this often, since other worker processes add entries too
+CACHE_TRIM_INTERVAL = 60
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/x-sh",
+    "application/sql",
+    "image/svg+xml",
+}
+# Common text files mimetypes does not know about
+TEXT_EXTENSIONS = {".log", ".out", ".err", ".jsonl", ".ndjson", ".tsv", ".yaml", ".yml", ".toml", ".ini", ".conf"}
+
+
+def available_encodings() -> list[str]:
+    """The supported encodings in order of preference; gzip is always available."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """Pick the encoding to use for an ``Accept-Encoding`` header, or None for identity."""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    best = None
+    for encoding in available_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        # Equal weights fall back to the server's preference order
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def compressible_type(content_type: str) -> bool:
+    content_type = content_type.split(";")[0].strip().lower()
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def compressible_file(filename: str) -> bool:
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return False
+    if extension in TEXT_EXTENSIONS:
+        return True
+    content_type, encoding = mimetypes.guess_type(filename)
+    return encoding is None and content_type is not None and compressible_type(content_type)
+
+
+class Compressor:
+    """One streaming compressor with a common interface over zlib, brotli and zstandard.
+
+    ``compress`` may buffer; ``flush`` returns everything compressed so far so
+    a streamed response is not delayed; ``finish`` ends the stream.
+    """
+
+    def __init__(self, encoding: str, level: int | None = None):
+        self.encoding = encoding
+        level = DEFAULT_LEVELS[encoding] if level is None else level
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + 15)
+        elif encoding == "br":
+            self.compressor = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding {encoding!r}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "gzip":
+            return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "zstd":
+            return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """Compresses text responses with the best encoding the client accepts.
+
+    Like tornado's GZipContentEncoding, but negotiates zstd and brotli too
+    when they are installed and takes its levels from the settings. Handlers
+    that encode their own response (downloads) set Content-Encoding, which
+    is left alone.
+    """
+
+    def __init__(self, request, levels: dict | None = None):
+        self.encoding = None if request.method == "HEAD" else negotiate(request.headers.get("Accept-Encoding", ""))
+        self.levels = levels or {}
+        self.compressor = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if status_code != 200 or not compressible_type(headers.get("Content-Type", "")):
+            return status_code, headers, chunk
+        headers["Vary"] = headers["Vary"] + ", Accept-Encoding" if "Vary" in headers else "Accept-Encoding"
+        if self.encoding is None or "Content-Encoding" in headers or (finishing and len(chunk) < MIN_LENGTH):
+            return status_code, headers, chunk
+        headers["Content-Encoding"] = self.encoding
+        self.compressor = Compressor(self.encoding, self.levels.get(self.encoding))
+        chunk = self.transform_chunk(chunk, finishing)
+        if "Content-Length" in headers:
+            if finishing:
+                headers["Content-Length"] = str(len(chunk))
+            else:
+                del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self.compressor is None:
+            return chunk
+        data = self.compressor.compress(chunk)
+        return data + (self.compressor.finish() if finishing else self.compressor.flush())
+
+
+class PrecompressedCache:
+    """Compressed variants of downloaded files, kept on disk so hot files are compressed once.
+
+    Entries are keyed by path, inode, mtime, size, encoding and level, so a
+    changed file simply misses. The least recently used entries are removed
+    once the cache exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE, min_size: int = DEFAULT_CACHE_MIN_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.min_size = min_size
+        self.lock = threading.Lock()
+        # Size as of the last scan plus what this process added since; None before the first scan
+        self.size = None
+        self.trimmed = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, path: str, st: os.stat_result, encoding: str, level: int | None) -> str:
+        key = f"{path}\0{st.st_ino}\0{st.st_mtime_ns}\0{st.st_size}\0{encoding}\0{level}"
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8", "surrogateescape")).hexdigest()
+                            + "." + encoding)
+
+    def open(self, path: str, st: os.stat_result, encoding: str, level: int | None) -> int | None:
+        """Return a descriptor for the cached variant, or None."""
+        cached = self.path(path, st, encoding, level)
+        try:
+            fd = os.open(cached, os.O_RDONLY)
+        except OSError:
+            return None
+        # The mtime orders entries for eviction
+        os.utime(cached)
+        return fd
+
+    def create(self, path: str, st: os.stat_result, encoding: str, level: int | None) -> "CacheWriter":
+        return CacheWriter(self, path, st, self.path(path, st, encoding, level))
+
+    def added(self, size: int) -> None:
+        """Account for a new entry of ``size`` bytes, trimming only when the cache may be over ``max_size``."""
+        with self.lock:
+            now = time.monotonic()
+            if self.size is not None:
+                self.size += size
+                if self.size <= self.max_size and now - self.trimmed < CACHE_TRIM_INTERVAL:
+                    return
+            # Other commits carry on counting while this one scans
+            self.size = self.size or 0
+            self.trimmed = now
+        self.trim()
+
+    def trim(self) -> None:
+        entries = []
+        total = 0
+        # Temporary files are still being written, or were left behind by a worker that died
+        stale = time.time() - CACHE_TRIM_INTERVAL
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if entry.name.startswith("."):
+                        if st.st_mtime < stale:
+                            self._remove(entry.path)
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        except OSError:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if self._remove(path):
+                total -= size
+        with self.lock:
+            self.size = total
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class CacheWriter:
+    """Collects one compressed variant in a temporary file; ``commit`` publishes it."""
+
+    def __init__(self, cache: PrecompressedCache, source: str, st: os.stat_result, target: str):
+        self.cache = cache
+        self.source = source
+        self.st = st
+        self.target = target
+        fd, self.temp = tempfile.mkstemp(dir=cache.directory, prefix=".", suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def commit(self) -> None:
+        size = self.file.tell()
+        self.file.close()
+        try:
+            st = os.stat(self.source)
+        except OSError:
+            st = None
+        if st is None or (st.st_mtime_ns, st.st_size) != (self.st.st_mtime_ns, self.st.st_size):
+            # Changed while it was being compressed; the variant may not match either version
+            self.abort()
+            return
+        try:
+            os.replace(self.temp, self.target)
+        except FileNotFoundError:
+            # Idle so long that a trim took it for a dead worker's leftover; just not cached this time
+            return
+        self.cache.added(size)
+
+    def abort(self) -> None:
+        self.file.close()
+        try:
+            os.remove(self.temp)
+        except OSError:
+            pass
@@ -0,0 +1,492 @@
+import os
+import sys
+import zlib
+import json
+import struct
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from array import array
+
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+# Literal data is sent in ops of at most this size, so neither side holds more of it at once
+MAX_LITERAL_SIZE = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+_ADLER_MOD = 65521
+# Rolling byte by byte runs in Python; after this many blocks without a match the encoder only checks
+# every block_size bytes, rolling through one block in every RESYNC_BLOCKS to find shifted data again
+ROLL_BLOCKS = 16
+RESYNC_BLOCKS = 32
+
+# Delta ops: copy `count` blocks of the old file starting at block `index`, or insert literal bytes
+_COPY = struct.Struct(">cQI")
+_LITERAL = struct.Struct(">cI")
+
+_HEADER = struct.Struct("<4sIIQqI")
+_MAGIC = b"FLSG"
+_VERSION = 1
+
+
+def default_cache_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), "filey-signatures")
+
+
+class DeltaError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def choose_block_size(size: int) -> int:
+    # About sqrt(size), as rsync does: small files get small blocks, big ones few signatures
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def check_block_size(block_size: int) -> int:
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise DeltaError(400, f"block_size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE}")
+    return block_size
+
+
+def strong_checksum(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+class Signature:
+    """Weak (Adler-32, which can be rolled) and strong (BLAKE2b) checksums of every block of a file.
+
+    ``size`` and ``mtime_ns`` identify the version of the file they describe;
+    the last block may be shorter than ``block_size``.
+    """
+
+    def __init__(self, block_size: int, size: int = 0, mtime_ns: int = 0, weak: array | None = None,
+                 strong: bytes = b""):
+        self.block_size = block_size
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.weak = weak if weak is not None else array("I")
+        self.strong = strong
+
+    def __len__(self) -> int:
+        return len(self.weak)
+
+    def block_strong(self, index: int) -> bytes:
+        return self.strong[index * STRONG_SIZE:(index + 1) * STRONG_SIZE]
+
+    def to_json(self) -> dict:
+        return {
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "block_size": self.block_size,
+            "weak": self.weak.tolist(),
+            "strong": [self.block_strong(i).hex() for i in range(len(self))],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Signature":
+        return cls(data["block_size"], data["size"], data["mtime_ns"], array("I", data["weak"]),
+                   b"".join(bytes.fromhex(digest) for digest in data["strong"]))
+
+
+class SignatureBuilder:
+    """Computes a Signature from data fed to it in pieces of any size."""
+
+    def __init__(self, block_size: int):
+        self.signature = Signature(block_size)
+        self.partial = bytearray()
+        self.strong = []
+
+    def feed(self, data) -> None:
+        block_size = self.signature.block_size
+        self.signature.size += len(data)
+        view = memoryview(data)
+        if self.partial:
+            take = block_size - len(self.partial)
+            self.partial += view[:take]
+            view = view[take:]
+            if len(self.partial) < block_size:
+                return
+            self._add(self.partial)
+            self.partial = bytearray()
+        whole = len(view) - len(view) % block_size
+        for start in range(0, whole, block_size):
+            self._add(view[start:start + block_size])
+        self.partial += view[whole:]
+
+    def _add(self, block) -> None:
+        self.signature.weak.append(zlib.adler32(block))
+        self.strong.append(strong_checksum(block))
+
+    def finish(self, mtime_ns: int) -> Signature:
+        if self.partial:
+            self._add(self.partial)
+            self.partial = bytearray()
+        self.signature.strong = b"".join(self.strong)
+        self.signature.mtime_ns = mtime_ns
+        return self.signature
+
+
+def _cache_path(cache_dir: str, path: str, block_size: int) -> str:
+    key = hashlib.sha256(f"{path}\0{block_size}".encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(cache_dir, key + ".sig")
+
+
+def load_cached_signature(cache_dir: str, path: str, block_size: int, st: os.stat_result) -> Signature | None:
+    try:
+        with open(_cache_path(cache_dir, path, block_size), "rb") as f:
+            data = f.read()
+        magic, version, cached_block_size, size, mtime_ns, count = _HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+    if (magic, version, cached_block_size, size, mtime_ns) != (_MAGIC, _VERSION, block_size, st.st_size,
+                                                                st.st_mtime_ns):
+        return None
+    weak = array("I")
+    weak.frombytes(data[_HEADER.size:_HEADER.size + 4 * count])
+    strong = data[_HEADER.size + 4 * count:]
+    if len(weak) != count or len(strong) != count * STRONG_SIZE:
+        return None
+    return Signature(block_size, size, mtime_ns, weak, strong)
+
+
+def save_signature(cache_dir: str, path: str, signature: Signature) -> None:
+    temp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, signature.block_size, signature.size, signature.mtime_ns,
+                                 len(signature)))
+            signature.weak.tofile(f)
+            f.write(signature.strong)
+        os.replace(temp_path, _cache_path(cache_dir, path, signature.block_size))
+    except OSError:
+        # Only a cache; the signature is recomputed next time
+        if temp_path:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+
+
+def get_signature(path: str, block_size: int | None = None, cache_dir: str | None = None) -> Signature:
+    """The signature of ``path``, from the cache if the file's size and mtime are unchanged."""
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        block_size = check_block_size(block_size) if block_size else choose_block_size(st.st_size)
+        if cache_dir:
+            signature = load_cached_signature(cache_dir, path, block_size, st)
+            if signature is not None:
+                return signature
+        builder = SignatureBuilder(block_size)
+        for data in iter(lambda: f.read(READ_SIZE - READ_SIZE % block_size), b""):
+            builder.feed(data)
+        signature = builder.finish(st.st_mtime_ns)
+    if cache_dir:
+        save_signature(cache_dir, path, signature)
+    return signature
+
+
+class DeltaApplier:
+    """Rebuilds a file from its old version and a stream of delta ops.
+
+    The new version is written to a hidden temp file next to ``path`` and
+    swapped in with a rename by ``finish``, after its size and (optionally)
+    SHA-256 are checked. ``base`` is the ``(size, mtime_ns)`` the client's
+    delta was computed against, or None for a new file; if the file has
+    changed since, the upload is refused. With ``size``, the declared size
+    of the new version, a delta that would rebuild more is refused as soon
+    as it gets there, since a few copy ops can otherwise produce any amount
+    of data. The new version's signature is computed on the way and cached,
+    so the next sync needs no extra read.
+    """
+
+    def __init__(self, path: str, block_size: int, base: tuple[int, int] | None, cache_dir: str | None = None,
+                 size: int | None = None):
+        if size is not None and size < 0:
+            raise DeltaError(400, "Invalid size")
+        self.path = path
+        self.block_size = check_block_size(block_size)
+        self.expected_size = size
+        self.cache_dir = cache_dir
+        self.base_fd = None
+        self.base_size = 0
+        self.mode = None
+        if base is not None:
+            try:
+                self.base_fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                raise DeltaError(412, "File no longer exists")
+            st = os.fstat(self.base_fd)
+            if (st.st_size, st.st_mtime_ns) != tuple(base):
+                os.close(self.base_fd)
+                self.base_fd = None
+                raise DeltaError(412, "File changed since its signature was taken")
+            self.base_size = st.st_size
+            self.mode = st.st_mode & 0o7777
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".",
+                                              suffix=".delta")
+        self.file = os.fdopen(fd, "wb")
+        self.buffer = bytearray()
+        self.literal_left = 0
+        self.digest = hashlib.sha256()
+        self.signature = SignatureBuilder(self.block_size)
+        self.size = 0
+        self.copied = 0
+        self.literal = 0
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+        while self.buffer:
+            if self.literal_left:
+                piece = bytes(self.buffer[:self.literal_left])
+                del self.buffer[:len(piece)]
+                self.literal_left -= len(piece)
+                self.literal += len(piece)
+                self._write(piece)
+                continue
+            op = self.buffer[:1]
+            if op == b"C":
+                if len(self.buffer) < _COPY.size:
+                    return
+                _, index, count = _COPY.unpack_from(self.buffer)
+                del self.buffer[:_COPY.size]
+                self._copy(index, count)
+            elif op == b"L":
+                if len(self.buffer) < _LITERAL.size:
+                    return
+                _, self.literal_left = _LITERAL.unpack_from(self.buffer)
+                del self.buffer[:_LITERAL.size]
+                if self.literal_left > MAX_LITERAL_SIZE:
+                    raise DeltaError(400, f"Literal of {self.literal_left} bytes exceeds {MAX_LITERAL_SIZE}")
+            else:
+                raise DeltaError(400, f"Unknown delta op {bytes(op)!r}")
+
+    def _copy(self, index: int, count: int) -> None:
+        start = index * self.block_size
+        end = min((index + count) * self.block_size, self.base_size)
+        if self.base_fd is None or count == 0 or start >= end:
+            raise DeltaError(400, f"Blocks {index}-{index + count - 1} are not in the old file")
+        while start < end:
+            data = os.pread(self.base_fd, min(READ_SIZE, end - start), start)
+            if not data:
+                raise DeltaError(409, "File shrank while the delta was applied")
+            self._write(data)
+            self.copied += len(data)
+            start += len(data)
+
+    def _write(self, data: bytes) -> None:
+        if self.expected_size is not None and self.size + len(data) > self.expected_size:
+            raise DeltaError(422, f"Delta rebuilds more than the expected {self.expected_size} bytes")
+        self.file.write(data)
+        self.digest.update(data)
+        self.signature.feed(data)
+        self.size += len(data)
+
+    def finish(self, size: int | None = None, sha256: str | None = None) -> dict:
+        if self.buffer or self.literal_left:
+            raise DeltaError(400, "Delta ended in the middle of an op")
+        if size is not None and size != self.size:
+            raise DeltaError(422, f"Expected {size} bytes, rebuilt {self.size}")
+        if sha256 and self.digest.hexdigest() != sha256.lower():
+            raise DeltaError(422, "Checksum mismatch")
+        self.file.close()
+        if self.mode is not None:
+            os.chmod(self.temp_path, self.mode)
+        os.replace(self.temp_path, self.path)
+        self.temp_path = None
+        self._close_base()
+        if self.cache_dir:
+            save_signature(self.cache_dir, self.path, self.signature.finish(os.stat(self.path).st_mtime_ns))
+        return {"size": self.size, "copied_bytes": self.copied, "literal_bytes": self.literal}
+
+    def discard(self) -> None:
+        """Drop the temp file unless ``finish`` already moved it into place."""
+        self._close_base()
+        if not self.file.closed:
+            self.file.close()
+        if self.temp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(self.temp_path)
+
+    def _close_base(self) -> None:
+        if self.base_fd is not None:
+            os.close(self.base_fd)
+            self.base_fd = None
+
+
+def encode_delta(signature: Signature, f, stats: dict | None = None):
+    """Yield the delta ops that turn the file ``signature`` describes into the content of binary file ``f``.
+
+    Block-aligned matches are found at the speed of zlib and hashlib; after
+    a change the weak checksum is rolled a byte at a time until the data
+    lines up with an old block again, so the cost grows with how much of the
+    file changed, not with its size. Long runs of new data (appends, rewritten
+    regions) are only checked at block steps, with a rolling pass now and
+    then, which keeps them fast at the risk of sending some shifted old data
+    as literal bytes.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(copied_bytes=0, literal_bytes=0)
+    block_size = signature.block_size
+    blocks = {}
+    last = len(signature) - 1
+    last_size = signature.size - last * block_size if last >= 0 else 0
+    for index in range(len(signature)):
+        if index == last and last_size < block_size:
+            break
+        blocks.setdefault(signature.weak[index], {}).setdefault(signature.block_strong(index), index)
+    copy_start = copy_count = 0
+
+    def flush_copy():
+        nonlocal copy_count
+        if copy_count:
+            stats["copied_bytes"] += min(copy_count * block_size, signature.size - copy_start * block_size)
+            yield _COPY.pack(b"C", copy_start, copy_count)
+            copy_count = 0
+
+    def literal(data):
+        yield from flush_copy()
+        for start in range(0, len(data), MAX_LITERAL_SIZE):
+            piece = data[start:start + MAX_LITERAL_SIZE]
+            stats["literal_bytes"] += len(piece)
+            yield _LITERAL.pack(b"L", len(piece)) + piece
+
+    buf = b""
+    eof = False
+    pos = 0
+    # Where the pending literal data starts, and the rolled checksum of buf[pos:pos + block_size] if any
+    literal_start = 0
+    weak = None
+    # Bytes left to roll through before switching to block steps, and block steps taken since
+    roll_left = ROLL_BLOCKS * block_size
+    steps = 0
+    while True:
+        if len(buf) - pos < block_size and not eof:
+            # Keep the pending literal and the rolling window; the rest has been dealt with
+            buf, pos, literal_start = buf[literal_start:], pos - literal_start, 0
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf += data
+            continue
+        if len(buf) - pos < block_size:
+            break
+        if weak is None:
+            weak = zlib.adler32(buf[pos:pos + block_size])
+        candidates = blocks.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong_checksum(buf[pos:pos + block_size]))
+            if index is not None:
+                if literal_start < pos:
+                    yield from literal(buf[literal_start:pos])
+                if copy_count and copy_start + copy_count == index:
+                    copy_count += 1
+                else:
+                    yield from flush_copy()
+                    copy_start, copy_count = index, 1
+                pos += block_size
+                literal_start = pos
+                weak = None
+                roll_left = ROLL_BLOCKS * block_size
+                steps = 0
+                continue
+        if pos - literal_start >= MAX_LITERAL_SIZE:
+            yield from literal(buf[literal_start:pos])
+            literal_start = pos
+        if not roll_left:
+            pos += block_size
+            weak = None
+            steps += 1
+            if steps % RESYNC_BLOCKS == 0:
+                roll_left = block_size
+            continue
+        roll_left -= 1
+        # Slide the window one byte: drop buf[pos], take in buf[pos + block_size]
+        if pos + block_size < len(buf):
+            out, new = buf[pos], buf[pos + block_size]
+            a = ((weak & 0xffff) - out + new) % _ADLER_MOD
+            b = ((weak >> 16) - block_size * out + a - 1) % _ADLER_MOD
+            weak = (b << 16) | a
+        else:
+            weak = None
+        pos += 1
+    # What is left is shorter than a block; it may still be the old file's short last block
+    tail = buf[pos:]
+    if tail and last >= 0 and len(tail) == last_size and zlib.adler32(tail) == signature.weak[last] \
+            and strong_checksum(tail) == signature.block_strong(last):
+        if literal_start < pos:
+            yield from literal(buf[literal_start:pos])
+        if copy_count and copy_start + copy_count == last:
+            copy_count += 1
+        else:
+            yield from flush_copy()
+            copy_start, copy_count = last, 1
+        yield from flush_copy()
+    else:
+        yield from literal(buf[literal_start:])
+        yield from flush_copy()
+
+
+def push(base_url: str, token: str, local_path: str, remote_path: str, block_size: int | None = None) -> dict:
+    """Upload ``local_path`` to ``remote_path`` on a filey server, sending only what changed.
+
+    Returns the server's summary, including how many bytes were copied from
+    the old version and how many were sent.
+    """
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    opener.open(base_url.rstrip("/") + "/login", urllib.parse.urlencode({"token": token}).encode())
+    url = base_url.rstrip("/") + "/delta/" + urllib.parse.quote(remote_path.lstrip("/"))
+    query = {"block_size": block_size} if block_size else {}
+    try:
+        with opener.open(url + "?" + urllib.parse.urlencode(query)) as response:
+            signature = Signature.from_json(json.load(response))
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        signature = None
+    with open(local_path, "rb") as f:
+        digest = hashlib.sha256()
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(data)
+        size = f.tell()
+        f.seek(0)
+        query = {"size": size, "sha256": digest.hexdigest()}
+        if signature is None:
+            signature = Signature(block_size or choose_block_size(size))
+        else:
+            query.update(base_size=signature.size, base_mtime_ns=signature.mtime_ns)
+        query["block_size"] = signature.block_size
+        # An iterable body without a Content-Length is sent chunked, as it is produced
+        request = urllib.request.Request(url + "?" + urllib.parse.urlencode(query), data=encode_delta(signature, f),
+                                         headers={"Content-Type": "application/octet-stream"}, method="POST")
+        with opener.open(request) as response:
+            return json.load(response)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Upload a file to a filey server, sending only the changed blocks")
+    parser.add_argument("local_path")
+    parser.add_argument("url", help="server URL, e.g. http://localhost:8000")
+    parser.add_argument("remote_path", help="destination path under the served directory")
+    parser.add_argument("--token", default=os.environ.get("WB_ACCESS_TOKEN"), help="access token")
+    parser.add_argument("--block-size", type=int, default=None)
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("--token (or WB_ACCESS_TOKEN) is required")
+    result = push(args.url, args.token, args.local_path, args.remote_path, args.block_size)
+    json.dump(result, sys.stdout)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
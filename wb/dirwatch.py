@@ -0,0 +1,246 @@
+import os
+import stat
+import logging
+from collections import OrderedDict
+
+import tornado.ioloop
+import tornado.locks
+
+from .executors import executors, ExecutorBusy
+
+from .watch import (Inotify, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE,
+                    IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_DELAY = 0.25
+DEFAULT_POLL_INTERVAL = 2000
+# Without inotify, modifications are only detected by stat-ing every entry,
+# which is skipped for directories larger than this
+MAX_POLL_STAT_ENTRIES = 10000
+
+DIR_EVENTS = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+def describe(path: str, name: str) -> dict | None:
+    """Return the listing entry for ``name``, or None if it no longer exists."""
+    try:
+        st = os.stat(os.path.join(path, name))
+    except OSError:
+        return None
+    return {"name": name, "is_dir": stat.S_ISDIR(st.st_mode), "size": st.st_size, "mtime": st.st_mtime_ns / 1e9}
+
+
+def describe_changes(path: str, changes: list) -> list[dict]:
+    """The events for ``(name, kind)`` changes, stat-ing every name that should still exist."""
+    events = []
+    for name, kind in changes:
+        entry = describe(path, name) if kind != "deleted" else None
+        if entry is None:
+            events.append({"type": "deleted", "name": name})
+        elif isinstance(kind, tuple):
+            events.append({"type": "renamed", "from": kind[1], "entry": entry})
+        else:
+            events.append({"type": kind, "entry": entry})
+    return events
+
+
+class DirectoryWatcher:
+    """Watches one directory on behalf of any number of subscribers.
+
+    Changes are collected for ``delay`` seconds and coalesced per name (a file
+    that is created and written to is reported once, as created), then handed
+    to every subscriber's ``on_directory_events(events)`` as a list of
+    ``created``/``modified``/``deleted``/``renamed`` events. ``resync`` means
+    events were lost and the listing should be re-read; ``gone`` means the
+    directory itself was removed or moved. Listing and stat-ing the
+    directory runs on the ``metadata`` executor; batches are published back
+    on the IOLoop in the order they were collected.
+    """
+
+    def __init__(self, path: str, key, delay: float = DEFAULT_BATCH_DELAY,
+                 interval: int = DEFAULT_POLL_INTERVAL, backend: str = "auto"):
+        self.path = path
+        self.key = key
+        self.delay = delay
+        self.interval = interval
+        self.backend = backend
+        self.subscribers = set()
+        # name -> "created" | "modified" | "deleted" | ("renamed", old name)
+        self.changes = OrderedDict()
+        self.moves = {}
+        self.extra = []
+        self.timer = None
+        self.inotify = None
+        self.handle = None
+        self.periodic = None
+        self.snapshot = None
+        self.publish_lock = tornado.locks.Lock()
+        self.closed = False
+
+    async def start(self) -> None:
+        inotify = Inotify.get() if self.backend != "poll" else None
+        if inotify is not None:
+            try:
+                self.handle = inotify.add_watch(self.path, DIR_EVENTS, self._on_event)
+                self.inotify = inotify
+                return
+            except OSError as e:
+                logger.info("Cannot watch %s with inotify, polling instead: %s", self.path, e)
+        self.snapshot = await executors.run("metadata", self._scan)
+        if self.closed:
+            return
+        # Waits for each poll to finish before timing the next
+        self.periodic = tornado.ioloop.PeriodicCallback(self._poll, self.interval)
+        self.periodic.start()
+
+    def close(self) -> None:
+        self.closed = True
+        if self.inotify is not None and self.handle is not None:
+            self.inotify.remove_watch(self.handle)
+            self.handle = None
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+        if self.timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+
+    def _on_event(self, mask, name, cookie) -> None:
+        if mask & IN_Q_OVERFLOW:
+            self.changes.clear()
+            self.extra = [{"type": "resync"}]
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            if not any(event["type"] == "gone" for event in self.extra):
+                self.extra.append({"type": "gone"})
+        elif not name:
+            return
+        elif mask & IN_MOVED_FROM:
+            self.moves[cookie] = name
+            self.change(name, "deleted")
+        elif mask & IN_MOVED_TO and cookie in self.moves:
+            self.rename(self.moves.pop(cookie), name)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            self.change(name, "created")
+        elif mask & IN_DELETE:
+            self.change(name, "deleted")
+        else:
+            self.change(name, "modified")
+        self._schedule()
+
+    def change(self, name: str, kind: str) -> None:
+        previous = self.changes.pop(name, None)
+        if kind == "created" and previous == "deleted":
+            # Replaced (e.g. written to a temporary file and renamed over it)
+            kind = "modified"
+        elif kind == "modified" and previous is not None:
+            kind = previous
+        elif kind == "deleted" and previous == "created":
+            # Never reported, so nothing to take back
+            return
+        self.changes[name] = kind
+
+    def rename(self, old: str, new: str) -> None:
+        # The move already recorded `old` as deleted; undo that
+        previous = self.changes.pop(old, None)
+        if previous == "deleted":
+            self.changes.pop(new, None)
+            self.changes[new] = ("renamed", old)
+        else:
+            # Created within this batch: clients never saw the old name
+            self.change(new, "created")
+
+    def _schedule(self) -> None:
+        if self.timer is None:
+            self.timer = tornado.ioloop.IOLoop.current().call_later(self.delay, self.flush)
+
+    async def flush(self) -> None:
+        self.timer = None
+        self.moves.clear()
+        extra, changes = self.extra, list(self.changes.items())
+        self.extra = []
+        self.changes.clear()
+        if not extra and not changes:
+            return
+        # The lock is granted in order, so a later batch never overtakes one still being described
+        async with self.publish_lock:
+            events = extra
+            if changes:
+                events += await executors.run("metadata", describe_changes, self.path, changes)
+            if self.closed:
+                return
+            for subscriber in list(self.subscribers):
+                subscriber.on_directory_events(events)
+
+    def _scan(self) -> dict:
+        with os.scandir(self.path) as it:
+            entries = list(it)
+        snapshot = {}
+        stat_entries = len(entries) <= MAX_POLL_STAT_ENTRIES
+        for entry in entries:
+            try:
+                st = entry.stat() if stat_entries else None
+            except OSError:
+                st = None
+            snapshot[entry.name] = (st.st_size, st.st_mtime_ns) if st is not None else None
+        return snapshot
+
+    async def _poll(self) -> None:
+        try:
+            snapshot = await executors.run("metadata", self._scan)
+        except ExecutorBusy:
+            return
+        except OSError:
+            self.extra = [{"type": "gone"}]
+            if self.periodic is not None:
+                self.periodic.stop()
+            await self.flush()
+            return
+        if self.closed:
+            return
+        for name in self.snapshot.keys() - snapshot.keys():
+            self.change(name, "deleted")
+        for name, info in snapshot.items():
+            if name not in self.snapshot:
+                self.change(name, "created")
+            elif info != self.snapshot[name]:
+                self.change(name, "modified")
+        self.snapshot = snapshot
+        await self.flush()
+
+
+class DirectoryHub:
+    """One DirectoryWatcher per directory, shared by every subscriber and torn down with the last one."""
+
+    def __init__(self):
+        self.watchers = {}
+
+    async def subscribe(self, path: str, subscriber, **options) -> DirectoryWatcher:
+        st = await executors.run("metadata", os.stat, path)
+        key = (st.st_dev, st.st_ino, path)
+        watcher = self.watchers.get(key)
+        if watcher is None:
+            # Registered before it starts, so viewers arriving while it lists the directory share it
+            watcher = self.watchers[key] = DirectoryWatcher(path, key, **options)
+            watcher.subscribers.add(subscriber)
+            try:
+                await watcher.start()
+            except Exception:
+                watcher.subscribers.discard(subscriber)
+                if self.watchers.get(key) is watcher:
+                    del self.watchers[key]
+                watcher.close()
+                raise
+            return watcher
+        watcher.subscribers.add(subscriber)
+        return watcher
+
+    def unsubscribe(self, watcher: DirectoryWatcher, subscriber) -> None:
+        watcher.subscribers.discard(subscriber)
+        if not watcher.subscribers and self.watchers.get(watcher.key) is watcher:
+            del self.watchers[watcher.key]
+            watcher.close()
+
+
+directory_hub = DirectoryHub()
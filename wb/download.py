@@ -0,0 +1,289 @@
+import os
+import secrets
+import datetime
+import email.utils
+
+from tornado.iostream import StreamClosedError
+
+from .executors import executors
+from .compression import Compressor
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# More ranges than this in one request is almost always abuse; serve the whole file instead
+MAX_RANGES = 32
+
+
+def make_etag(st: os.stat_result, encoding: str | None = None) -> str:
+    # Each content encoding of a file is a different representation with its own tag
+    if encoding:
+        return '"%x-%x-%x-%s"' % (st.st_ino, st.st_size, st.st_mtime_ns, encoding)
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def response_encoding(handler, encoding: str | None) -> str | None:
+    # Range requests are answered from the uncompressed file; GET and HEAD otherwise describe the
+    # same representation, so they must agree on its encoding (and so its ETag)
+    return None if handler.request.headers.get("Range") else encoding
+
+
+def parse_range_header(value: str, size: int) -> list[tuple[int, int]] | None:
+    """Parse a ``Range: bytes=...`` header into sorted, merged inclusive (start, end) pairs.
+
+    Returns None when the header should be ignored (malformed or not a byte range),
+    and an empty list when no range is satisfiable.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start < 0 or (last and end < start):
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    # Weak comparison, as required for If-None-Match
+    return any(t.removeprefix("W/") == etag for t in tags)
+
+
+def _parse_http_date(value: str) -> datetime.datetime | None:
+    try:
+        return email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_not_modified(handler, etag: str, st: os.stat_result) -> bool:
+    if_none_match = handler.request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    date = _parse_http_date(handler.request.headers.get("If-Modified-Since", ""))
+    return date is not None and int(st.st_mtime) <= date.timestamp()
+
+
+def _if_range_allows(handler, etag: str, st: os.stat_result) -> bool:
+    if_range = handler.request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Strong comparison only
+        return if_range.strip() == etag
+    date = _parse_http_date(if_range)
+    return date is not None and int(st.st_mtime) == int(date.timestamp())
+
+
+def _open(path: str) -> tuple:
+    f = open(path, "rb")
+    try:
+        return f, os.fstat(f.fileno())
+    except BaseException:
+        f.close()
+        raise
+
+
+async def send_file(handler, path: str, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    encoding: str | None = None, level: int | None = None, cache=None) -> None:
+    """Stream ``path`` to the client in bounded chunks, honouring conditional and Range requests.
+
+    With ``encoding``, whole-file responses are compressed on the fly (or
+    served from ``cache``, a PrecompressedCache); range requests are always
+    answered from the uncompressed file.
+    """
+    f, st = await executors.run("metadata", _open, path)
+    with f:
+        size = st.st_size
+        encoding = response_encoding(handler, encoding)
+        etag = make_etag(st, encoding)
+
+        handler.set_header("Accept-Ranges", "bytes")
+        handler.set_header("Etag", etag)
+        handler.set_header("Last-Modified", datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc))
+        handler.set_header("Content-Disposition", f'attachment; filename="{filename}"')
+
+        if is_not_modified(handler, etag, st):
+            handler.set_status(304)
+            return
+
+        content_type = "application/octet-stream"
+        ranges = None
+        range_header = handler.request.headers.get("Range")
+        if range_header and _if_range_allows(handler, etag, st):
+            ranges = parse_range_header(range_header, size)
+            if ranges == []:
+                handler.set_status(416)
+                handler.set_header("Content-Range", f"bytes */{size}")
+                return
+
+        if encoding:
+            handler.set_header("Content-Type", content_type)
+            handler.set_header("Content-Encoding", encoding)
+            if handler.request.method == "HEAD":
+                await _head_compressed(handler, path, st, encoding, level, cache)
+                return
+            try:
+                await _send_compressed(handler, f.fileno(), path, st, chunk_size, encoding, level, cache)
+            except StreamClosedError:
+                pass
+            return
+
+        if not ranges:
+            handler.set_header("Content-Type", content_type)
+            handler.set_header("Content-Length", size)
+            parts = [(None, 0, size - 1)]
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            handler.set_status(206)
+            handler.set_header("Content-Type", content_type)
+            handler.set_header("Content-Range", f"bytes {start}-{end}/{size}")
+            handler.set_header("Content-Length", end - start + 1)
+            parts = [(None, start, end)]
+        else:
+            boundary = secrets.token_hex(16)
+            handler.set_status(206)
+            handler.set_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+            parts = []
+            length = 0
+            for start, end in ranges:
+                head = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode()
+                parts.append((head, start, end))
+                length += len(head) + (end - start + 1) + 2
+            trailer = f"--{boundary}--\r\n".encode()
+            handler.set_header("Content-Length", length + len(trailer))
+
+        if handler.request.method == "HEAD":
+            return
+
+        try:
+            for head, start, end in parts:
+                if head:
+                    handler.write(head)
+                await _send_range(handler, f.fileno(), start, end - start + 1, chunk_size)
+                if head:
+                    handler.write(b"\r\n")
+            if len(parts) > 1:
+                handler.write(trailer)
+        except StreamClosedError:
+            pass
+
+
+async def _send_range(handler, fd: int, start: int, length: int, chunk_size: int) -> None:
+    position = start
+    remaining = length
+    while remaining > 0:
+        # A read from a cold disk or a network mount must not stall the IOLoop
+        chunk = await executors.run("read", os.pread, fd, min(chunk_size, remaining), position)
+        if not chunk:
+            break
+        position += len(chunk)
+        remaining -= len(chunk)
+        handler.write(chunk)
+        # Wait for the socket to drain so at most one chunk is buffered per download
+        await handler.flush()
+
+
+def _compress_chunk(fd: int, size: int, offset: int, compressor: Compressor, writer) -> tuple[int, bytes]:
+    # Runs in an executor thread so compression never blocks the IOLoop
+    data = os.pread(fd, size, offset)
+    output = compressor.compress(data) if data else b""
+    if writer is not None and output:
+        writer.write(output)
+    return len(data), output
+
+
+def _finish_compression(compressor: Compressor, writer) -> bytes:
+    output = compressor.finish()
+    if writer is not None:
+        writer.write(output)
+        writer.commit()
+    return output
+
+
+async def _head_compressed(handler, path: str, st: os.stat_result, encoding: str, level: int | None,
+                           cache) -> None:
+    # The compressed length is only known once a cached copy exists
+    cached = None
+    if cache is not None and st.st_size >= cache.min_size:
+        cached = await executors.run("read", cache.open, path, st, encoding, level)
+    if cached is not None:
+        try:
+            handler.set_header("Content-Length", os.fstat(cached).st_size)
+        finally:
+            os.close(cached)
+        return
+    # Send the headers now, or finish() would add a Content-Length of 0
+    try:
+        await handler.flush()
+    except StreamClosedError:
+        pass
+
+
+async def _send_compressed(handler, fd: int, path: str, st: os.stat_result, chunk_size: int,
+                           encoding: str, level: int | None, cache) -> None:
+    use_cache = cache is not None and st.st_size >= cache.min_size
+    cached = await executors.run("read", cache.open, path, st, encoding, level) if use_cache else None
+    if cached is not None:
+        try:
+            size = os.fstat(cached).st_size
+            handler.set_header("Content-Length", size)
+            await _send_range(handler, cached, 0, size, chunk_size)
+        finally:
+            os.close(cached)
+        return
+    # Compressed once here and kept for the next request
+    writer = await executors.run("write", cache.create, path, st, encoding, level) if use_cache else None
+    compressor = Compressor(encoding, level)
+    try:
+        position = 0
+        while position < st.st_size:
+            count, output = await executors.run("read", _compress_chunk, fd, min(chunk_size, st.st_size - position),
+                                                position, compressor, writer)
+            if not count:
+                break
+            position += count
+            if output:
+                handler.write(output)
+                await handler.flush()
+        handler.write(await executors.run("write", _finish_compression, compressor, writer))
+        writer = None
+    finally:
+        if writer is not None:
+            await executors.run("write", writer.abort)
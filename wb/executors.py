@@ -0,0 +1,162 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .metrics import registry
+
+# Blocking filesystem work is split into classes with their own threads, so a
+# tree delete can only ever occupy the "bulk" threads and never delays a listing
+DEFAULT_POOLS = {
+    # stat calls and directory listings
+    "metadata": {"threads": 4, "max_queue": None},
+    # file views, line lookups, download chunks and tree walks
+    "read": {"threads": 8, "max_queue": None},
+    # upload writes and upload session files
+    "write": {"threads": 4, "max_queue": None},
+    # first-time line index scans and compressed file indexing, which read whole files
+    "scan": {"threads": 2, "max_queue": None},
+    # whole-tree deletes and renames
+    "bulk": {"threads": 2, "max_queue": 32},
+}
+# Wait and run times are reported over this many recent operations
+SAMPLE_SIZE = 1024
+
+
+class ExecutorBusy(Exception):
+    """Raised when an operation class already has ``max_queue`` operations waiting."""
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def _summary(samples) -> dict:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+        "p50_ms": round(_percentile(ordered, 0.5) * 1000, 3),
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+class OperationPool:
+    """A thread pool for one class of operation that keeps queue and timing statistics."""
+
+    def __init__(self, name: str, threads: int, max_queue: int | None = None):
+        self.name = name
+        self.threads = threads
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix=f"wb-{name}")
+        self.lock = threading.Lock()
+        self.queued = self.running = 0
+        self.submitted = self.completed = self.failed = self.rejected = 0
+        self.waits = deque(maxlen=SAMPLE_SIZE)
+        self.durations = deque(maxlen=SAMPLE_SIZE)
+
+    def submit(self, fn, *args) -> Future:
+        with self.lock:
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise ExecutorBusy(f"Too many queued {self.name} operations")
+            self.queued += 1
+            self.submitted += 1
+        future = self.executor.submit(self._call, time.monotonic(), fn, args)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _call(self, queued_at: float, fn, args):
+        started = time.monotonic()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.waits.append(started - queued_at)
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.durations.append(time.monotonic() - started)
+
+    def _on_done(self, future: Future) -> None:
+        with self.lock:
+            if future.cancelled():
+                # Cancelled while still queued, so _call never ran
+                self.queued -= 1
+            elif future.exception() is not None:
+                self.failed += 1
+            self.completed += 1
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "threads": self.threads,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "wait": _summary(self.waits),
+                "run": _summary(self.durations),
+            }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class Executors:
+    """The operation pools, created on first use from ``DEFAULT_POOLS`` and any configured overrides."""
+
+    def __init__(self):
+        self.options = {name: dict(options) for name, options in DEFAULT_POOLS.items()}
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def configure(self, config: dict) -> None:
+        """Apply ``{"bulk": {"threads": 4, "max_queue": 8}, ...}`` overrides; running pools are replaced."""
+        with self.lock:
+            for name, options in config.items():
+                if name not in self.options:
+                    raise ValueError(f"Unknown executor {name!r}; expected one of {', '.join(self.options)}")
+                self.options[name].update(options)
+                pool = self.pools.pop(name, None)
+                if pool is not None:
+                    pool.shutdown()
+
+    def get(self, name: str) -> OperationPool:
+        with self.lock:
+            pool = self.pools.get(name)
+            if pool is None:
+                options = self.options[name]
+                pool = self.pools[name] = OperationPool(name, options["threads"], options.get("max_queue"))
+            return pool
+
+    def run(self, name: str, fn, *args):
+        return self.get(name).run(fn, *args)
+
+    def stats(self) -> dict:
+        return {name: self.get(name).stats() for name in self.options}
+
+
+executors = Executors()
+
+
+def _pool_values(attribute: str):
+    return lambda: {(name,): getattr(pool, attribute) for name, pool in list(executors.pools.items())}
+
+
+registry.gauge("filey_executor_queued", "Operations waiting for an executor thread.", ("pool",), _pool_values("queued"))
+registry.gauge("filey_executor_running", "Operations running on an executor thread.", ("pool",), _pool_values("running"))
+registry.counter("filey_executor_completed_total", "Operations finished by each executor.", ("pool",),
+                 _pool_values("completed"))
+registry.counter("filey_executor_rejected_total", "Operations refused because the queue was full.", ("pool",),
+                 _pool_values("rejected"))
@@ -0,0 +1,141 @@
+import os
+import re
+import mmap
+import fnmatch
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+MAX_CONCURRENT_SEARCHES = 4
+DEFAULT_MAX_MATCHES = 1000
+MAX_MATCHES_PER_FILE = 100
+SNIPPET_LENGTH = 200
+# A NUL byte in this much of the start of a file marks it as binary
+BINARY_CHECK_SIZE = 8192
+
+
+def compile_pattern(query: str, regex: bool = False, ignore_case: bool = False) -> tuple[bytes, int]:
+    """Return the ``(pattern, flags)`` workers compile; raises ValueError for a bad regex."""
+    pattern = query.encode() if regex else re.escape(query.encode())
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    try:
+        compiled = re.compile(pattern, flags)
+    except re.error as e:
+        raise ValueError(f"Invalid pattern: {e}")
+    if compiled.match(b""):
+        raise ValueError("Pattern matches the empty string")
+    return pattern, flags
+
+
+def iter_files(root: str, name_glob: str | None = None, max_size: int | None = None):
+    """Yield the regular files under ``root`` whose name matches ``name_glob`` and size is within ``max_size``."""
+    pending = [root]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                if name_glob and not fnmatch.fnmatch(entry.name, name_glob):
+                    continue
+                if max_size is not None and entry.stat().st_size > max_size:
+                    continue
+            except OSError:
+                continue
+            yield entry.path
+        pending.extend(reversed(subdirs))
+
+
+def take(iterator, count: int) -> list:
+    # Pull the next batch from a generator; called in an executor thread
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= count:
+            break
+    return batch
+
+
+_compiled = {}
+
+
+def scan_file(path: str, pattern: bytes, flags: int, max_matches: int = MAX_MATCHES_PER_FILE) -> dict | None:
+    """Search one file; runs in a worker process.
+
+    Returns ``{"path", "matches": [(line number, snippet)], "truncated"}``, or
+    None for files that are empty, unreadable or binary.
+    """
+    regex = _compiled.get((pattern, flags))
+    if regex is None:
+        regex = _compiled[(pattern, flags)] = re.compile(pattern, flags)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data.find(b"\0", 0, BINARY_CHECK_SIZE) >= 0:
+                    return None
+                matches = []
+                line = 1
+                counted = 0
+                truncated = False
+                for match in regex.finditer(data):
+                    start = data.rfind(b"\n", 0, match.start()) + 1
+                    end = data.find(b"\n", match.start())
+                    if end < 0:
+                        end = size
+                    line += data[counted:start].count(b"\n")
+                    counted = start
+                    if matches and matches[-1][0] == line:
+                        continue
+                    if len(matches) >= max_matches:
+                        truncated = True
+                        break
+                    snippet = data[start:min(end, start + SNIPPET_LENGTH)].decode("utf-8", errors="replace")
+                    matches.append((line, snippet.rstrip("\r")))
+    except (OSError, ValueError):
+        return None
+    if not matches:
+        return None
+    return {"path": path, "matches": matches, "truncated": truncated}
+
+
+class SearchPool(ProcessPoolExecutor):
+    """The worker processes searches run in; ``workers`` is how many there are."""
+
+    def __init__(self, workers: int):
+        # spawn rather than fork: the server process has threads (executors, the path index)
+        super().__init__(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.workers = workers
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers: int | None = None) -> SearchPool:
+    """The process pool shared by all searches, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SearchPool(workers or os.cpu_count())
+        return _pool
+
+
+def replace_broken_pool(pool: SearchPool) -> None:
+    """Drop ``pool`` after a worker died in it, so the next search starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
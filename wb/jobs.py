@@ -0,0 +1,404 @@
+import os
+import re
+import json
+import stat
+import time
+import errno
+import shutil
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .executors import executors
+from .metrics import JOBS, JOB_DURATION, JOB_BYTES
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# Finished jobs are kept this long (seconds) so clients can still read their outcome
+JOB_TTL = 3600
+MAX_FINISHED_JOBS = 1000
+# Running jobs publish their progress to the state directory at most this often (seconds)
+PUBLISH_INTERVAL = 0.5
+
+
+def default_state_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), "filey-jobs")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """A long-running filesystem operation executed on the ``bulk`` executor.
+
+    The operation runs in a worker thread and reports progress by calling
+    ``advance``; ``check`` raises JobCancelled once the job has been cancelled,
+    so cancellation takes effect between entries or copied chunks.
+
+    With a ``state_dir`` the job's status is also published there, so other
+    worker processes can report it and cancel it through a marker file.
+    """
+
+    def __init__(self, kind: str, source: str, target: str | None = None, state_dir: str | None = None):
+        self.id = secrets.token_hex(8)
+        self.kind = kind
+        self.source = source
+        self.target = target
+        self.state = "queued"
+        self.phase = None
+        self.entries = self.bytes = 0
+        self.entries_total = self.bytes_total = None
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self.cancelled = threading.Event()
+        self.future = None
+        self.state_dir = state_dir
+        self.published = 0.0
+
+    def check(self) -> None:
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def advance(self, entries: int = 0, size: int = 0) -> None:
+        self.check()
+        self.entries += entries
+        self.bytes += size
+        self.publish()
+
+    def publish(self, force: bool = False) -> None:
+        """Write the status to the state directory and pick up cancellations requested there."""
+        if self.state_dir is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.published < PUBLISH_INTERVAL:
+            return
+        self.published = now
+        if os.path.exists(os.path.join(self.state_dir, self.id + ".cancel")):
+            self.cancelled.set()
+        write_status(self.state_dir, self.id, {**self.status(), "pid": os.getpid()})
+
+    def start_phase(self, phase: str, entries_total: int | None = None, bytes_total: int | None = None) -> None:
+        self.phase = phase
+        self.entries = self.bytes = 0
+        self.entries_total, self.bytes_total = entries_total, bytes_total
+
+    def run(self, operation, args, on_done) -> None:
+        self.state = "running"
+        self.started = time.time()
+        try:
+            self.publish(force=True)
+            self.check()
+            operation(self, *args)
+            if on_done is not None:
+                on_done()
+            self.state = "done"
+        except JobCancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            self.state = "failed"
+            if isinstance(e, OSError) and e.filename:
+                self.error = f"{e.strerror or e}: {os.path.basename(e.filename)}"
+            else:
+                self.error = str(e)
+        finally:
+            self.finished = time.time()
+            self.publish(force=True)
+            JOBS.inc(self.kind, self.state)
+            JOB_DURATION.observe(self.finished - self.started, self.kind)
+            JOB_BYTES.inc(self.kind, amount=self.bytes)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        if self.future is not None and self.future.cancel():
+            # Never started, so run() won't count it
+            self.state = "cancelled"
+            self.finished = time.time()
+            self.publish(force=True)
+            JOBS.inc(self.kind, self.state)
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "phase": self.phase,
+            "source": self.source,
+            "target": self.target,
+            "entries": self.entries,
+            "entries_total": self.entries_total,
+            "bytes": self.bytes,
+            "bytes_total": self.bytes_total,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class StoredJob:
+    """A job run by another worker process, seen through its published status."""
+
+    def __init__(self, state_dir: str, job_id: str, status: dict):
+        self.state_dir = state_dir
+        self.id = job_id
+        self.last = status
+
+    def status(self) -> dict:
+        status = read_status(self.state_dir, self.id) or self.last
+        if status["state"] in ("queued", "running") and not _process_exists(status.get("pid")):
+            status = {**status, "state": "failed", "error": "The worker running this job exited"}
+        self.last = status
+        return {key: value for key, value in status.items() if key != "pid"}
+
+    def cancel(self) -> None:
+        # The owning worker notices the marker the next time it publishes progress
+        open(os.path.join(self.state_dir, self.id + ".cancel"), "a").close()
+
+    @property
+    def done(self) -> bool:
+        return self.status()["state"] in ("done", "failed", "cancelled")
+
+
+def write_status(state_dir: str, job_id: str, status: dict) -> None:
+    # Replaced atomically so readers never see a partial file
+    temp = os.path.join(state_dir, f".{job_id}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp, "w") as f:
+        json.dump(status, f)
+    os.replace(temp, os.path.join(state_dir, job_id + ".json"))
+
+
+def read_status(state_dir: str, job_id: str) -> dict | None:
+    try:
+        with open(os.path.join(state_dir, job_id + ".json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _process_exists(pid: int | None) -> bool:
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """This process's jobs, plus those of other workers when they share ``state_dir``.
+
+    With a state directory every call reads or writes files, so the server
+    calls these methods on the ``metadata`` executor; ``lock`` guards ``jobs``.
+    """
+
+    def __init__(self, state_dir: str | None = None):
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.state_dir = None
+        if state_dir is not None:
+            self.configure(state_dir)
+
+    def configure(self, state_dir: str | None) -> None:
+        """Share jobs with other worker processes through ``state_dir``."""
+        if state_dir is not None:
+            os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+
+    def submit(self, kind: str, operation, args: tuple, source: str, target: str | None = None,
+               on_done=None) -> Job:
+        """Queue ``operation(job, *args)``; raises ExecutorBusy when too many jobs are waiting.
+
+        ``on_done`` is called in the worker thread after the operation succeeds.
+        """
+        self.expire()
+        job = Job(kind, source, target, self.state_dir)
+        job.future = executors.get("bulk").submit(job.run, operation, args, on_done)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.publish(force=True)
+        return job
+
+    def get(self, job_id: str) -> "Job | StoredJob | None":
+        job = self.jobs.get(job_id)
+        if job is None and self.state_dir is not None and re.fullmatch(r"[0-9a-f]+", job_id):
+            status = read_status(self.state_dir, job_id)
+            if status is not None:
+                job = StoredJob(self.state_dir, job_id, status)
+        return job
+
+    def active(self) -> list[Job]:
+        """This process's jobs that have not finished yet."""
+        with self.lock:
+            return [job for job in self.jobs.values() if not job.done]
+
+    def list(self) -> list[dict]:
+        self.expire()
+        with self.lock:
+            jobs = list(self.jobs.values())
+        statuses = [job.status() for job in jobs]
+        if self.state_dir is not None:
+            local = {job.id for job in jobs}
+            stored = [self.get(name[:-5]) for name in os.listdir(self.state_dir)
+                      if name.endswith(".json") and name[:-5] not in local]
+            statuses.extend(job.status() for job in stored if job is not None)
+            statuses.sort(key=lambda status: status["created"])
+        return statuses
+
+    def expire(self) -> None:
+        cutoff = time.time() - JOB_TTL
+        with self.lock:
+            finished = [job for job in self.jobs.values() if job.done]
+            for index, job in enumerate(finished):
+                if job.finished < cutoff or index < len(finished) - MAX_FINISHED_JOBS:
+                    del self.jobs[job.id]
+        if self.state_dir is not None:
+            try:
+                names = os.listdir(self.state_dir)
+            except OSError:
+                return
+            for name in names:
+                path = os.path.join(self.state_dir, name)
+                try:
+                    # Running jobs republish as they progress, so only abandoned files get this old
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+job_manager = JobManager()
+
+
+# -- Operations --------------------------------------------------------------
+# Each runs in a worker thread and takes the job as its first argument.
+
+def remove_tree(job: Job, path: str) -> None:
+    """Delete ``path`` (a file or a whole tree, without following symlinks)."""
+    job.start_phase("deleting")
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+        job.advance(1, st.st_size)
+        return
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False, onerror=_raise):
+        for name in filenames:
+            child = os.path.join(dirpath, name)
+            size = os.lstat(child).st_size
+            os.unlink(child)
+            job.advance(1, size)
+        for name in dirnames:
+            child = os.path.join(dirpath, name)
+            # Symlinks to directories are listed as directories but never descended into
+            if os.path.islink(child):
+                os.unlink(child)
+            else:
+                os.rmdir(child)
+            job.advance(1)
+    os.rmdir(path)
+    job.advance(1)
+
+
+def copy_tree(job: Job, source: str, target: str) -> None:
+    """Copy ``source`` to ``target``, which must not exist yet.
+
+    The copy is built under a hidden temporary name next to ``target`` and
+    renamed into place when complete, so a cancelled or failed copy leaves
+    nothing half-written behind.
+    """
+    entries, size = _measure(job, source)
+    job.start_phase("copying", entries, size)
+    partial = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.{job.id}.partial")
+    try:
+        if os.path.isdir(source) and not os.path.islink(source):
+            _copy_dir(job, source, partial)
+        else:
+            _copy_entry(job, source, partial)
+        if os.path.lexists(target):
+            raise FileExistsError(errno.EEXIST, "Target already exists", target)
+        os.rename(partial, target)
+    except BaseException:
+        if os.path.isdir(partial) and not os.path.islink(partial):
+            shutil.rmtree(partial, ignore_errors=True)
+        elif os.path.lexists(partial):
+            os.unlink(partial)
+        raise
+
+
+def move(job: Job, source: str, target: str) -> None:
+    """Rename ``source`` to ``target``, copying and deleting when they are on different filesystems."""
+    if os.path.lexists(target):
+        raise FileExistsError(errno.EEXIST, "Target already exists", target)
+    job.start_phase("renaming")
+    try:
+        os.rename(source, target)
+        job.advance(1)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_tree(job, source, target)
+    remove_tree(job, source)
+
+
+def _raise(error: OSError) -> None:
+    raise error
+
+
+def _measure(job: Job, path: str) -> tuple[int, int]:
+    job.start_phase("scanning")
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        job.advance(1, st.st_size)
+        return job.entries, job.bytes
+    job.advance(1)
+    for dirpath, dirnames, filenames in os.walk(path, onerror=_raise):
+        job.advance(len(dirnames))
+        for name in filenames:
+            job.advance(1, os.lstat(os.path.join(dirpath, name)).st_size)
+    return job.entries, job.bytes
+
+
+def _copy_dir(job: Job, source: str, target: str) -> None:
+    os.mkdir(target)
+    job.advance(1)
+    directories = [(source, target)]
+    for dirpath, dirnames, filenames in os.walk(source, onerror=_raise):
+        destination = os.path.join(target, os.path.relpath(dirpath, source))
+        for name in dirnames:
+            if os.path.islink(os.path.join(dirpath, name)):
+                _copy_entry(job, os.path.join(dirpath, name), os.path.join(destination, name))
+            else:
+                os.mkdir(os.path.join(destination, name))
+                directories.append((os.path.join(dirpath, name), os.path.join(destination, name)))
+                job.advance(1)
+        for name in filenames:
+            _copy_entry(job, os.path.join(dirpath, name), os.path.join(destination, name))
+    # Last, since creating entries updates a directory's mtime
+    for source_dir, target_dir in reversed(directories):
+        shutil.copystat(source_dir, target_dir)
+
+
+def _copy_entry(job: Job, source: str, target: str) -> None:
+    st = os.lstat(source)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(source), target)
+    elif stat.S_ISREG(st.st_mode):
+        with open(source, "rb") as src, open(target, "xb") as dst:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                job.advance(size=len(chunk))
+        shutil.copystat(source, target)
+    # Sockets, FIFOs and device nodes are not copied
+    job.advance(1)
@@ -0,0 +1,138 @@
+import re
+
+MAX_PATTERNS = 16
+MAX_PATTERN_LENGTH = 1024
+MAX_CONTEXT_LINES = 100
+
+
+class LineFilter:
+    """Selects lines matching any of ``patterns`` (or none of them with ``invert``).
+
+    The patterns are compiled once into a single alternation and run over
+    whole blocks of lines at a time, so the regex engine does the scanning
+    rather than a Python loop over lines. ``before``/``after`` add that many
+    lines of context around each selected run, as ``grep -B``/``-A`` do.
+    """
+
+    def __init__(self, patterns: list[str], literal: bool = False, invert: bool = False,
+                 ignore_case: bool = False, before: int = 0, after: int = 0):
+        if not patterns or len(patterns) > MAX_PATTERNS:
+            raise ValueError(f"Between 1 and {MAX_PATTERNS} patterns are allowed")
+        if any(len(p) > MAX_PATTERN_LENGTH for p in patterns):
+            raise ValueError(f"Patterns are limited to {MAX_PATTERN_LENGTH} characters")
+        if not (0 <= before <= MAX_CONTEXT_LINES and 0 <= after <= MAX_CONTEXT_LINES):
+            raise ValueError(f"Context is limited to {MAX_CONTEXT_LINES} lines")
+        self.patterns = patterns
+        self.invert = invert
+        self.before = before
+        self.after = after
+        self.key = (tuple(patterns), literal, invert, ignore_case, before, after)
+        sources = [re.escape(p) if literal else p for p in patterns]
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        try:
+            self.regex = re.compile("|".join(f"(?:{s})" for s in sources).encode(), flags)
+        except re.error as e:
+            raise ValueError(f"Invalid pattern: {e}")
+
+    @classmethod
+    def from_arguments(cls, get_arguments, get_argument) -> "LineFilter | None":
+        """Build a filter from ``?grep=...`` query arguments, or return None if there are none."""
+        patterns = get_arguments("grep")
+        if not patterns:
+            return None
+        flag = lambda name: get_argument(name, "0") not in ("0", "", "false")
+        context = int(get_argument("context", "0"))
+        return cls(patterns, literal=flag("literal"), invert=flag("invert"), ignore_case=flag("ignore_case"),
+                   before=int(get_argument("before", str(context))), after=int(get_argument("after", str(context))))
+
+    def select(self, data: bytes, start: int = 0) -> list[tuple[int, int]]:
+        """Return ``(start, end)`` spans of contiguous selected lines in ``data[start:]``.
+
+        ``data`` must end at a line boundary; spans include the trailing newline.
+        """
+        matched = []
+        pos = start
+        while pos < len(data):
+            match = self.regex.search(data, pos)
+            if match is None:
+                break
+            line_start = data.rfind(b"\n", 0, match.start()) + 1
+            line_end = data.find(b"\n", match.start()) + 1 or len(data)
+            if matched and matched[-1][1] == line_start:
+                matched[-1] = (matched[-1][0], line_end)
+            else:
+                matched.append((line_start, line_end))
+            pos = line_end
+        if not self.invert:
+            return matched
+        # Everything between the matching runs
+        spans = []
+        pos = start
+        for span_start, span_end in matched:
+            if span_start > pos:
+                spans.append((pos, span_start))
+            pos = span_end
+        if pos < len(data):
+            spans.append((pos, len(data)))
+        return spans
+
+
+class FilterState:
+    """Applies a LineFilter to a stream of blocks, carrying context across block boundaries.
+
+    ``feed(offset, data)`` takes complete lines starting at file ``offset`` and
+    returns the selected output as ``(offset, bytes)`` runs; each run is a
+    contiguous slice of the file, and no byte is returned twice.
+    """
+
+    def __init__(self, line_filter: LineFilter, offset: int = 0, carry: bytes = b""):
+        self.filter = line_filter
+        # The last `before` lines seen, in case the next block starts with a match
+        self.carry = carry
+        self.emitted = offset
+        self.after_pending = 0
+
+    def feed(self, offset: int, data: bytes) -> list[tuple[int, bytes]]:
+        line_filter = self.filter
+        skip = len(self.carry)
+        buf = self.carry + data if skip else data
+        base = offset - skip
+        intervals = []
+        if self.after_pending:
+            end, self.after_pending = _forward_lines(buf, skip, self.after_pending)
+            intervals.append((skip, end))
+        for start, end in line_filter.select(buf, skip):
+            for _ in range(line_filter.before):
+                if start == 0:
+                    break
+                start = buf.rfind(b"\n", 0, start - 1) + 1
+            end, self.after_pending = _forward_lines(buf, end, line_filter.after)
+            intervals.append((start, end))
+
+        runs = []
+        for start, end in intervals:
+            start = max(start, self.emitted - base)
+            if start >= end:
+                continue
+            if runs and runs[-1][0] + len(runs[-1][1]) == base + start:
+                runs[-1] = (runs[-1][0], runs[-1][1] + buf[start:end])
+            else:
+                runs.append((base + start, buf[start:end]))
+            self.emitted = base + end
+
+        if line_filter.before:
+            start = len(buf)
+            for _ in range(line_filter.before):
+                if start == 0:
+                    break
+                start = buf.rfind(b"\n", 0, start - 1) + 1
+            self.carry = buf[start:]
+        return runs
+
+
+def _forward_lines(data: bytes, pos: int, count: int) -> tuple[int, int]:
+    # Advance over up to `count` lines; returns the new position and how many lines were missing
+    while count and pos < len(data):
+        pos = data.find(b"\n", pos) + 1 or len(data)
+        count -= 1
+    return pos, count
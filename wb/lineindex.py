@@ -0,0 +1,221 @@
+import os
+import re
+import struct
+import tempfile
+import threading
+import functools
+import contextlib
+from array import array
+from collections import OrderedDict
+
+from .compressed import open_uncompressed
+
+DEFAULT_STRIDE = 1000
+SCAN_BLOCK_SIZE = 1024 * 1024
+FINGERPRINT_SIZE = 64
+MAX_LINES_PER_READ = 10000
+MAX_BYTES_PER_READ = 1024 * 1024
+# Number of indexes kept in memory; the rest are reloaded from their sidecar files
+MAX_CACHED_INDEXES = 64
+
+_HEADER = struct.Struct("<4sIIQQQqB64s")
+_MAGIC = b"FLIX"
+_VERSION = 1
+
+
+def default_cache_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), "filey-index")
+
+
+@functools.lru_cache(maxsize=64)
+def _skip_lines(count: int) -> re.Pattern:
+    # Matches exactly `count` complete lines; lets the regex engine walk newlines in C
+    return re.compile(rb"(?:[^\n]*\n){%d}" % count)
+
+
+class LineIndex:
+    """Sparse index of line start offsets for one file.
+
+    ``offsets[k]`` is the byte offset of line ``k * stride``. The index covers
+    the file up to ``scanned`` (the end of the last complete line seen) and is
+    extended from there when the file grows; it is only rebuilt when the file
+    is replaced (new inode), truncated, or rewritten in place. Offsets in a
+    compressed file are offsets into its uncompressed data.
+    """
+
+    def __init__(self, path: str, stride: int = DEFAULT_STRIDE, cache_dir: str | None = None):
+        self.path = path
+        self.stride = stride
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.identity = None
+        self._reset()
+
+    def _reset(self):
+        self.offsets = array("Q", [0])
+        self.lines = 0
+        self.scanned = 0
+        self.size = 0
+        self.mtime_ns = 0
+        self.fingerprint = b""
+
+    @property
+    def sidecar_path(self) -> str | None:
+        if not self.cache_dir or self.identity is None:
+            return None
+        return os.path.join(self.cache_dir, "%x-%x.idx" % self.identity)
+
+    def refresh(self) -> None:
+        f, size = open_uncompressed(self.path)
+        with self.lock, f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino)
+            if identity != self.identity:
+                self.identity = identity
+                self._reset()
+                self._load()
+            if (size, st.st_mtime_ns) == (self.size, self.mtime_ns):
+                return
+            if size < self.scanned or not self._fingerprint_matches(f):
+                self._reset()
+            self._scan(f, size)
+            self.size, self.mtime_ns = size, st.st_mtime_ns
+            self._save()
+
+    def _fingerprint_matches(self, f) -> bool:
+        f.seek(self.scanned - len(self.fingerprint))
+        return f.read(len(self.fingerprint)) == self.fingerprint
+
+    def _scan(self, f, size: int) -> None:
+        f.seek(self.scanned)
+        pos = self.scanned
+        while pos < size:
+            block = f.read(min(SCAN_BLOCK_SIZE, size - pos))
+            if not block:
+                break
+            newlines = block.count(b"\n")
+            if not newlines:
+                # No complete line in this block; resume from the same place next time
+                if len(block) == SCAN_BLOCK_SIZE and pos + len(block) < size:
+                    pos += len(block)
+                    continue
+                break
+            next_mark = len(self.offsets) * self.stride
+            i = 0
+            while self.lines + newlines >= next_mark:
+                need = next_mark - self.lines
+                match = _skip_lines(need).match(block, i)
+                i = match.end()
+                self.lines += need
+                newlines -= need
+                self.offsets.append(pos + i)
+                next_mark += self.stride
+            self.lines += newlines
+            last = block.rfind(b"\n") + 1
+            pos += last
+            self.scanned = pos
+            if last < len(block):
+                f.seek(pos)
+        self.fingerprint = b""
+        if self.scanned:
+            start = max(self.scanned - FINGERPRINT_SIZE, 0)
+            f.seek(start)
+            self.fingerprint = f.read(self.scanned - start)
+
+    def _load(self) -> None:
+        path = self.sidecar_path
+        if path is None:
+            return
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, version, stride, lines, scanned, size, mtime_ns, fp_len, fingerprint = _HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return
+        if magic != _MAGIC or version != _VERSION or stride != self.stride:
+            return
+        offsets = array("Q")
+        offsets.frombytes(data[_HEADER.size:])
+        self.offsets = offsets
+        self.lines, self.scanned, self.size, self.mtime_ns = lines, scanned, size, mtime_ns
+        self.fingerprint = fingerprint[:fp_len]
+
+    def _save(self) -> None:
+        path = self.sidecar_path
+        if path is None:
+            return
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, self.stride, self.lines, self.scanned, self.size,
+                                     self.mtime_ns, len(self.fingerprint), self.fingerprint))
+                self.offsets.tofile(f)
+            os.replace(temp_path, path)
+        except OSError:
+            # The sidecar is only a cache; an unwritable cache dir just means rescanning next time
+            if temp_path:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_path)
+
+    def seek_line(self, f, line: int) -> int:
+        """Position ``f`` at the start of ``line`` (0-based) and return its byte offset."""
+        mark = min(line // self.stride, len(self.offsets) - 1)
+        offset = self.offsets[mark]
+        skip = line - mark * self.stride
+        f.seek(offset)
+        while skip > 0:
+            block = f.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            newlines = block.count(b"\n")
+            if newlines < skip:
+                skip -= newlines
+                offset += len(block)
+                continue
+            offset += _skip_lines(skip).match(block).end()
+            skip = 0
+        f.seek(offset)
+        return offset
+
+    def read_lines(self, line: int, count: int) -> dict:
+        """Read up to ``count`` lines starting at ``line`` (0-based)."""
+        self.refresh()
+        count = max(0, min(count, MAX_LINES_PER_READ))
+        f, _ = open_uncompressed(self.path)
+        with f:
+            with self.lock:
+                start = self.seek_line(f, line)
+            lines = []
+            read = 0
+            while len(lines) < count and read < MAX_BYTES_PER_READ:
+                text = f.readline(MAX_BYTES_PER_READ - read)
+                if not text:
+                    break
+                read += len(text)
+                lines.append(text.decode("utf-8", errors="replace").rstrip("\r\n"))
+        return {
+            "line": line,
+            "lines": lines,
+            "start": start,
+            "end": start + read,
+            "size": self.size,
+            "total_lines": self.lines,
+        }
+
+
+_indexes: "OrderedDict[tuple[str, int], LineIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_line_index(path: str, cache_dir: str | None = None, stride: int = DEFAULT_STRIDE) -> LineIndex:
+    key = (path, stride)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = LineIndex(path, stride, cache_dir)
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import base64
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 10000
+MAX_CACHED_LISTINGS = 32
+SORT_KEYS = ("name", "size", "mtime")
+# Sizes and mtimes used to sort a listing are re-read after this many seconds;
+# a directory's own mtime only changes when entries are added, removed or renamed
+STAT_TTL = 5.0
+# A directory modified this close to when it was read may have changed again
+# within the same mtime tick, so such a listing is not trusted
+RACY_NS = 1_000_000_000
+
+
+class Listing:
+    """The entries of one directory as read once with os.scandir.
+
+    Names are kept sorted together with the ``d_type`` directory flag, which
+    costs no extra syscalls. Sizes and mtimes are only gathered for the
+    entries of a requested page, or for all entries (and cached for
+    ``STAT_TTL``) when sorting by size or mtime.
+    """
+
+    def __init__(self, path: str, st: os.stat_result):
+        self.path = path
+        self.identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        self.lock = threading.Lock()
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir))
+        entries.sort()
+        self.names = [name for name, _ in entries]
+        self.dirs = bytearray(is_dir for _, is_dir in entries)
+        self.read_ns = time.time_ns()
+        self.stats_time = None
+        self.sizes = self.mtimes = None
+        self.orders = {}
+
+    def fresh(self, st: os.stat_result) -> bool:
+        return ((st.st_dev, st.st_ino, st.st_mtime_ns) == self.identity
+                and self.read_ns - st.st_mtime_ns >= RACY_NS)
+
+    def _stat(self, index: int) -> tuple[int, int]:
+        try:
+            st = os.stat(os.path.join(self.path, self.names[index]))
+        except OSError:
+            # Vanished since the listing was read, or a dangling symlink
+            return -1, -1
+        return st.st_size, st.st_mtime_ns
+
+    def _order(self, sort: str) -> array:
+        if self.stats_time is None or time.monotonic() - self.stats_time > STAT_TTL:
+            sizes, mtimes = array("q"), array("q")
+            for index in range(len(self.names)):
+                size, mtime = self._stat(index)
+                sizes.append(size)
+                mtimes.append(mtime)
+            self.sizes, self.mtimes = sizes, mtimes
+            self.stats_time = time.monotonic()
+            self.orders = {}
+        order = self.orders.get(sort)
+        if order is None:
+            values = self.sizes if sort == "size" else self.mtimes
+            # Names are already sorted, so the index breaks ties by name
+            order = self.orders[sort] = array("L", sorted(range(len(self.names)), key=lambda i: (values[i], i)))
+        return order
+
+    def page(self, sort: str = "name", reverse: bool = False, cursor: str | None = None,
+             limit: int = DEFAULT_PAGE_SIZE) -> dict:
+        """Return up to ``limit`` entries following ``cursor`` in the given order."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.lock:
+            if sort == "name":
+                order = None
+                key = lambda position: (self.names[position],)
+            else:
+                order = self._order(sort)
+                values = self.sizes if sort == "size" else self.mtimes
+                key = lambda position: (values[order[position]], self.names[order[position]])
+            positions = range(len(self.names))
+            after = decode_cursor(cursor, sort) if cursor else None
+            if not reverse:
+                start = bisect.bisect_right(positions, after, key=key) if after else 0
+                page = range(start, min(start + limit, len(positions)))
+                more = page.stop < len(positions)
+            else:
+                end = bisect.bisect_left(positions, after, key=key) if after else len(positions)
+                page = range(end - 1, max(end - limit, 0) - 1, -1)
+                more = page.stop >= 0
+            entries = []
+            for position in page:
+                index = position if order is None else order[position]
+                if order is None:
+                    size, mtime = self._stat(index)
+                else:
+                    size, mtime = self.sizes[index], self.mtimes[index]
+                entries.append({
+                    "name": self.names[index],
+                    "is_dir": bool(self.dirs[index]),
+                    "size": size if size >= 0 else None,
+                    "mtime": mtime / 1e9 if mtime >= 0 else None,
+                })
+            next_cursor = encode_cursor(key(page[-1])) if more and page else None
+        return {"entries": entries, "next": next_cursor, "total": len(self.names)}
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    expected = (str,) if sort == "name" else (int, str)
+    if not isinstance(key, list) or tuple(map(type, key)) != expected:
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+
+def format_size(size: int | None) -> str:
+    if size is None:
+        return ""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_mtime(mtime: float | None) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime)) if mtime is not None else ""
+
+
+_listings: "OrderedDict[str, Listing]" = OrderedDict()
+_listings_lock = threading.Lock()
+
+
+def get_listing(path: str) -> Listing:
+    """Return the cached listing of ``path``, re-reading it if the directory has changed."""
+    st = os.stat(path)
+    with _listings_lock:
+        listing = _listings.get(path)
+        if listing is not None and listing.fresh(st):
+            _listings.move_to_end(path)
+            return listing
+    listing = Listing(path, st)
+    with _listings_lock:
+        _listings[path] = listing
+        _listings.move_to_end(path)
+        while len(_listings) > MAX_CACHED_LISTINGS:
+            _listings.popitem(last=False)
+    return listing
+
+
+def list_directory(path: str, sort: str = "name", reverse: bool = False, cursor: str | None = None,
+                   limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    return get_listing(path).page(sort, reverse, cursor, limit)
@@ -1,31 +1,139 @@
 import os
+import stat
 import secrets
 import argparse
 import json
+import glob
 from typing import TYPE_CHECKING
- 
- if TYPE_CHECKING:
-     from typing import Optional
 
+if TYPE_CHECKING:
+    from typing import Optional
+
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.log
+import tornado.netutil
 import tornado.web
 import socket
 import tornado.websocket
 import asyncio
+import tempfile
 import shutil
-from collections import deque
+import contextlib
+import codecs
+import functools
+import weakref
+import signal
 
 # Add this import for template path
 from tornado.web import RequestHandler, Application
 
+from .download import send_file, DEFAULT_CHUNK_SIZE
+from .viewer import read_window, DEFAULT_WINDOW_SIZE
+from .compressed import needs_indexing
+from .lineindex import get_line_index, default_cache_dir as default_index_cache_dir
+from .listing import list_directory, format_size, format_mtime, DEFAULT_PAGE_SIZE
+from .linefilter import LineFilter
+from .executors import executors, ExecutorBusy
+from .jobs import job_manager, remove_tree, copy_tree, move, default_state_dir as default_job_state_dir
+from .workers import Supervisor, RequestTracker, drain, DEFAULT_DRAIN_TIMEOUT
+from .metrics import (registry, read_published, record_request, ResponseSizeTransform, StallDetector,
+                      UPLOAD_BYTES, STREAM_BYTES, STREAM_SKIPPED_BYTES, DEFAULT_STALL_THRESHOLD,
+                      PUBLISH_INTERVAL as METRICS_PUBLISH_INTERVAL)
+from .compression import (CompressionTransform, PrecompressedCache, negotiate, compressible_file,
+                          DEFAULT_CACHE_SIZE as DEFAULT_COMPRESSION_CACHE_SIZE,
+                          DEFAULT_CACHE_MIN_SIZE as DEFAULT_COMPRESSION_CACHE_MIN_SIZE)
+from .archive import (iter_tree, make_writer, read_entry, FORMATS as ARCHIVE_FORMATS,
+                      DEFAULT_CHUNK_SIZE as DEFAULT_ARCHIVE_CHUNK_SIZE)
+from .grep import (compile_pattern, iter_files, take, scan_file, get_pool, replace_broken_pool, BrokenProcessPool,
+                   DEFAULT_MAX_MATCHES, MAX_CONCURRENT_SEARCHES)
+from .search import (get_path_index, current_path_index, DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT,
+                     DEFAULT_RESCAN_INTERVAL as DEFAULT_SEARCH_RESCAN_INTERVAL)
+from .dirwatch import (directory_hub, DEFAULT_BATCH_DELAY,
+                       DEFAULT_POLL_INTERVAL as DEFAULT_DIRECTORY_POLL_INTERVAL)
+from .multitail import (Source, TimestampMerger, MAX_SOURCES, DEFAULT_MERGE_DELAY,
+                        DEFAULT_RESCAN_INTERVAL)
+from .tail import (tail_hub, FrameCoalescer, DEFAULT_FRAME_SIZE, DEFAULT_FRAME_DELAY, DEFAULT_HIGH_WATER,
+                   DEFAULT_TAIL_LINES, MAX_TAIL_LINES, DEFAULT_BUFFER_SIZE as DEFAULT_TAIL_BUFFER_SIZE,
+                   DEFAULT_POLL_INTERVAL as DEFAULT_TAIL_POLL_INTERVAL)
+from .multipart import MultipartParser, MultipartError, get_boundary, parse_disposition
+from .delta import (DeltaApplier, DeltaError, get_signature,
+                    default_cache_dir as default_signature_cache_dir)
+from .chunked import (UploadSession, UploadSessionError, default_state_dir, expire_sessions,
+                      DEFAULT_CHUNK_SIZE as DEFAULT_UPLOAD_CHUNK_SIZE)
+
 # Will be set in main() after parsing configuration
 ACCESS_TOKEN = None
 ROOT_DIR = os.getcwd()
 
+# Upload limits, overridable through the config file
+MAX_CONCURRENT_UPLOADS = 16
+MAX_UPLOAD_REQUEST_SIZE = 1024 ** 4
+MAX_FIELD_SIZE = 64 * 1024
+
+# Milliseconds between job progress messages
+DEFAULT_JOB_PROGRESS_INTERVAL = 250
+
+
+def resolve_path(path, base=None):
+    # Absolute path of ``path`` under ``base`` (ROOT_DIR by default), or None if it escapes it
+    base = base or ROOT_DIR
+    abspath = os.path.abspath(os.path.join(base, path))
+    if os.path.commonpath([abspath, base]) != base:
+        return None
+    return abspath
+
+async def run_blocking(kind, fn, *args):
+    # Run blocking filesystem work on the executor for its class of operation
+    try:
+        return await executors.run(kind, fn, *args)
+    except ExecutorBusy as e:
+        raise tornado.web.HTTPError(503, reason=str(e))
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def read_pool(path):
+    # Reading a compressed file for the first time indexes all of it; that must not hold up light reads
+    return "scan" if needs_indexing(path) else "read"
+
+async def is_regular_file(path):
+    st = await run_blocking("metadata", stat_or_none, path)
+    return st is not None and stat.S_ISREG(st.st_mode)
+
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self) -> str | None:
         return self.get_secure_cookie("user")
 
+# Open WebSockets, so a draining worker can ask their clients to reconnect elsewhere
+open_websockets = weakref.WeakSet()
+
+class WebSocketBase(tornado.websocket.WebSocketHandler):
+    def get_current_user(self) -> str | None:
+        return self.get_secure_cookie("user")
+
+    def check_origin(self, origin):
+        return True  # Allow all origins for now
+
+    async def get(self, *args, **kwargs):
+        open_websockets.add(self)
+        await super().get(*args, **kwargs)
+
+def count_websockets():
+    counts = {}
+    for websocket in list(open_websockets):
+        if websocket.ws_connection is not None:
+            key = (type(websocket).__name__,)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+registry.gauge("filey_websockets_open", "Open WebSocket connections by handler.", ("handler",), count_websockets)
+
 class LoginHandler(BaseHandler):
     def get(self):
         if self.current_user:
@@ -43,185 +151,1381 @@ class LoginHandler(BaseHandler):
 
 class MainHandler(BaseHandler):
     @tornado.web.authenticated
-    def get(self, path):
-        abspath = os.path.abspath(os.path.join(ROOT_DIR, path))
-        root = ROOT_DIR
-        if not abspath.startswith(root):
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
             self.set_status(403)
             self.write("Forbidden")
             return
 
-        if os.path.isdir(abspath):
-            files = os.listdir(abspath)
-            files.sort()
-            file_data = []
-            for f_name in files:
-                file_data.append({
-                    'name': f_name,
-                    'is_dir': os.path.isdir(os.path.join(abspath, f_name))
-                })
-            self.render("directory.html", path=path, files=file_data)
-        elif os.path.isfile(abspath):
+        st = await run_blocking("metadata", stat_or_none, abspath)
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            sort = self.get_argument("sort", "name")
+            reverse = self.get_argument("order", "asc") == "desc"
+            cursor = self.get_argument("cursor", None)
+            try:
+                limit = int(self.get_argument("limit", str(self.settings.get("listing_page_size", DEFAULT_PAGE_SIZE))))
+                # Reading a huge directory (or stat-ing it for a sort) must not block the IOLoop
+                page = await run_blocking("metadata", list_directory, abspath, sort, reverse, cursor, limit)
+            except ValueError as e:
+                raise tornado.web.HTTPError(400, reason=str(e))
+            if self.get_argument("format", None) == "json":
+                self.write(page)
+                return
+            self.render("directory.html", path=path, files=page["entries"], next_cursor=page["next"],
+                        total=page["total"], sort=sort, order="desc" if reverse else "asc",
+                        format_size=format_size, format_mtime=format_mtime)
+        elif st is not None and stat.S_ISREG(st.st_mode):
             filename = os.path.basename(abspath)
             if self.get_argument('download', None):
-                self.set_header('Content-Type', 'application/octet-stream')
-                self.set_header('Content-Disposition', f'attachment; filename="{filename}"')
-                with open(abspath, 'rb') as f:
-                    self.write(f.read())
+                chunk_size = self.settings.get("download_chunk_size", DEFAULT_CHUNK_SIZE)
+                encoding = None
+                if self.settings.get("compression", True) and compressible_file(filename):
+                    self.set_header("Vary", "Accept-Encoding")
+                    encoding = negotiate(self.request.headers.get("Accept-Encoding", ""))
+                levels = self.settings.get("compression_levels") or {}
+                await send_file(self, abspath, filename, chunk_size, encoding, levels.get(encoding),
+                                self.settings.get("compression_cache"))
             else:
-                with open(abspath, 'r', encoding='utf-8', errors='replace') as f:
-                    file_content = f.read()
+                # Only the first (or, with ?tail=1, the last) window is rendered; the page fetches the rest on scroll
+                tail = self.get_argument('tail', None) is not None
+                window_size = self.settings.get("view_window_size", DEFAULT_WINDOW_SIZE)
+                window = await run_blocking(read_pool(abspath), read_window, abspath, None, window_size, tail)
                 start_streaming = self.get_argument('stream', None) is not None
-                self.render("file.html", filename=filename, path=path, file_content=file_content, start_streaming=start_streaming)
+                self.render("file.html", filename=filename, path=path, window=window, start_streaming=start_streaming)
         else:
             self.set_status(404)
             self.write("File not found")
 
-class FileStreamHandler(tornado.websocket.WebSocketHandler):
-    def get_current_user(self) -> str | None:
-        return self.get_secure_cookie("user")
+    head = get
 
-    def check_origin(self, origin):
-        return True  # Allow all origins for now
+class WindowHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
+            self.set_status(403)
+            self.write("Forbidden")
+            return
+        if not await is_regular_file(abspath):
+            self.set_status(404)
+            self.write("File not found")
+            return
+        try:
+            offset = self.get_argument("offset", None)
+            offset = int(offset) if offset is not None else None
+            length = int(self.get_argument("length", str(self.settings.get("view_window_size", DEFAULT_WINDOW_SIZE))))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="offset and length must be integers")
+        backward = self.get_argument("direction", "forward") == "backward"
+        self.write(await run_blocking(read_pool(abspath), read_window, abspath, offset, length, backward))
+
+class LinesHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
+            self.set_status(403)
+            self.write("Forbidden")
+            return
+        if not await is_regular_file(abspath):
+            self.set_status(404)
+            self.write("File not found")
+            return
+        try:
+            # Line numbers are 1-based, as in editors
+            line = max(int(self.get_argument("line", "1")), 1)
+            count = int(self.get_argument("count", "100"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="line and count must be integers")
+        index = get_line_index(abspath, self.settings.get("index_cache_dir") or default_index_cache_dir())
+        # The first request on a big file scans it once; that runs with the other whole-file scans
+        pool = "scan" if index.identity is None else read_pool(abspath)
+        result = await run_blocking(pool, index.read_lines, line - 1, count)
+        result["line"] = line
+        self.write(result)
 
+def tail_options(settings):
+    # Options for a newly created tail watcher; watchers already running keep theirs
+    return {
+        "buffer_size": settings.get("tail_buffer_size", DEFAULT_TAIL_BUFFER_SIZE),
+        "backend": settings.get("tail_backend", "auto"),
+        "interval": settings.get("tail_poll_interval", DEFAULT_TAIL_POLL_INTERVAL),
+    }
+
+class FileStreamHandler(WebSocketBase):
     async def open(self, path):
         if not self.current_user:
             self.close()
             return
             
-        self.file_path = os.path.abspath(os.path.join(ROOT_DIR, path))
+        self.file_path = resolve_path(path)
+        if self.file_path is None:
+            await self.send_error_message("Forbidden")
+            return
         self.running = True
-        if not os.path.isfile(self.file_path):
-            await self.write_message(f"File not found: {self.file_path}")
-            self.close()
+        if not await is_regular_file(self.file_path):
+            await self.send_error_message(f"File not found: {path}")
             return
 
-        # Send last 100 lines first
+        # Send the last N lines first (100 by default, ?lines=N to change)
         try:
-            with open(self.file_path, 'r', encoding='utf-8', errors='replace') as f:
-                last_100_lines = deque(f, 100)
-            if last_100_lines:
-                await self.write_message("".join(last_100_lines))
+            history_lines = min(int(self.get_argument("lines", str(DEFAULT_TAIL_LINES))), MAX_TAIL_LINES)
+            from_offset = self.get_argument("from_offset", None)
+            from_offset = int(from_offset) if from_offset is not None else None
+        except ValueError:
+            await self.send_error_message("lines and from_offset must be integers")
+            return
+        if from_offset is not None and from_offset < 0:
+            await self.send_error_message("from_offset must not be negative")
+            return
+        # Optional server-side filter, e.g. ?grep=ERROR&grep=WARN&context=2
+        try:
+            line_filter = LineFilter.from_arguments(self.get_arguments, self.get_argument)
+        except ValueError as e:
+            await self.send_error_message(f"Invalid filter: {e}")
+            return
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.frames = self.make_frames(self.send_frame, self.send_skipped)
+        # Live events wait until the history before them has been sent
+        self.held = []
+
+        # All connections tailing the same file share one watcher
+        try:
+            self.watcher = await tail_hub.subscribe(self.file_path, self, line_filter=line_filter,
+                                                    **tail_options(self.settings))
         except Exception as e:
-            await self.write_message(f"Error reading file history: {e}")
+            await self.send_error_message(f"Error opening file for streaming: {e}")
+            return
+        if not self.running:
+            # Closed while the watcher was being set up
+            tail_hub.unsubscribe(self.watcher, self)
+            self.watcher = None
+            return
+        self.file_id = self.watcher.identity
 
         try:
-            self.file = open(self.file_path, 'r', encoding='utf-8', errors='replace')
-            self.file.seek(0, os.SEEK_END)  # Start at end of file for new lines
+            reset = None
+            if from_offset is None:
+                pass
+            elif self.get_argument("file", None) != self.file_id:
+                # The client was following a file that has since been rotated away
+                reset = "rotated"
+            elif from_offset > self.watcher.offset:
+                reset = "truncated"
+            if reset:
+                self.send_message({"type": "reset", "file": self.file_id, "reason": reset})
+            # History may mean scanning far back through the file, so it is read from a view on an executor;
+            # a filtered tail returns a list of (offset, data) runs, a plain one a single run
+            with self.watcher.view() as view:
+                if from_offset is None or reset:
+                    runs = await run_blocking("read", view.history, history_lines)
+                    if line_filter is None:
+                        runs = [runs]
+                else:
+                    # Resume exactly where the client left off
+                    offset, runs = await run_blocking("read", view.read_since, from_offset)
+                    if line_filter is None:
+                        runs = [(offset, runs)]
+                    if offset > from_offset:
+                        self.send_skipped(from_offset, offset - from_offset)
+            if not self.running:
+                return
+            for offset, data in runs:
+                if data:
+                    # This is what the client asked for, so it is never dropped
+                    self.frames.push(offset, data, force=True)
+            self.frames.flush()
         except Exception as e:
-            await self.write_message(f"Error opening file for streaming: {e}")
+            self.send_message({"type": "error", "message": f"Error reading file history: {e}"})
+        self.release_held()
+
+    def hold(self, event, *args):
+        # True if the event has to wait for history that is still being read
+        if self.held is None:
+            return False
+        self.held.append((event, args))
+        return True
+
+    def release_held(self):
+        held, self.held = self.held, None
+        for event, args in held or ():
+            event(*args)
+
+    def make_frames(self, send_frame, send_skipped):
+        return FrameCoalescer(
+            send_frame, send_skipped,
+            frame_size=self.settings.get("stream_frame_size", DEFAULT_FRAME_SIZE),
+            delay=self.settings.get("stream_frame_delay", DEFAULT_FRAME_DELAY),
+            high_water=self.settings.get("stream_high_water", DEFAULT_HIGH_WATER))
+
+    def get_compression_options(self):
+        # permessage-deflate, if enabled and the client offers it
+        if self.settings.get("stream_compression"):
+            return {"compression_level": self.settings.get("stream_compression_level", 6)}
+        return None
+
+    def send_message(self, message):
+        try:
+            return self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            self.on_close()
+            return None
+
+    async def send_error_message(self, message):
+        try:
+            await self.write_message(json.dumps({"type": "error", "message": message}))
+        finally:
             self.close()
+
+    def send_frame(self, offset, data, end):
+        STREAM_BYTES.inc(type(self).__name__, amount=len(data))
+        # Every frame carries the byte range it covers so a reconnecting client can resume after it
+        return self.send_message({
+            "type": "data",
+            "file": self.file_id,
+            "offset": offset,
+            "end": end,
+            "text": self.decoder.decode(data),
+        })
+
+    def send_skipped(self, offset, count):
+        STREAM_SKIPPED_BYTES.inc(type(self).__name__, amount=count)
+        # Dropped data may have ended mid-character
+        self.decoder.reset()
+        self.send_message({"type": "skipped", "file": self.file_id, "offset": offset, "count": count})
+
+    def on_tail_data(self, offset, data):
+        if self.running and not self.hold(self.on_tail_data, offset, data):
+            self.frames.push(offset, data)
+
+    def on_tail_reset(self, reason):
+        if not self.running or self.hold(self.on_tail_reset, reason):
             return
-        self.loop = tornado.ioloop.IOLoop.current()
-        self.periodic = tornado.ioloop.PeriodicCallback(self.send_new_lines, 500)
-        self.periodic.start()
+        self.frames.flush()
+        self.decoder.reset()
+        self.file_id = self.watcher.identity
+        self.send_message({"type": "reset", "file": self.file_id, "reason": reason})
+
+    def on_close(self):
+        self.running = False
+        if getattr(self, 'frames', None) is not None:
+            self.frames.close()
+        if getattr(self, 'watcher', None) is not None:
+            tail_hub.unsubscribe(self.watcher, self)
+            self.watcher = None
+
+class MultiStreamHandler(FileStreamHandler):
+    """Tails several files over one WebSocket, optionally merged by timestamp.
 
-    async def send_new_lines(self):
+    Files are named with ``?path=`` and ``?glob=`` (both repeatable, relative
+    to ROOT_DIR); globs are re-evaluated periodically so that files created
+    later are picked up. Messages are those of ``/stream`` plus a ``source``
+    field naming the file they belong to.
+    """
+
+    async def open(self):
+        if not self.current_user:
+            self.close()
+            return
+        self.running = True
+        self.replaying = False
+        self.held = None
+        self.sources = {}
+        self.paths = self.get_arguments("path")
+        self.globs = self.get_arguments("glob")
+        if not self.paths and not self.globs:
+            await self.send_error_message("Give at least one path or glob")
+            return
+        try:
+            self.history_lines = min(int(self.get_argument("lines", str(DEFAULT_TAIL_LINES))), MAX_TAIL_LINES)
+            self.line_filter = LineFilter.from_arguments(self.get_arguments, self.get_argument)
+        except ValueError as e:
+            await self.send_error_message(f"Invalid argument: {e}")
+            return
+        self.merger = None
+        if self.get_argument("merge", None) == "timestamp":
+            self.merger = TimestampMerger(self.emit_merged,
+                                          delay=self.settings.get("multistream_merge_delay", DEFAULT_MERGE_DELAY))
+        await self.rescan()
+        self.rescanner = tornado.ioloop.PeriodicCallback(
+            self.rescan, self.settings.get("multistream_rescan_interval", DEFAULT_RESCAN_INTERVAL))
+        self.rescanner.start()
+
+    def expand(self):
+        # Runs on the metadata executor: globs list directories and every match is stat-ed
+        paths = []
+        for path in self.paths:
+            paths.append(resolve_path(path))
+        for pattern in self.globs:
+            if os.path.isabs(pattern):
+                continue
+            # Sorted so that the same files win when there are more matches than MAX_SOURCES
+            for match in sorted(glob.glob(os.path.join(ROOT_DIR, pattern))):
+                paths.append(resolve_path(match))
+        return [path for path in paths if path is not None and os.path.isfile(path)]
+
+    async def rescan(self):
         if not self.running:
             return
-        where = self.file.tell()
-        line = self.file.readline()
-        while line:
-            await self.write_message(line)
-            where = self.file.tell()
-            line = self.file.readline()
-        self.file.seek(where)
+        # History goes out first and is never dropped; merged, if merging, across all new files. Each file's
+        # history is read on an executor from a view taken as it is subscribed, and live events wait until
+        # it has been sent.
+        self.held = []
+        added = []
+        try:
+            found = await run_blocking("metadata", self.expand)
+            for abspath in set(self.sources) - set(found):
+                self.remove_source(abspath)
+            for abspath in found:
+                if abspath in self.sources:
+                    continue
+                if len(self.sources) >= MAX_SOURCES:
+                    break
+                source = await self.add_source(abspath)
+                if source is not None:
+                    added.append((source, source.watcher.view()))
+            if not added:
+                return
+            histories = [await run_blocking("read", view.history, self.history_lines) for _, view in added]
+            if not self.running:
+                return
+            self.replaying = True
+            for (source, _), runs in zip(added, histories):
+                if self.line_filter is None:
+                    runs = [runs]
+                for offset, data in runs:
+                    if data:
+                        self.on_source_data(source, offset, data, release=False)
+            if self.merger is not None:
+                self.merger.release(force=True)
+            for source, _ in added:
+                source.frames.flush()
+        except Exception as e:
+            self.send_message({"type": "error", "message": f"Error reading file history: {e}"})
+        finally:
+            for _, view in added:
+                view.close()
+            self.replaying = False
+            self.release_held()
+
+    async def add_source(self, abspath):
+        source = Source(os.path.relpath(abspath, ROOT_DIR), self)
+        try:
+            source.watcher = await tail_hub.subscribe(abspath, source, line_filter=self.line_filter,
+                                                      **tail_options(self.settings))
+        except Exception as e:
+            self.send_message({"type": "error", "source": source.name, "message": f"Cannot follow file: {e}"})
+            return None
+        if not self.running:
+            tail_hub.unsubscribe(source.watcher, source)
+            return None
+        source.file_id = source.watcher.identity
+        source.frames = self.make_frames(
+            lambda offset, data, end: self.send_source_frame(source, offset, data, end),
+            lambda offset, count: self.send_source_skipped(source, offset, count))
+        self.sources[abspath] = source
+        if self.merger is not None:
+            self.merger.add_source(source)
+        self.send_message({"type": "source", "source": source.name, "file": source.file_id})
+        return source
+
+    def remove_source(self, abspath):
+        # The file was deleted: what is queued for it goes out, then it stops holding up the merge
+        source = self.sources.pop(abspath)
+        if self.merger is not None:
+            self.merger.release(force=True)
+            self.merger.remove_source(source)
+        source.frames.flush()
+        source.frames.close()
+        tail_hub.unsubscribe(source.watcher, source)
+        source.watcher = None
+        self.send_message({"type": "removed", "source": source.name, "file": source.file_id})
+
+    def send_source_frame(self, source, offset, data, end):
+        STREAM_BYTES.inc(type(self).__name__, amount=len(data))
+        return self.send_message({
+            "type": "data",
+            "source": source.name,
+            "file": source.file_id,
+            "offset": offset,
+            "end": end,
+            "text": source.decoder.decode(data),
+        })
+
+    def send_source_skipped(self, source, offset, count):
+        STREAM_SKIPPED_BYTES.inc(type(self).__name__, amount=count)
+        source.decoder.reset()
+        self.send_message({"type": "skipped", "source": source.name, "file": source.file_id,
+                           "offset": offset, "count": count})
+
+    def on_source_data(self, source, offset, data, release=True):
+        if not self.running or source.watcher is None or (release and self.hold(self.on_source_data, source, offset, data)):
+            return
+        if self.merger is not None:
+            self.merger.add(source, offset, data, release=release)
+        else:
+            source.frames.push(offset, data, force=self.replaying)
+
+    def emit_merged(self, source, offset, data):
+        # Frames must leave in merge order, so nothing waits in a coalescer
+        source.frames.push(offset, data, force=self.replaying)
+        source.frames.flush()
+
+    def on_source_reset(self, source, reason):
+        if not self.running or source.watcher is None or self.hold(self.on_source_reset, source, reason):
+            return
+        if self.merger is not None:
+            self.merger.release(force=True)
+        source.frames.flush()
+        source.decoder.reset()
+        source.last_timestamp = b""
+        source.file_id = source.watcher.identity
+        self.send_message({"type": "reset", "source": source.name, "file": source.file_id, "reason": reason})
 
     def on_close(self):
         self.running = False
-        if hasattr(self, 'periodic'):
-            self.periodic.stop()
-        if hasattr(self, 'file'):
-            self.file.close()
+        if getattr(self, 'rescanner', None) is not None:
+            self.rescanner.stop()
+        if getattr(self, 'merger', None) is not None:
+            self.merger.close()
+        for source in getattr(self, 'sources', {}).values():
+            source.frames.close()
+            tail_hub.unsubscribe(source.watcher, source)
+        self.sources = {}
+
+class DirectoryWatchHandler(WebSocketBase):
+    """Pushes changes to one directory's listing as JSON event batches."""
+
+    async def open(self, path):
+        self.watcher = None
+        self.running = True
+        if not self.current_user:
+            self.close()
+            return
+        abspath = resolve_path(path)
+        if abspath is None or not await run_blocking("metadata", os.path.isdir, abspath):
+            self.write_message(json.dumps({"type": "error", "message": "Not a directory"}))
+            self.close()
+            return
+        # All viewers of a directory share one watcher
+        try:
+            watcher = await directory_hub.subscribe(
+                abspath, self,
+                delay=self.settings.get("directory_batch_delay", DEFAULT_BATCH_DELAY),
+                interval=self.settings.get("directory_poll_interval", DEFAULT_DIRECTORY_POLL_INTERVAL),
+                backend=self.settings.get("tail_backend", "auto"))
+        except (OSError, ExecutorBusy) as e:
+            self.write_message(json.dumps({"type": "error", "message": f"Cannot watch directory: {e}"}))
+            self.close()
+            return
+        if not self.running:
+            # Closed while the watcher was being set up
+            directory_hub.unsubscribe(watcher, self)
+            return
+        self.watcher = watcher
+
+    def on_directory_events(self, events):
+        try:
+            self.write_message(json.dumps({"type": "events", "events": events}))
+        except tornado.websocket.WebSocketClosedError:
+            self.on_close()
+
+    def on_close(self):
+        self.running = False
+        if self.watcher is not None:
+            directory_hub.unsubscribe(self.watcher, self)
+            self.watcher = None
 
+@tornado.web.stream_request_body
 class UploadHandler(BaseHandler):
-    @tornado.web.authenticated
-    def post(self):
-        directory = self.get_argument("directory", "")
-        file_infos = self.request.files.get('files', [])
-        
-        # This handles the single-file upload from the button
-        if not file_infos:
-            file_info = self.request.files.get('file', [])[0]
-            filename = file_info['filename']
-            upload_path = os.path.join(ROOT_DIR, directory)
-            if not os.path.abspath(upload_path).startswith(ROOT_DIR):
-                self.set_status(403)
-                self.write("Forbidden")
-                return
-            os.makedirs(upload_path, exist_ok=True)
-            with open(os.path.join(upload_path, filename), 'wb') as f:
-                f.write(file_info['body'])
-            self.redirect("/" + directory)
+    # Number of upload requests currently streaming a body, shared by all handlers
+    active_uploads = 0
+
+    def prepare(self):
+        self.counted = False
+        self.parts = []
+        self.pending = []
+        self.write_lock = tornado.locks.Lock()
+        self.current = None
+        self.error = None
+        self.form_upload = False
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        if UploadHandler.active_uploads >= self.settings.get("max_concurrent_uploads", MAX_CONCURRENT_UPLOADS):
+            raise tornado.web.HTTPError(503, reason="Too many concurrent uploads")
+        UploadHandler.active_uploads += 1
+        self.counted = True
+
+        self.request.connection.set_max_body_size(
+            self.settings.get("max_upload_request_size", MAX_UPLOAD_REQUEST_SIZE))
+        self.max_file_size = self.settings.get("max_upload_file_size")
+        try:
+            boundary = get_boundary(self.request.headers.get("Content-Type", ""))
+        except MultipartError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        # The target directory may come from the query string or from a form
+        # field that precedes the file parts
+        self.directory = self.get_query_argument("directory", "")
+        self.parser = MultipartParser(boundary, self.on_part_begin, self.on_part_data, self.on_part_end)
+
+    async def data_received(self, chunk):
+        UPLOAD_BYTES.inc("multipart", amount=len(chunk))
+        try:
+            self.parser.feed(chunk)
+        except MultipartError as e:
+            self.fail(400, str(e))
+        # Tornado waits for this before reading more of the body, so a slow disk slows the upload down
+        await self.write_pending()
+
+    async def write_pending(self):
+        # File operations queued by the parser callbacks, run in order on the write executor
+        async with self.write_lock:
+            while self.pending:
+                operations, self.pending = self.pending, []
+                try:
+                    await run_blocking("write", run_all, operations)
+                except tornado.web.HTTPError as e:
+                    await self.abort_parts(e.status_code, e.reason)
+                except OSError as e:
+                    await self.abort_parts(500, f"Could not store the upload: {e.strerror or e}")
+
+    async def abort_parts(self, status, message):
+        # The rest of the failed batch never ran, so no part still being written can complete
+        self.fail(status, message)
+        self.pending.clear()
+        unfinished = [functools.partial(discard_part, part) for part in self.parts if not part["done"]]
+        with contextlib.suppress(OSError, tornado.web.HTTPError):
+            await run_blocking("write", run_all, unfinished)
+
+    def fail(self, status, message):
+        if self.error is None:
+            self.error = (status, message)
+        self.discard_current()
+
+    def on_part_begin(self, headers):
+        name, filename = parse_disposition(headers)
+        if filename is None:
+            self.current = {"field": name, "body": bytearray()}
             return
+        if self.error or not filename or name not in ("file", "files"):
+            self.current = {"skip": True}
+            return
+        # 'file' is the single-file form upload, 'files' carries relative paths from drag-and-drop
+        if name == "file":
+            self.form_upload = True
+            filename = os.path.basename(filename)
+        directory = resolve_path(self.directory)
+        final_path = resolve_path(filename, directory) if directory else None
+        if final_path is None or final_path == directory:
+            self.fail(403, f"Forbidden path: {filename}")
+            self.current = {"skip": True}
+            return
+        self.current = part = {"path": final_path, "temp": None, "file": None, "size": 0, "done": False}
+        self.parts.append(part)
+        self.pending.append(lambda: open_part(part))
 
-        # This handles the drag-and-drop upload
-        for file_info in file_infos:
-            relative_path = file_info['filename']
-            file_body = file_info['body']
-            
-            # Sanitize the relative path to prevent directory traversal
-            # and ensure it's a safe path
-            final_path = os.path.join(ROOT_DIR, directory, relative_path)
-            final_path_abs = os.path.abspath(final_path)
-
-            if not final_path_abs.startswith(os.path.abspath(os.path.join(ROOT_DIR, directory))):
-                self.set_status(403)
-                self.write(f"Forbidden path: {relative_path}")
-                return
+    def on_part_data(self, data):
+        part = self.current
+        if part is None or part.get("skip"):
+            return
+        if "field" in part:
+            part["body"] += data
+            if len(part["body"]) > MAX_FIELD_SIZE:
+                self.fail(400, "Form field too large")
+            return
+        part["size"] += len(data)
+        if self.max_file_size is not None and part["size"] > self.max_file_size:
+            self.fail(413, f"File exceeds the {self.max_file_size} byte limit: {os.path.basename(part['path'])}")
+            return
+        self.pending.append(lambda: part["file"].write(data))
 
-            os.makedirs(os.path.dirname(final_path_abs), exist_ok=True)
-            
-            with open(final_path_abs, 'wb') as f:
-                f.write(file_body)
-        
+    def on_part_end(self):
+        part, self.current = self.current, None
+        if part is None or part.get("skip"):
+            return
+        if "field" in part:
+            if part["field"] == "directory":
+                self.directory = part["body"].decode("utf-8", errors="replace")
+            return
+        self.pending.append(lambda: close_part(part))
+
+    def discard_current(self):
+        part, self.current = self.current, {"skip": True}
+        if part and "temp" in part:
+            self.pending.append(lambda: discard_part(part))
+            tornado.ioloop.IOLoop.current().add_callback(self.write_pending)
+
+    def release(self):
+        if self.counted:
+            self.counted = False
+            UploadHandler.active_uploads -= 1
+
+    def on_finish(self):
+        self.discard_current()
+        self.release()
+
+    def on_connection_close(self):
+        self.discard_current()
+        self.release()
+
+    async def post(self):
+        await self.write_pending()
+        updates = [functools.partial(index_changed, "add", part["path"]) for part in self.parts if part["done"]]
+        if updates:
+            await run_blocking("metadata", run_all, updates)
+        if self.error is None and not self.parser.finished:
+            self.fail(400, "Multipart body ended before the closing boundary")
+        if self.error:
+            status, message = self.error
+            self.set_status(status)
+            self.write(message)
+            return
+        if self.form_upload:
+            # The single-file form expects to land back on the directory listing
+            self.redirect("/" + self.directory)
+            return
         self.set_status(200)
         self.write("Upload successful")
 
-class DeleteHandler(BaseHandler):
+def open_part(part):
+    target_dir = os.path.dirname(part["path"])
+    os.makedirs(target_dir, exist_ok=True)
+    # Spool into a hidden temp file next to the target so completion is an atomic rename
+    fd, part["temp"] = tempfile.mkstemp(dir=target_dir, prefix="." + os.path.basename(part["path"]) + ".",
+                                        suffix=".upload")
+    part["file"] = os.fdopen(fd, "wb")
+
+def close_part(part):
+    part["file"].close()
+    os.replace(part["temp"], part["path"])
+    part["done"] = True
+
+def discard_part(part):
+    if part["file"] is not None and not part["file"].closed:
+        part["file"].close()
+    if part["temp"] is not None and not part["done"]:
+        with contextlib.suppress(OSError):
+            os.remove(part["temp"])
+
+def run_all(operations):
+    for operation in operations:
+        operation()
+
+async def load_upload_session(handler, session_id):
+    state_dir = handler.settings.get("upload_state_dir") or default_state_dir()
+    try:
+        return await run_blocking("write", UploadSession.load, state_dir, session_id)
+    except UploadSessionError as e:
+        raise tornado.web.HTTPError(e.status, reason=str(e))
+
+class UploadSessionsHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        path = self.get_argument("path", "")
-        abspath = os.path.abspath(os.path.join(ROOT_DIR, path))
-        root = ROOT_DIR
-        if not abspath.startswith(root):
+    async def post(self):
+        directory = self.get_argument("directory", "")
+        relative_path = self.get_argument("path")
+        try:
+            size = int(self.get_argument("size"))
+            chunk_size = int(self.get_argument("chunk_size", str(DEFAULT_UPLOAD_CHUNK_SIZE)))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="size and chunk_size must be integers")
+        max_file_size = self.settings.get("max_upload_file_size")
+        if max_file_size is not None and size > max_file_size:
+            raise tornado.web.HTTPError(413, reason=f"File exceeds the {max_file_size} byte limit")
+        dir_abspath = resolve_path(directory)
+        final_path = resolve_path(relative_path, dir_abspath) if dir_abspath else None
+        if final_path is None or final_path == dir_abspath:
             self.set_status(403)
-            self.write("Forbidden")
+            self.write(f"Forbidden path: {relative_path}")
             return
-        if os.path.isdir(abspath):
-            shutil.rmtree(abspath)
-        elif os.path.isfile(abspath):
-            os.remove(abspath)
-        parent = os.path.dirname(path)
-        self.redirect("/" + parent if parent else "/")
+        state_dir = self.settings.get("upload_state_dir") or default_state_dir()
+        await run_blocking("write", expire_sessions, state_dir)
+        try:
+            session = await run_blocking("write", UploadSession.create, state_dir, final_path, size, chunk_size)
+        except UploadSessionError as e:
+            raise tornado.web.HTTPError(e.status, reason=str(e))
+        self.set_status(201)
+        self.write(await run_blocking("write", session.status))
 
-class RenameHandler(BaseHandler):
+class UploadSessionHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        path = self.get_argument("path", "")
-        new_name = self.get_argument("new_name", "")
-        abspath = os.path.abspath(os.path.join(ROOT_DIR, path))
-        new_abspath = os.path.abspath(os.path.join(ROOT_DIR, os.path.dirname(path), new_name))
-        root = ROOT_DIR
-        if not (abspath.startswith(root) and new_abspath.startswith(root)):
+    async def get(self, session_id):
+        session = await load_upload_session(self, session_id)
+        self.write(await run_blocking("write", session.status))
+
+    @tornado.web.authenticated
+    async def delete(self, session_id):
+        session = await load_upload_session(self, session_id)
+        await run_blocking("write", session.discard)
+        self.set_status(204)
+
+@tornado.web.stream_request_body
+class UploadChunkHandler(BaseHandler):
+    async def prepare(self):
+        self.fd = None
+        self.write_lock = tornado.locks.Lock()
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        session_id, index = self.path_args
+        self.session = await load_upload_session(self, session_id)
+        try:
+            self.start, self.end = self.session.chunk_range(int(index))
+        except UploadSessionError as e:
+            raise tornado.web.HTTPError(e.status, reason=str(e))
+        self.offset = self.start
+        self.request.connection.set_max_body_size(self.end - self.start)
+        self.fd = await run_blocking("write", self.session.open_chunk)
+
+    async def data_received(self, chunk):
+        UPLOAD_BYTES.inc("chunked", amount=len(chunk))
+        # Write straight to the chunk's offset in the preallocated file; nothing is re-copied on finalize
+        offset, self.offset = self.offset, self.offset + len(chunk)
+        async with self.write_lock:
+            if self.fd is not None:
+                await run_blocking("write", os.pwrite, self.fd, chunk, offset)
+
+    async def put(self, session_id, index):
+        await self.close_chunk()
+        if self.offset != self.end:
+            raise tornado.web.HTTPError(400, reason=f"Expected {self.end - self.start} bytes for chunk {index}")
+        await run_blocking("write", self.session.record_chunk, int(index))
+        self.set_status(204)
+
+    async def close_chunk(self):
+        # Not while a write is still using the descriptor
+        async with self.write_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def on_finish(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.close_chunk)
+
+    def on_connection_close(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.close_chunk)
+
+class UploadFinalizeHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self, session_id):
+        sha256 = self.get_argument("sha256", None)
+        try:
+            session = await load_upload_session(self, session_id)
+        except tornado.web.HTTPError as e:
+            # A retry of a finalize that already succeeded (its response may have been lost) gets the same answer
+            state_dir = self.settings.get("upload_state_dir") or default_state_dir()
+            record = await run_blocking("write", UploadSession.completed, state_dir, session_id)
+            if e.status_code != 404 or record is None:
+                raise
+            if sha256 and record["sha256"] and sha256.lower() != record["sha256"]:
+                raise tornado.web.HTTPError(422, reason="Checksum mismatch")
+            self.write({"path": os.path.relpath(record["path"], ROOT_DIR)})
+            return
+        try:
+            await run_blocking("write", session.finalize, sha256)
+        except UploadSessionError as e:
+            raise tornado.web.HTTPError(e.status, reason=str(e))
+        await run_blocking("metadata", index_changed, "add", session.path)
+        self.write({"path": os.path.relpath(session.path, ROOT_DIR)})
+
+@tornado.web.stream_request_body
+class DeltaHandler(BaseHandler):
+    """rsync-style updates: GET a file's block signature, then POST only the blocks that changed."""
+
+    @tornado.web.authenticated
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
             self.set_status(403)
             self.write("Forbidden")
             return
-        os.rename(abspath, new_abspath)
-        parent = os.path.dirname(path)
-        self.redirect("/" + parent if parent else "/")
+        if not await is_regular_file(abspath):
+            self.set_status(404)
+            self.write("File not found")
+            return
+        try:
+            block_size = int(self.get_argument("block_size", "0"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="block_size must be an integer")
+        cache_dir = self.settings.get("signature_cache_dir") or default_signature_cache_dir()
+        try:
+            # Unless it is cached, the signature hashes the whole file
+            signature = await run_blocking("scan", get_signature, abspath, block_size or None, cache_dir)
+        except DeltaError as e:
+            raise tornado.web.HTTPError(e.status, reason=str(e))
+        self.write(signature.to_json())
+
+    async def prepare(self):
+        self.applier = None
+        self.error = None
+        self.write_lock = tornado.locks.Lock()
+        if self.request.method != "POST":
+            return
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        abspath = resolve_path(self.path_args[0])
+        st = await run_blocking("metadata", stat_or_none, abspath) if abspath is not None else None
+        if abspath is None or abspath == ROOT_DIR or (st is not None and stat.S_ISDIR(st.st_mode)):
+            raise tornado.web.HTTPError(403, reason="Forbidden path")
+        try:
+            size = int(self.get_argument("size"))
+            block_size = int(self.get_argument("block_size"))
+            base_size = self.get_argument("base_size", None)
+            # Without a base the file is new (or replaced without looking at it) and the delta is all literal data
+            base = (int(base_size), int(self.get_argument("base_mtime_ns"))) if base_size is not None else None
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="size, block_size, base_size and base_mtime_ns must be integers")
+        max_file_size = self.settings.get("max_upload_file_size")
+        if max_file_size is not None and size > max_file_size:
+            raise tornado.web.HTTPError(413, reason=f"File exceeds the {max_file_size} byte limit")
+        self.size = size
+        self.request.connection.set_max_body_size(
+            self.settings.get("max_upload_request_size", MAX_UPLOAD_REQUEST_SIZE))
+        cache_dir = self.settings.get("signature_cache_dir") or default_signature_cache_dir()
+        try:
+            self.applier = await run_blocking("write", DeltaApplier, abspath, block_size, base, cache_dir, size)
+        except DeltaError as e:
+            raise tornado.web.HTTPError(e.status, reason=str(e))
+
+    async def data_received(self, chunk):
+        UPLOAD_BYTES.inc("delta", amount=len(chunk))
+        # Copies from the old file and literal data are written in order, on the write executor
+        async with self.write_lock:
+            if self.applier is not None:
+                try:
+                    await run_blocking("write", self.applier.feed, chunk)
+                except DeltaError as e:
+                    # Reported once the body is in; the rest of it is ignored
+                    self.error = e
+                    self.discard()
+                    self.applier = None
+
+    async def post(self, path):
+        async with self.write_lock:
+            if self.error is not None:
+                raise tornado.web.HTTPError(self.error.status, reason=str(self.error))
+            try:
+                result = await run_blocking("write", self.applier.finish, self.size, self.get_argument("sha256", None))
+            except DeltaError as e:
+                raise tornado.web.HTTPError(e.status, reason=str(e))
+            finally:
+                self.discard()
+        await run_blocking("metadata", index_changed, "add", self.applier.path)
+        result["path"] = os.path.relpath(self.applier.path, ROOT_DIR)
+        self.write(result)
+
+    def discard(self):
+        if self.applier is not None:
+            self.applier.discard()
+
+    def on_finish(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.discard_when_idle)
+
+    def on_connection_close(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.discard_when_idle)
+
+    async def discard_when_idle(self):
+        # Not while a write is still using the temp file
+        async with self.write_lock:
+            self.discard()
+
+def index_changed(method, *paths):
+    # Keep the search index (if one has been built) in step with changes made through filey. This takes the
+    # index lock, which a compaction holds throughout, so it is called from job threads or an executor.
+    index = current_path_index(ROOT_DIR)
+    if index is not None:
+        getattr(index, method)(*paths)
+
+class SearchHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self):
+        query = self.get_argument("q", "")
+        if not query.strip():
+            raise tornado.web.HTTPError(400, reason="q is required")
+        try:
+            limit = int(self.get_argument("limit", str(DEFAULT_SEARCH_LIMIT)))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="limit must be an integer")
+        index = get_path_index(ROOT_DIR, self.settings.get("search_rescan_interval", DEFAULT_SEARCH_RESCAN_INTERVAL))
+        # Waits for the index lock, which a compaction holds while it rebuilds everything
+        self.write(await run_blocking("metadata", index.search, query, limit))
+
+class SearchStatsHandler(BaseHandler):
+    @tornado.web.authenticated
+    def get(self):
+        index = current_path_index(ROOT_DIR)
+        self.write(index.stats() if index is not None else {"complete": False, "entries": 0})
+
+class ArchiveHandler(BaseHandler):
+    """Streams a directory as a zip, tar or tar.gz archive generated on the fly."""
+
+    @tornado.web.authenticated
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
+            raise tornado.web.HTTPError(403)
+        kind = self.get_argument("format", "zip")
+        if kind not in ARCHIVE_FORMATS:
+            raise tornado.web.HTTPError(400, reason=f"format must be one of {', '.join(ARCHIVE_FORMATS)}")
+        st = await run_blocking("metadata", stat_or_none, abspath)
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            raise tornado.web.HTTPError(404)
+        content_type, extension = ARCHIVE_FORMATS[kind]
+        self.set_header("Content-Type", content_type)
+        self.set_header("Content-Disposition", f'attachment; filename="{os.path.basename(abspath)}{extension}"')
+        self.closed = False
+        self.buffered = 0
+        self.chunk_size = self.settings.get("archive_chunk_size", DEFAULT_ARCHIVE_CHUNK_SIZE)
+        writer = make_writer(kind, store=self.get_argument("store", None) == "1")
+        entries = iter_tree(abspath)
+        try:
+            while not self.closed:
+                batch = await run_blocking("read", take, entries, 256)
+                if not batch:
+                    break
+                for entry_path, name, entry_st in batch:
+                    if stat.S_ISDIR(entry_st.st_mode):
+                        await self.send(writer.add_directory(name, entry_st))
+                    elif stat.S_ISLNK(entry_st.st_mode):
+                        target = await run_blocking("read", os.readlink, entry_path)
+                        await self.send(writer.add_symlink(name, entry_st, target))
+                    elif stat.S_ISREG(entry_st.st_mode):
+                        await self.send_entry(writer, entry_path, name, entry_st)
+                    if self.closed:
+                        return
+            # A zip's central directory is one record per entry; build it off the IOLoop too
+            pieces = writer.close()
+            while (data := await run_blocking("read", next, pieces, None)) is not None:
+                await self.send(data)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    async def send_entry(self, writer, path, name, st):
+        try:
+            fd = await run_blocking("read", os.open, path, os.O_RDONLY)
+        except OSError:
+            # Unreadable files are left out rather than failing the whole archive
+            return
+        try:
+            await self.send(writer.begin_file(name, st))
+            for offset in range(0, st.st_size, self.chunk_size):
+                size = min(self.chunk_size, st.st_size - offset)
+                await self.send(await run_blocking("read", read_entry, writer, fd, offset, size))
+                if self.closed:
+                    return
+            await self.send(writer.end_file())
+        finally:
+            os.close(fd)
+
+    async def send(self, data):
+        # Headers of small entries are batched; the socket is drained once a chunk has accumulated
+        self.write(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.buffered = 0
+            await self.flush()
+
+    def on_connection_close(self):
+        self.closed = True
+
+class StatsHandler(BaseHandler):
+    @tornado.web.authenticated
+    def get(self):
+        self.write({"executors": executors.stats()})
+
+class MetricsHandler(BaseHandler):
+    """Prometheus metrics; scrapers authenticate with ``Authorization: Bearer <token>``."""
+
+    def get(self):
+        authorization = self.request.headers.get("Authorization", "")
+        bearer = authorization[7:] if authorization.startswith("Bearer ") else ""
+        # compare_digest only takes ASCII str, so compare bytes; headers may hold anything
+        token_ok = bool(bearer) and ACCESS_TOKEN is not None and secrets.compare_digest(
+            bearer.encode("utf-8"), ACCESS_TOKEN.encode("utf-8"))
+        if not self.current_user and not token_ok:
+            raise tornado.web.HTTPError(403)
+        metrics_dir = self.settings.get("metrics_dir")
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(registry.render(read_published(metrics_dir) if metrics_dir else []))
+
+registry.gauge("filey_uploads_active", "Upload requests currently streaming a body.",
+               collect=lambda: {(): UploadHandler.active_uploads})
+registry.gauge("filey_searches_active", "Content searches currently running.",
+               collect=lambda: {(): GrepHandler.active_searches})
+
+class GrepHandler(BaseHandler):
+    """Searches file contents under a directory, streaming matches as newline-delimited JSON."""
+
+    # Number of searches currently running, shared by all handlers
+    active_searches = 0
+
+    @tornado.web.authenticated
+    async def get(self, path):
+        abspath = resolve_path(path)
+        if abspath is None:
+            raise tornado.web.HTTPError(403)
+        st = await run_blocking("metadata", stat_or_none, abspath)
+        if st is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            pattern, flags = compile_pattern(self.get_argument("q"), regex=self.get_argument("regex", None) == "1",
+                                             ignore_case=self.get_argument("ignore_case", None) == "1")
+            max_size = self.get_argument("max_size", None)
+            max_size = int(max_size) if max_size is not None else None
+            max_matches = int(self.get_argument("max_matches", str(DEFAULT_MAX_MATCHES)))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        if GrepHandler.active_searches >= self.settings.get("max_concurrent_searches", MAX_CONCURRENT_SEARCHES):
+            raise tornado.web.HTTPError(503, reason="Too many concurrent searches")
+        GrepHandler.active_searches += 1
+        try:
+            await self.search(abspath, stat.S_ISDIR(st.st_mode), pattern, flags, self.get_argument("glob", None),
+                              max_size, max_matches)
+        finally:
+            GrepHandler.active_searches -= 1
+
+    async def search(self, abspath, is_dir, pattern, flags, name_glob, max_size, max_matches):
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.cancelled = False
+        pool = get_pool(self.settings.get("grep_workers"))
+        # Keep every worker busy without queueing the whole tree in the pool
+        max_in_flight = pool.workers * 2
+        files = iter_files(abspath, name_glob, max_size) if is_dir else iter([abspath])
+        batch = []
+        in_flight = set()
+        scanned = matched = 0
+        exhausted = truncated = broken = sent = False
+        while not self.cancelled and not broken and matched < max_matches:
+            try:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    if not batch:
+                        # Walking the tree is blocking I/O too
+                        batch = await run_blocking("read", take, files, 256)
+                        exhausted = not batch
+                        continue
+                    future = pool.submit(scan_file, batch[0], pattern, flags)
+                    batch.pop(0)
+                    in_flight.add(asyncio.wrap_future(future))
+                if not in_flight:
+                    break
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                results = [future.result() for future in done]
+            except BrokenProcessPool:
+                # A worker died (killed, out of memory); nothing more can run in this pool
+                replace_broken_pool(pool)
+                broken = True
+                break
+            lines = []
+            for result in results:
+                scanned += 1
+                if result is None or matched >= max_matches:
+                    continue
+                truncated = truncated or result["truncated"]
+                relpath = os.path.relpath(result["path"], ROOT_DIR)
+                for line, text in result["matches"][:max_matches - matched]:
+                    lines.append(json.dumps({"path": relpath, "line": line, "text": text}))
+                    matched += 1
+            if lines and not self.cancelled:
+                self.write("\n".join(lines) + "\n")
+                sent = True
+                try:
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    self.cancelled = True
+        for future in in_flight:
+            future.cancel()
+        if broken and not sent:
+            raise tornado.web.HTTPError(503, reason="Search workers failed")
+        if not self.cancelled:
+            summary = {"done": True, "files_scanned": scanned, "matches": matched,
+                       "truncated": truncated or matched >= max_matches}
+            if broken:
+                summary["error"] = "Search workers failed"
+            self.write(json.dumps(summary) + "\n")
+
+    def on_connection_close(self):
+        self.cancelled = True
+
+async def start_job(handler, kind, operation, args, source, target=None, on_done=None):
+    # With a state directory, submitting expires old status files and publishes the new job's
+    job = await run_blocking("metadata", job_manager.submit, kind, operation, args, source, target, on_done)
+    handler.set_status(202)
+    handler.set_header("Location", f"/jobs/{job.id}")
+    handler.write(job.status())
+
+async def resolve_source(handler):
+    # The existing entry named by the ``path`` argument; never the root itself
+    path = handler.get_argument("path", "")
+    abspath = resolve_path(path)
+    if abspath is None or abspath == ROOT_DIR:
+        raise tornado.web.HTTPError(403)
+    if not await run_blocking("metadata", os.path.lexists, abspath):
+        raise tornado.web.HTTPError(404)
+    return path, abspath
+
+async def check_target(source, target):
+    if target is None or target == ROOT_DIR:
+        raise tornado.web.HTTPError(403)
+    if await run_blocking("metadata", os.path.lexists, target):
+        raise tornado.web.HTTPError(409, reason="Target already exists")
+    if os.path.commonpath([source, target]) == source:
+        raise tornado.web.HTTPError(400, reason="Cannot copy or move a directory into itself")
+
+class DeleteHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        path, abspath = await resolve_source(self)
+        await start_job(self, "delete", remove_tree, (abspath,), path,
+                  on_done=lambda: index_changed("remove", abspath))
+
+class RenameHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        path, abspath = await resolve_source(self)
+        new_name = self.get_argument("new_name")
+        new_abspath = resolve_path(new_name, os.path.dirname(abspath))
+        if new_abspath is not None and os.path.dirname(new_abspath) != os.path.dirname(abspath):
+            raise tornado.web.HTTPError(400, reason="new_name must be a plain name")
+        await check_target(abspath, new_abspath)
+        # A rename on a network mount can take as long as a copy
+        await start_job(self, "rename", move, (abspath, new_abspath), path, os.path.relpath(new_abspath, ROOT_DIR),
+                  on_done=lambda: index_changed("rename", abspath, new_abspath))
+
+class TransferHandler(BaseHandler):
+    """Copies or moves an entry into another directory as a background job."""
+
+    def initialize(self, kind):
+        self.kind = kind
+
+    @tornado.web.authenticated
+    async def post(self):
+        path, abspath = await resolve_source(self)
+        destination = resolve_path(self.get_argument("destination", ""))
+        if destination is None:
+            raise tornado.web.HTTPError(403)
+        if not await run_blocking("metadata", os.path.isdir, destination):
+            raise tornado.web.HTTPError(404, reason="Destination is not a directory")
+        target = os.path.join(destination, os.path.basename(abspath))
+        await check_target(abspath, target)
+        if self.kind == "copy":
+            operation, on_done = copy_tree, lambda: index_changed("add", target)
+        else:
+            # Across filesystems this becomes a chunked copy followed by a delete
+            operation, on_done = move, lambda: index_changed("rename", abspath, target)
+        await start_job(self, self.kind, operation, (abspath, target), path, os.path.relpath(target, ROOT_DIR), on_done)
+
+async def get_job(job_id):
+    # Jobs of other workers, and the status of any job, are read from the state directory if there is one
+    job = await run_blocking("metadata", job_manager.get, job_id)
+    if job is None:
+        raise tornado.web.HTTPError(404)
+    return job
+
+class JobsHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self):
+        self.write({"jobs": await run_blocking("metadata", job_manager.list)})
+
+class JobHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, job_id):
+        job = await get_job(job_id)
+        self.write(await run_blocking("metadata", job.status))
+
+class JobCancelHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self, job_id):
+        job = await get_job(job_id)
+        await run_blocking("metadata", job.cancel)
+        self.write(await run_blocking("metadata", job.status))
+
+class JobEventsHandler(WebSocketBase):
+    """Sends a job's status whenever it changes, until the job has finished."""
+
+    async def open(self, job_id):
+        self.periodic = None
+        self.running = True
+        if not self.current_user:
+            self.close()
+            return
+        self.job = await run_blocking("metadata", job_manager.get, job_id)
+        if self.job is None:
+            self.write_message(json.dumps({"type": "error", "message": "No such job"}))
+            self.close()
+            return
+        if not self.running:
+            return
+        self.last = None
+        # The job runs in a worker thread, so its progress is sampled rather than pushed
+        self.periodic = tornado.ioloop.PeriodicCallback(
+            self.send_status, self.settings.get("job_progress_interval", DEFAULT_JOB_PROGRESS_INTERVAL))
+        self.periodic.start()
+        await self.send_status()
+
+    async def send_status(self):
+        # Another worker's job is read from its status file
+        status = await run_blocking("metadata", self.job.status)
+        if self.periodic is None:
+            return
+        if status != self.last:
+            self.last = status
+            try:
+                self.write_message(json.dumps({"type": "status", **status}))
+            except tornado.websocket.WebSocketClosedError:
+                self.on_close()
+                return
+        if status["state"] in ("done", "failed", "cancelled"):
+            self.on_close()
+            self.close()
+
+    def on_close(self):
+        self.running = False
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+def log_request(handler):
+    # Tornado's access log line, plus the request metrics
+    status = handler.get_status()
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    request = handler.request
+    log_method("%d %s %s (%s) %.2fms", status, request.method, request.uri, request.remote_ip,
+               1000.0 * request.request_time())
+    record_request(handler)
+
 
 def make_app(settings):
     # Add template_path to settings
     settings["template_path"] = os.path.join(os.path.dirname(__file__), "templates")
+    transforms = []
+    if settings.get("compression", True):
+        transforms.append(functools.partial(CompressionTransform, levels=settings.get("compression_levels")))
+    transforms.append(ResponseSizeTransform)
+    settings.setdefault("log_function", log_request)
     return tornado.web.Application([
         (r"/login", LoginHandler),
         (r"/stream/(.*)", FileStreamHandler),
+        (r"/multistream", MultiStreamHandler),
+        (r"/watch/(.*)", DirectoryWatchHandler),
+        (r"/window/(.*)", WindowHandler),
+        (r"/lines/(.*)", LinesHandler),
         (r"/upload", UploadHandler),
+        (r"/upload/sessions", UploadSessionsHandler),
+        (r"/upload/sessions/([0-9a-f]+)", UploadSessionHandler),
+        (r"/upload/sessions/([0-9a-f]+)/chunks/([0-9]+)", UploadChunkHandler),
+        (r"/upload/sessions/([0-9a-f]+)/finalize", UploadFinalizeHandler),
+        (r"/delta/(.*)", DeltaHandler),
+        (r"/search", SearchHandler),
+        (r"/search/stats", SearchStatsHandler),
+        (r"/grep/(.*)", GrepHandler),
+        (r"/archive/(.*)", ArchiveHandler),
+        (r"/stats", StatsHandler),
+        (r"/metrics", MetricsHandler),
         (r"/delete", DeleteHandler),
         (r"/rename", RenameHandler),
+        (r"/copy", TransferHandler, {"kind": "copy"}),
+        (r"/move", TransferHandler, {"kind": "move"}),
+        (r"/jobs", JobsHandler),
+        (r"/jobs/([0-9a-f]+)", JobHandler),
+        (r"/jobs/([0-9a-f]+)/cancel", JobCancelHandler),
+        (r"/jobs/([0-9a-f]+)/events", JobEventsHandler),
         (r"/(.*)", MainHandler),
-    ], **settings)
+    ], transforms=transforms, **settings)
+
+
+def load_config(path):
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def configure(config):
+    """Apply a parsed config file and return the application settings for it."""
+    settings = {
+        "cookie_secret": config.get("cookie_secret") or os.environ.get("WB_COOKIE_SECRET") or ACCESS_TOKEN,
+        "login_url": "/login",
+        "download_chunk_size": config.get("download_chunk_size", DEFAULT_CHUNK_SIZE),
+        "max_upload_file_size": config.get("max_upload_file_size"),
+        "max_upload_request_size": config.get("max_upload_request_size", MAX_UPLOAD_REQUEST_SIZE),
+        "max_concurrent_uploads": config.get("max_concurrent_uploads", MAX_CONCURRENT_UPLOADS),
+        "upload_state_dir": config.get("upload_state_dir"),
+        "view_window_size": config.get("view_window_size", DEFAULT_WINDOW_SIZE),
+        "listing_page_size": config.get("listing_page_size", DEFAULT_PAGE_SIZE),
+        "index_cache_dir": config.get("index_cache_dir"),
+        "signature_cache_dir": config.get("signature_cache_dir"),
+        "tail_buffer_size": config.get("tail_buffer_size", DEFAULT_TAIL_BUFFER_SIZE),
+        "tail_backend": config.get("tail_backend", "auto"),
+        "tail_poll_interval": config.get("tail_poll_interval", DEFAULT_TAIL_POLL_INTERVAL),
+        "stream_frame_size": config.get("stream_frame_size", DEFAULT_FRAME_SIZE),
+        "stream_frame_delay": config.get("stream_frame_delay", DEFAULT_FRAME_DELAY),
+        "stream_high_water": config.get("stream_high_water", DEFAULT_HIGH_WATER),
+        "stream_compression": config.get("stream_compression", False),
+        "multistream_merge_delay": config.get("multistream_merge_delay", DEFAULT_MERGE_DELAY),
+        "multistream_rescan_interval": config.get("multistream_rescan_interval", DEFAULT_RESCAN_INTERVAL),
+        "directory_batch_delay": config.get("directory_batch_delay", DEFAULT_BATCH_DELAY),
+        "directory_poll_interval": config.get("directory_poll_interval", DEFAULT_DIRECTORY_POLL_INTERVAL),
+        "search_rescan_interval": config.get("search_rescan_interval", DEFAULT_SEARCH_RESCAN_INTERVAL),
+        "grep_workers": config.get("grep_workers"),
+        "max_concurrent_searches": config.get("max_concurrent_searches", MAX_CONCURRENT_SEARCHES),
+        "job_progress_interval": config.get("job_progress_interval", DEFAULT_JOB_PROGRESS_INTERVAL),
+        "archive_chunk_size": config.get("archive_chunk_size", DEFAULT_ARCHIVE_CHUNK_SIZE),
+        "compression": config.get("compression", True),
+        "compression_levels": config.get("compression_levels", {}),
+        "stall_threshold": config.get("stall_threshold", DEFAULT_STALL_THRESHOLD),
+    }
+    executors.configure(config.get("executors", {}))
+    if config.get("compression_cache_dir"):
+        settings["compression_cache"] = PrecompressedCache(
+            config["compression_cache_dir"],
+            config.get("compression_cache_size", DEFAULT_COMPRESSION_CACHE_SIZE),
+            config.get("compression_cache_min_size", DEFAULT_COMPRESSION_CACHE_MIN_SIZE))
+    workers = config.get("workers", 1)
+    # Jobs must be visible from whichever worker the next request lands on
+    job_manager.configure(config.get("job_state_dir") or (default_job_state_dir() if workers > 1 else None))
+    return settings
+
+
+async def serve(sockets, settings, search_index=True, drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+    """Serve on already-bound sockets until SIGTERM or SIGINT, then drain and return."""
+    app = make_app(settings)
+    tracker = RequestTracker(app)
+    server = tornado.httpserver.HTTPServer(tracker)
+    server.add_sockets(sockets)
+    if search_index:
+        # Build the filename index in the background so the first search does not wait for it
+        get_path_index(ROOT_DIR, settings["search_rescan_interval"])
+    if settings.get("stall_threshold"):
+        StallDetector(settings["stall_threshold"]).start()
+    metrics_dir = settings.get("metrics_dir")
+    if metrics_dir:
+        # Every worker's /metrics includes the others' published counters
+        tornado.ioloop.PeriodicCallback(lambda: registry.publish(metrics_dir), METRICS_PUBLISH_INTERVAL * 1000).start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    deadline = loop.time() + drain_timeout
+    for websocket in list(open_websockets):
+        # 1012 "service restart": the pages reconnect, reaching another worker
+        websocket.close(1012, "Server restarting")
+    await drain(server, tracker, drain_timeout)
+    # Jobs are in-flight work too; cancelled ones still clean up their partial copies
+    while job_manager.active() and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    for job in job_manager.active():
+        job.cancel()
+    while job_manager.active() and loop.time() < deadline + 5:
+        await asyncio.sleep(0.1)
+    if metrics_dir:
+        registry.publish(metrics_dir)
 
 
 def main():
@@ -230,16 +1534,18 @@ def main():
     parser.add_argument("--root", help="Root directory to serve")
     parser.add_argument("--port", type=int, help="Port to listen on")
     parser.add_argument("--token", help="Access token for login")
+    parser.add_argument("--workers", type=int, help="Number of worker processes to fork (default 1)")
     args = parser.parse_args()
 
-    config = {}
-    if args.config:
-        with open(args.config) as f:
-            config = json.load(f)
+    config = load_config(args.config)
+    if args.workers:
+        config["workers"] = args.workers
 
     root = args.root or config.get("root") or os.getcwd()
     port = args.port or config.get("port") or 8000
     token = args.token or config.get("token") or os.environ.get("WB_ACCESS_TOKEN") or secrets.token_urlsafe(32)
+    workers = config.get("workers", 1)
+    drain_timeout = config.get("drain_timeout", DEFAULT_DRAIN_TIMEOUT)
 
     global ACCESS_TOKEN, ROOT_DIR
     ACCESS_TOKEN = token
@@ -247,20 +1553,39 @@ def main():
 
     print(f"Access token: {ACCESS_TOKEN}")
 
-    settings = {
-        "cookie_secret": ACCESS_TOKEN,
-        "login_url": "/login",
-    }
-    app = make_app(settings)
+    # Everything up to here happens once, before forking, so every worker
+    # shares the token and cookie secret and any worker accepts any session
+    settings = configure(config)
     while True:
         try:
-            app.listen(port)
-            print(f"Serving HTTP on 0.0.0.0 port {port} (http://0.0.0.0:{port}/) ...")
-            print(f"http://{socket.getfqdn()}:{port}/")
-            tornado.ioloop.IOLoop.current().start()
+            sockets = tornado.netutil.bind_sockets(port)
             break
         except OSError:
             port += 1
-    
+    print(f"Serving HTTP on 0.0.0.0 port {port} (http://0.0.0.0:{port}/) ...")
+    print(f"http://{socket.getfqdn()}:{port}/")
+
+    # Workers publish their metrics here so any one of them can report the totals
+    metrics_dir = tempfile.mkdtemp(prefix="filey-metrics-") if workers > 1 else None
+
+    def run_worker(index):
+        asyncio.run(serve(sockets, {**settings, "metrics_dir": metrics_dir}, config.get("search_index", True),
+                          drain_timeout))
+
+    def reload():
+        # SIGHUP: new workers start from the re-read config; root, port and token stay as they are
+        nonlocal config, settings
+        config = {**load_config(args.config), "workers": workers}
+        settings = configure(config)
+
+    if workers > 1:
+        print(f"Starting {workers} worker processes")
+        try:
+            Supervisor(workers, run_worker, reload, drain_timeout).run()
+        finally:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        run_worker(0)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+import traceback
+
+import tornado.ioloop
+import tornado.web
+
+# Latency buckets (seconds) shared by the request and job histograms
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The IOLoop counts as stalled once a heartbeat is this late (seconds)
+DEFAULT_STALL_THRESHOLD = 0.25
+HEARTBEAT_INTERVAL = 0.05
+# Workers publish their metrics for the others this often (seconds)
+PUBLISH_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+class Metric:
+    """One metric family; values are kept per tuple of label values.
+
+    ``collect``, if given, is called at scrape time and returns
+    ``{label_values: value}``, for values that already exist elsewhere
+    (executor queues, open connections) and need no bookkeeping.
+    """
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> dict:
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self.lock:
+                values = {key: list(value) if isinstance(value, list) else value
+                          for key, value in self.values.items()}
+        return {"kind": self.kind, "help": self.documentation, "labels": self.labels,
+                "values": [[list(key), value] for key, value in values.items()]}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum; allocated once per label set
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = (), collect=None) -> Counter:
+        return self.register(Counter(name, documentation, labels, collect))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, others: list[dict] = ()) -> str:
+        """This process's metrics in the Prometheus text format, summed with ``others`` (other workers' snapshots)."""
+        merged = self.snapshot()
+        for name, family in merged.items():
+            family["values"] = {tuple(key): value for key, value in family["values"]}
+        for snapshot in others:
+            for name, family in snapshot.items():
+                target = merged.get(name)
+                if target is None or target["kind"] != family["kind"]:
+                    continue
+                for key, value in family["values"]:
+                    key = tuple(key)
+                    current = target["values"].get(key)
+                    if current is None:
+                        target["values"][key] = value
+                    elif isinstance(current, list):
+                        if len(current) == len(value):
+                            target["values"][key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target["values"][key] = current + value
+        lines = []
+        for name, family in merged.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for key, value in sorted(family["values"].items()):
+                labels = list(zip(family["labels"], key))
+                if family["kind"] == "histogram":
+                    cumulative = 0
+                    bounds = [_format(bound) for bound in family["buckets"]] + ["+Inf"]
+                    for bound, count in zip(bounds, value):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_format(value[-1])}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+    def publish(self, directory: str) -> None:
+        """Write this process's snapshot for the other workers' ``/metrics`` to include."""
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+
+def read_published(directory: str) -> list[dict]:
+    """Snapshots published by other processes.
+
+    Counters and histograms of workers that have exited still count, so
+    totals never go backwards; their gauges are dropped.
+    """
+    snapshots = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return snapshots
+    for name in names:
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _process_exists(int(name[:-5])):
+            snapshot = {key: family for key, family in snapshot.items() if family["kind"] != "gauge"}
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format(value: float) -> str:
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("filey_http_requests_total", "HTTP requests by handler, method and status.",
+                            ("handler", "method", "code"))
+REQUEST_DURATION = registry.histogram("filey_http_request_duration_seconds",
+                                      "Time from request start to the end of the response.", ("handler", "method"))
+RESPONSE_BYTES = registry.counter("filey_http_response_bytes_total", "Response body bytes sent, after compression.",
+                                  ("handler",))
+UPLOAD_BYTES = registry.counter("filey_upload_bytes_total", "Upload bytes received.", ("kind",))
+STREAM_BYTES = registry.counter("filey_stream_bytes_total", "File data sent over WebSocket streams.", ("handler",))
+STREAM_SKIPPED_BYTES = registry.counter("filey_stream_skipped_bytes_total",
+                                        "File data dropped because a stream client fell behind.", ("handler",))
+JOBS = registry.counter("filey_jobs_total", "Finished background jobs by kind and outcome.", ("kind", "state"))
+JOB_DURATION = registry.histogram("filey_job_duration_seconds", "Background job run time.", ("kind",))
+JOB_BYTES = registry.counter("filey_job_bytes_total", "Bytes processed by background jobs.", ("kind",))
+IOLOOP_LAG = registry.histogram("filey_ioloop_lag_seconds", "How late IOLoop heartbeats ran.", buckets=LAG_BUCKETS)
+IOLOOP_STALLS = registry.counter("filey_ioloop_stalls_total", "Times the IOLoop was blocked beyond the threshold.")
+
+
+def record_request(handler: tornado.web.RequestHandler) -> None:
+    name = type(handler).__name__
+    method = handler.request.method
+    REQUESTS.inc(name, method, str(handler.get_status()))
+    REQUEST_DURATION.observe(handler.request.request_time(), name, method)
+    RESPONSE_BYTES.inc(name, amount=getattr(handler.request, "bytes_written", 0))
+
+
+class ResponseSizeTransform(tornado.web.OutputTransform):
+    """Counts the response bytes on ``request.bytes_written``; goes last so compressed sizes are counted."""
+
+    def __init__(self, request):
+        self.request = request
+        request.bytes_written = 0
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        self.request.bytes_written += len(chunk)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        self.request.bytes_written += len(chunk)
+        return chunk
+
+
+class StallDetector:
+    """Notices when the IOLoop is blocked and logs what it is stuck in.
+
+    A callback on the loop records a heartbeat every ``HEARTBEAT_INTERVAL``;
+    a watchdog thread checks it and, once a heartbeat is more than
+    ``threshold`` seconds late, logs the loop thread's stack and the request
+    being handled, once per stall.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_STALL_THRESHOLD):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.reported = False
+        self.stalls = 0
+        self.stopped = threading.Event()
+        self.periodic = None
+        self.thread = None
+        self.loop_thread = None
+
+    def start(self) -> None:
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.periodic = tornado.ioloop.PeriodicCallback(self.beat, HEARTBEAT_INTERVAL * 1000)
+        self.periodic.start()
+        self.thread = threading.Thread(target=self.watch, name="stall-detector", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.periodic is not None:
+            self.periodic.stop()
+
+    def beat(self) -> None:
+        now = time.monotonic()
+        IOLOOP_LAG.observe(max(now - self.last_beat - HEARTBEAT_INTERVAL, 0))
+        self.last_beat = now
+        self.reported = False
+
+    def watch(self) -> None:
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            blocked = time.monotonic() - self.last_beat - HEARTBEAT_INTERVAL
+            if blocked > self.threshold and not self.reported:
+                self.reported = True
+                self.stalls += 1
+                IOLOOP_STALLS.inc()
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    logger.warning("IOLoop blocked for %.0fms in %s\n%s", blocked * 1000, _current_request(frame),
+                                   "".join(traceback.format_stack(frame)))
+
+
+def _current_request(frame) -> str:
+    # The innermost handler method on the stack is the one holding up the loop
+    while frame is not None:
+        handler = frame.f_locals.get("self")
+        if isinstance(handler, tornado.web.RequestHandler):
+            return f"{type(handler).__name__} ({handler.request.method} {handler.request.uri})"
+        frame = frame.f_back
+    return "no request handler"
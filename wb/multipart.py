@@ -0,0 +1,128 @@
+from typing import Callable
+
+from tornado.httputil import HTTPHeaders, HTTPInputError, _parse_header
+
+# Part headers are tiny in practice; anything bigger is a malformed or hostile body
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def get_boundary(content_type: str) -> bytes:
+    ctype, params = _parse_header(content_type)
+    if ctype != "multipart/form-data" or not params.get("boundary"):
+        raise MultipartError("Expected multipart/form-data with a boundary")
+    boundary = params["boundary"]
+    # RFC 2046 allows the boundary to be quoted
+    if boundary.startswith('"') and boundary.endswith('"'):
+        boundary = boundary[1:-1]
+    return boundary.encode("latin1")
+
+
+def parse_disposition(headers: HTTPHeaders) -> tuple[str | None, str | None]:
+    """Return the (name, filename) of a part from its Content-Disposition header."""
+    disposition, params = _parse_header(headers.get("Content-Disposition", ""))
+    if disposition != "form-data":
+        return None, None
+    return params.get("name"), params.get("filename")
+
+
+class MultipartParser:
+    """Incremental ``multipart/form-data`` parser.
+
+    Feed body chunks as they arrive; part bodies are handed to ``on_part_data``
+    as soon as they cannot contain the next delimiter, so memory use is bounded
+    by the chunk size rather than the size of the parts.
+    """
+
+    PREAMBLE, AFTER_BOUNDARY, HEADERS, BODY, EPILOGUE = range(5)
+
+    def __init__(self, boundary: bytes,
+                 on_part_begin: Callable[[HTTPHeaders], None],
+                 on_part_data: Callable[[bytes], None],
+                 on_part_end: Callable[[], None]):
+        self.first_boundary = b"--" + boundary
+        self.delimiter = b"\r\n--" + boundary
+        self.on_part_begin = on_part_begin
+        self.on_part_data = on_part_data
+        self.on_part_end = on_part_end
+        self.state = self.PREAMBLE
+        self.buffer = bytearray()
+
+    @property
+    def finished(self) -> bool:
+        return self.state == self.EPILOGUE
+
+    def feed(self, data: bytes) -> None:
+        if self.state == self.EPILOGUE:
+            return
+        self.buffer += data
+        while self._step():
+            pass
+
+    def close(self) -> None:
+        if self.state != self.EPILOGUE:
+            raise MultipartError("Multipart body ended before the closing boundary")
+
+    def _step(self) -> bool:
+        buf = self.buffer
+        if self.state == self.PREAMBLE:
+            idx = buf.find(self.first_boundary)
+            if idx < 0:
+                del buf[:max(len(buf) - len(self.first_boundary) + 1, 0)]
+                return False
+            del buf[:idx + len(self.first_boundary)]
+            self.state = self.AFTER_BOUNDARY
+            return True
+
+        if self.state == self.AFTER_BOUNDARY:
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b"--":
+                self.state = self.EPILOGUE
+                buf.clear()
+                return False
+            idx = buf.find(b"\r\n")
+            if idx < 0:
+                return False
+            # Transport padding (linear whitespace) may follow the boundary
+            if buf[:idx].strip(b" \t"):
+                raise MultipartError("Invalid multipart boundary line")
+            del buf[:idx + 2]
+            self.state = self.HEADERS
+            return True
+
+        if self.state == self.HEADERS:
+            idx = buf.find(b"\r\n\r\n")
+            if idx < 0:
+                if len(buf) > MAX_HEADER_SIZE:
+                    raise MultipartError("Multipart part headers too large")
+                return False
+            try:
+                headers = HTTPHeaders.parse(buf[:idx].decode("utf-8"))
+            except (UnicodeDecodeError, HTTPInputError):
+                raise MultipartError("Invalid multipart part headers")
+            del buf[:idx + 4]
+            self.state = self.BODY
+            self.on_part_begin(headers)
+            return True
+
+        if self.state == self.BODY:
+            idx = buf.find(self.delimiter)
+            if idx < 0:
+                # Keep just enough bytes to recognise a delimiter split across chunks
+                keep = len(self.delimiter) - 1
+                if len(buf) > keep:
+                    self.on_part_data(bytes(buf[:-keep]))
+                    del buf[:-keep]
+                return False
+            if idx:
+                self.on_part_data(bytes(buf[:idx]))
+            del buf[:idx + len(self.delimiter)]
+            self.state = self.AFTER_BOUNDARY
+            self.on_part_end()
+            return True
+
+        return False
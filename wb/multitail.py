@@ -0,0 +1,129 @@
+import re
+import time
+import heapq
+import codecs
+import itertools
+from collections import deque
+
+import tornado.ioloop
+
+MAX_SOURCES = 64
+DEFAULT_RESCAN_INTERVAL = 2000
+DEFAULT_MERGE_DELAY = 0.5
+MAX_MERGE_BUFFER = 4 * 1024 * 1024
+
+# ISO 8601-ish leading timestamps: "2024-05-01T12:00:00.123Z", "[2024-05-01 12:00:00,123]", ...
+_TIMESTAMP = re.compile(rb"\[?(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:[.,](\d{1,9}))?")
+
+
+def parse_timestamp(line: bytes) -> bytes | None:
+    """Return a sortable key for the timestamp at the start of ``line``, or None."""
+    match = _TIMESTAMP.match(line)
+    if match is None:
+        return None
+    date, clock, fraction = match.groups()
+    return date + b"T" + clock + b"." + (fraction or b"").ljust(9, b"0")
+
+
+class Source:
+    """One file of a merged tail; forwards its watcher's events tagged with its name."""
+
+    def __init__(self, name: str, listener):
+        self.name = name
+        self.listener = listener
+        self.watcher = None
+        self.file_id = None
+        self.frames = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # Lines without a timestamp of their own (e.g. stack traces) sort with the line before them
+        self.last_timestamp = b""
+
+    def on_tail_data(self, offset: int, data: bytes) -> None:
+        self.listener.on_source_data(self, offset, data)
+
+    def on_tail_reset(self, reason: str) -> None:
+        self.listener.on_source_reset(self, reason)
+
+
+class TimestampMerger:
+    """Interleaves lines from several sources in the order of their leading timestamps.
+
+    This is a k-way merge over one queue per source. The oldest queued line
+    is released once every source has something queued, so nothing older can
+    still be on its way, or once it has waited ``delay`` seconds, which
+    bounds the latency a quiet source adds. More than ``max_buffer`` queued
+    bytes also forces lines out. Released lines are passed to
+    ``emit(source, offset, data)`` in runs of adjacent lines from one source.
+    """
+
+    def __init__(self, emit, delay: float = DEFAULT_MERGE_DELAY, max_buffer: int = MAX_MERGE_BUFFER):
+        self.emit = emit
+        self.delay = delay
+        self.max_buffer = max_buffer
+        self.queues = {}
+        self.buffered = 0
+        self.timer = None
+        self.sequence = itertools.count()
+
+    def add_source(self, source: Source) -> None:
+        self.queues.setdefault(source, deque())
+
+    def remove_source(self, source: Source) -> None:
+        queue = self.queues.pop(source, ())
+        self.buffered -= sum(len(line) for _, _, line, _ in queue)
+
+    def add(self, source: Source, offset: int, data: bytes, release: bool = True) -> None:
+        queue = self.queues.setdefault(source, deque())
+        now = time.monotonic()
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos) + 1 or len(data)
+            line = data[pos:end]
+            timestamp = parse_timestamp(line)
+            if timestamp is None:
+                timestamp = source.last_timestamp
+            else:
+                source.last_timestamp = timestamp
+            queue.append((timestamp, offset + pos, line, now))
+            pos = end
+        self.buffered += len(data)
+        if release:
+            self.release()
+
+    def release(self, force: bool = False) -> None:
+        now = time.monotonic()
+        heap = [(queue[0][0], next(self.sequence), source) for source, queue in self.queues.items() if queue]
+        heapq.heapify(heap)
+        run = None
+        while heap:
+            source = heap[0][2]
+            queue = self.queues[source]
+            if (not force and len(heap) < len(self.queues) and self.buffered <= self.max_buffer
+                    and now - queue[0][3] < self.delay):
+                break
+            heapq.heappop(heap)
+            _, offset, line, _ = queue.popleft()
+            self.buffered -= len(line)
+            if run is not None and run[0] is source and run[1] + len(run[2]) == offset:
+                run[2] += line
+            else:
+                if run is not None:
+                    self.emit(run[0], run[1], bytes(run[2]))
+                run = [source, offset, bytearray(line)]
+            if queue:
+                heapq.heappush(heap, (queue[0][0], next(self.sequence), source))
+        if run is not None:
+            self.emit(run[0], run[1], bytes(run[2]))
+        if self.buffered and self.timer is None:
+            self.timer = tornado.ioloop.IOLoop.current().call_later(self.delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self.timer = None
+        self.release()
+
+    def close(self) -> None:
+        if self.timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+        self.queues.clear()
+        self.buffered = 0
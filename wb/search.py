@@ -0,0 +1,405 @@
+import os
+import re
+import sys
+import time
+import fnmatch
+import logging
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 5000
+DEFAULT_RESCAN_INTERVAL = 60
+# Compact once more than this many (and more than half of all) entries are deleted
+MIN_COMPACT_DELETED = 10000
+# Most entries checked for a query too short for the trigram index; beyond that results are truncated
+MAX_SHORT_QUERY_SCAN = 50000
+
+ROOT = 0
+_DIR = 1
+_DELETED = 2
+
+
+def _trigrams(name: str) -> set[str]:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class PathIndex:
+    """An in-memory index of every path under ``root`` for filename search.
+
+    Each entry is a ``(parent entry, name)`` pair kept in parallel arrays,
+    with names interned so that a component repeated across thousands of
+    directories is stored once. Entries are found through trigram postings
+    (``array('I')`` of entry ids per trigram of the lower-cased name), and
+    the candidates from the rarest trigram of a query are verified directly.
+    Removed entries are marked as deleted and dropped when the index is
+    compacted, once they outnumber the live ones.
+
+    The index is built by a background walk and kept fresh by rescanning
+    the directories whose mtime changed since they were last read, and by
+    ``add``/``remove``/``rename`` calls from the handlers that modify files.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.RLock()
+        self.names = [""]
+        self.name_ids = {"": 0}
+        self.parents = array("I", [0])
+        self.name_of = array("I", [0])
+        self.flags = bytearray([_DIR])
+        self.children = {ROOT: array("I")}
+        # (parent entry, name id) -> entry, for directories only
+        self.child_dirs = {}
+        self.dir_mtimes = {}
+        self.postings = {}
+        self.live = 0
+        self.deleted = 0
+        self.complete = False
+        self.build_seconds = None
+        self.last_rescan = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # -- Building ------------------------------------------------------------
+
+    def start(self, rescan_interval: float = DEFAULT_RESCAN_INTERVAL) -> None:
+        self.thread = threading.Thread(target=self._run, args=(rescan_interval,), name="path-index", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def _run(self, rescan_interval: float) -> None:
+        try:
+            self.build()
+            while not self.stop_event.wait(rescan_interval):
+                self.rescan()
+                if self.deleted > max(self.live, MIN_COMPACT_DELETED):
+                    self.compact()
+        except Exception:
+            logger.exception("Path index for %s failed", self.root)
+
+    def build(self) -> None:
+        started = time.monotonic()
+        pending = [ROOT]
+        while pending and not self.stop_event.is_set():
+            pending.extend(self._scan_dir(pending.pop()))
+        self.build_seconds = time.monotonic() - started
+        self.last_rescan = time.time()
+        self.complete = True
+        logger.info("Indexed %d paths under %s in %.1fs", self.live, self.root, self.build_seconds)
+
+    def rescan(self) -> None:
+        """Re-read the directories whose mtime changed since they were last scanned."""
+        with self.lock:
+            directories = list(self.dir_mtimes)
+        for entry in directories:
+            if self.stop_event.is_set():
+                return
+            with self.lock:
+                if entry not in self.dir_mtimes:
+                    continue
+                path = self._abspath(entry)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != self.dir_mtimes.get(entry):
+                pending = [entry]
+                while pending:
+                    pending.extend(self._scan_dir(pending.pop()))
+        self.last_rescan = time.time()
+
+    def compact(self) -> None:
+        """Renumber the live entries, dropping deleted ones and stale postings."""
+        with self.lock:
+            parents, name_of, flags = array("I", [0]), array("I", [0]), bytearray([_DIR])
+            children, child_dirs, dir_mtimes, postings = {ROOT: array("I")}, {}, {}, {}
+            renumbered = {ROOT: ROOT}
+            queue = [ROOT]
+            for old in queue:
+                for child in self._children(old):
+                    new = renumbered[child] = len(parents)
+                    parent = renumbered[old]
+                    parents.append(parent)
+                    name_of.append(self.name_of[child])
+                    flags.append(self.flags[child])
+                    children[parent].append(new)
+                    if self.flags[child] & _DIR:
+                        children[new] = array("I")
+                        child_dirs[(parent, self.name_of[child])] = new
+                        queue.append(child)
+                    for trigram in _trigrams(self.names[self.name_of[child]].lower()):
+                        postings.setdefault(trigram, array("I")).append(new)
+            for old, mtime in self.dir_mtimes.items():
+                if old in renumbered:
+                    dir_mtimes[renumbered[old]] = mtime
+            self.parents, self.name_of, self.flags = parents, name_of, flags
+            self.children, self.child_dirs, self.dir_mtimes, self.postings = children, child_dirs, dir_mtimes, postings
+            self.deleted = 0
+
+    def _scan_dir(self, directory: int) -> list[int]:
+        # Bring one directory's children in line with the disk; returns new subdirectories to scan
+        with self.lock:
+            path = self._abspath(directory)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                found = {}
+                for entry in it:
+                    try:
+                        found[entry.name] = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        found[entry.name] = False
+        except OSError:
+            return []
+        new_dirs = []
+        with self.lock:
+            if self.flags[directory] & _DELETED:
+                return []
+            existing = {self.names[self.name_of[child]]: child for child in self._children(directory)}
+            for name, child in existing.items():
+                if found.get(name) != bool(self.flags[child] & _DIR):
+                    self._remove(child)
+            for name, is_dir in found.items():
+                child = existing.get(name)
+                if child is not None and not self.flags[child] & _DELETED:
+                    continue
+                child = self._add(directory, name, is_dir)
+                if is_dir:
+                    new_dirs.append(child)
+            self.dir_mtimes[directory] = mtime
+        return new_dirs
+
+    # -- Entries -------------------------------------------------------------
+
+    def _intern(self, name: str) -> int:
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return name_id
+
+    def _children(self, directory: int):
+        # Children arrays keep the ids of entries that were since moved or deleted; skip those
+        for child in self.children.get(directory, ()):
+            if self.parents[child] == directory and not self.flags[child] & _DELETED:
+                yield child
+
+    def _add(self, parent: int, name: str, is_dir: bool) -> int:
+        entry = len(self.parents)
+        name_id = self._intern(name)
+        self.parents.append(parent)
+        self.name_of.append(name_id)
+        self.flags.append(_DIR if is_dir else 0)
+        self.children[parent].append(entry)
+        if is_dir:
+            self.children[entry] = array("I")
+            self.child_dirs[(parent, name_id)] = entry
+        self._post(entry, name)
+        self.live += 1
+        return entry
+
+    def _post(self, entry: int, name: str) -> None:
+        for trigram in _trigrams(name.lower()):
+            postings = self.postings.get(trigram)
+            if postings is None:
+                postings = self.postings[trigram] = array("I")
+            postings.append(entry)
+
+    def _remove(self, entry: int) -> None:
+        if self.flags[entry] & _DELETED:
+            return
+        if self.flags[entry] & _DIR:
+            for child in list(self._children(entry)):
+                self._remove(child)
+            self.children.pop(entry, None)
+            self.dir_mtimes.pop(entry, None)
+            self.child_dirs.pop((self.parents[entry], self.name_of[entry]), None)
+        self.flags[entry] |= _DELETED
+        self.live -= 1
+        self.deleted += 1
+
+    def _lookup(self, relpath: str) -> int | None:
+        entry = ROOT
+        parts = [part for part in relpath.split(os.sep) if part]
+        for i, part in enumerate(parts):
+            name_id = self.name_ids.get(part)
+            last = i == len(parts) - 1
+            child = self.child_dirs.get((entry, name_id)) if name_id is not None else None
+            if child is None and last and name_id is not None:
+                child = next((c for c in self._children(entry) if self.name_of[c] == name_id), None)
+            if child is None:
+                return None
+            entry = child
+        return entry
+
+    def _relpath(self, abspath: str) -> str | None:
+        relpath = os.path.relpath(abspath, self.root)
+        return None if relpath == os.pardir or relpath.startswith(os.pardir + os.sep) else relpath
+
+    def _abspath(self, entry: int) -> str:
+        return os.path.join(self.root, self.path(entry))
+
+    def path(self, entry: int) -> str:
+        parts = []
+        while entry != ROOT:
+            parts.append(self.names[self.name_of[entry]])
+            entry = self.parents[entry]
+        return "/".join(reversed(parts))
+
+    # -- Updates from handlers ----------------------------------------------
+
+    def add(self, abspath: str) -> None:
+        """Index a file or directory (and, for a directory, everything below it)."""
+        relpath = self._relpath(abspath)
+        if not relpath or relpath == os.curdir:
+            return
+        with self.lock:
+            if self._lookup(relpath) is not None:
+                return
+            # Missing parent directories (e.g. from a nested upload) are added with their whole subtree
+            while os.path.dirname(relpath) and self._lookup(os.path.dirname(relpath)) is None:
+                relpath = os.path.dirname(relpath)
+            parent = self._lookup(os.path.dirname(relpath))
+            if not self.flags[parent] & _DIR:
+                return
+            abspath = os.path.join(self.root, relpath)
+            is_dir = os.path.isdir(abspath) and not os.path.islink(abspath)
+            entry = self._add(parent, os.path.basename(relpath), is_dir)
+            # Held throughout so a compaction cannot renumber the new entries midway
+            pending = [entry] if is_dir else []
+            while pending:
+                pending.extend(self._scan_dir(pending.pop()))
+
+    def remove(self, abspath: str) -> None:
+        relpath = self._relpath(abspath)
+        if not relpath or relpath == os.curdir:
+            return
+        with self.lock:
+            entry = self._lookup(relpath)
+            if entry is not None:
+                self._remove(entry)
+
+    def rename(self, old_abspath: str, new_abspath: str) -> None:
+        old, new = self._relpath(old_abspath), self._relpath(new_abspath)
+        if not old or not new:
+            return
+        with self.lock:
+            entry = self._lookup(old)
+            existing = self._lookup(new)
+            parent = self._lookup(os.path.dirname(new))
+            if entry is None or entry == existing or parent is None or not self.flags[parent] & _DIR:
+                moved = False
+                if entry is not None and entry != existing:
+                    self._remove(entry)
+            else:
+                if existing is not None:
+                    # Renamed over an existing entry
+                    self._remove(existing)
+                # Move in place, so a directory's whole subtree follows without being touched
+                name = os.path.basename(new)
+                if self.flags[entry] & _DIR:
+                    self.child_dirs.pop((self.parents[entry], self.name_of[entry]), None)
+                    self.child_dirs[(parent, self._intern(name))] = entry
+                self.parents[entry] = parent
+                self.name_of[entry] = self._intern(name)
+                self.children[parent].append(entry)
+                self._post(entry, name)
+                moved = True
+        if not moved:
+            self.add(new_abspath)
+
+    # -- Queries -------------------------------------------------------------
+
+    def search(self, query: str, limit: int = DEFAULT_LIMIT) -> dict:
+        """Find entries whose name (or, if the query has a ``/``, path) matches.
+
+        Plain queries are case-insensitive substrings; queries containing
+        ``*``, ``?`` or ``[`` are shell-style globs.
+        """
+        query = query.strip().lower()
+        limit = max(1, min(limit, MAX_LIMIT))
+        whole_path = "/" in query
+        if any(c in query for c in "*?["):
+            regex = re.compile(fnmatch.translate(query))
+            matches = regex.match
+            # The longest wildcard-free run in the last path component must occur in the name
+            literals = re.split(r"[*?]|\[[^\]]*\]?", query.rsplit("/", 1)[-1])
+            literal = max(literals, key=len)
+        else:
+            matches = lambda text: query in text
+            literal = query.rsplit("/", 1)[-1]
+        results = []
+        seen = set()
+        with self.lock:
+            candidates, partial = self._candidates(literal)
+            for entry in candidates:
+                if entry in seen or self.flags[entry] & _DELETED or entry == ROOT:
+                    continue
+                name = self.names[self.name_of[entry]].lower()
+                if literal not in name:
+                    continue
+                path = self.path(entry)
+                if not matches(path.lower() if whole_path else name):
+                    continue
+                seen.add(entry)
+                results.append({"path": path, "is_dir": bool(self.flags[entry] & _DIR)})
+                if len(results) >= limit:
+                    break
+        return {"results": results, "truncated": len(results) >= limit or partial, "complete": self.complete}
+
+    def _candidates(self, literal: str) -> tuple:
+        # The entries that may match, and whether those are only some of them
+        trigrams = _trigrams(literal)
+        if not trigrams:
+            # Too short for the trigram index; check entries in order, up to a bound
+            return range(min(len(self.parents), MAX_SHORT_QUERY_SCAN)), len(self.parents) > MAX_SHORT_QUERY_SCAN
+        postings = [self.postings.get(trigram) for trigram in trigrams]
+        if any(p is None for p in postings):
+            return (), False
+        return min(postings, key=len), False
+
+    def stats(self) -> dict:
+        with self.lock:
+            arrays = [self.parents, self.name_of, *self.children.values(), *self.postings.values()]
+            array_bytes = sum(a.buffer_info()[1] * a.itemsize for a in arrays) + len(self.flags)
+            name_bytes = sum(sys.getsizeof(name) for name in self.names)
+            dict_bytes = sum(sys.getsizeof(d) for d in (self.name_ids, self.children, self.child_dirs,
+                                                         self.dir_mtimes, self.postings))
+            return {
+                "entries": self.live,
+                "deleted_entries": self.deleted,
+                "directories": len(self.dir_mtimes),
+                "names": len(self.names),
+                "trigrams": len(self.postings),
+                "memory_bytes": array_bytes + name_bytes + dict_bytes,
+                "complete": self.complete,
+                "build_seconds": self.build_seconds,
+                "last_rescan": self.last_rescan,
+            }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_path_index(root: str, rescan_interval: float = DEFAULT_RESCAN_INTERVAL) -> PathIndex:
+    """Return the index for ``root``, starting its background build on first use."""
+    global _index
+    with _index_lock:
+        if _index is None or _index.root != root:
+            if _index is not None:
+                _index.stop()
+            _index = PathIndex(root)
+            _index.start(rescan_interval)
+        return _index
+
+
+def current_path_index(root: str) -> PathIndex | None:
+    # Handlers that change files update the index only if one is being kept
+    index = _index
+    return index if index is not None and index.root == root else None
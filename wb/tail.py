@@ -0,0 +1,771 @@
+import os
+import logging
+from collections import deque
+
+import tornado.ioloop
+import tornado.locks
+
+from .executors import executors, ExecutorBusy
+from .linefilter import LineFilter, FilterState
+from .compressed import open_uncompressed, compression_format, needs_indexing
+from .watch import (Inotify, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVE_SELF, IN_DELETE_SELF,
+                    IN_CREATE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE, IN_Q_OVERFLOW)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TAIL_LINES = 100
+MAX_TAIL_LINES = 10000
+TAIL_BLOCK_SIZE = 64 * 1024
+# Stop walking backwards after this much, even if fewer lines were found (e.g. one huge line)
+MAX_TAIL_BYTES = 8 * 1024 * 1024
+
+
+def read_tail(f, count: int, end: int | None = None, block_size: int = TAIL_BLOCK_SIZE,
+              max_bytes: int = MAX_TAIL_BYTES) -> tuple[int, bytes]:
+    """Return ``(offset, data)`` for the last ``count`` lines of binary file ``f`` before ``end``.
+
+    Reads fixed-size blocks backwards from ``end`` (EOF by default) until enough
+    newlines have been seen, so the cost depends on the size of the tail and
+    not on the size of the file.
+    """
+    if end is None:
+        end = f.seek(0, os.SEEK_END)
+    if count <= 0 or end <= 0:
+        return end, b""
+    pos = end
+    blocks = []
+    newlines = 0
+    # One newline more than the line count is needed to find where the first wanted line starts
+    while pos > 0 and newlines <= count and end - pos < max_bytes:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        blocks.append(block)
+        newlines += block.count(b"\n")
+    data = b"".join(reversed(blocks))
+
+    # A trailing newline ends the last line rather than starting a new one
+    idx = len(data) - 1 if data.endswith(b"\n") else len(data)
+    for _ in range(count):
+        idx = data.rfind(b"\n", 0, idx)
+        if idx < 0:
+            break
+    start = idx + 1 if idx >= 0 else 0
+    return pos + start, data[start:]
+
+
+DEFAULT_POLL_INTERVAL = 500
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# Read at most this much at a time so one busy file's data is published over several IOLoop turns
+MAX_READ_PER_POLL = 4 * 1024 * 1024
+# A line without a newline is held back until it completes or grows past this
+MAX_PARTIAL_LINE = 64 * 1024
+
+# Most that is replayed to a reconnecting client; anything older is reported as skipped
+MAX_RESUME_BYTES = 8 * 1024 * 1024
+
+FILE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_EVENTS = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+
+def file_identity(st: os.stat_result) -> str:
+    return "%x:%x" % (st.st_dev, st.st_ino)
+
+
+class TailWatcher:
+    """Follows one file on behalf of any number of subscribers.
+
+    New data is read once and handed to every subscriber's
+    ``on_tail_data(offset, data)``, where ``data`` holds complete lines starting
+    at byte ``offset``. The most recent bytes are kept in a ring buffer so new
+    subscribers get their history without touching the disk.
+
+    Changes are picked up from inotify where available and by polling every
+    ``interval`` ms otherwise. When the file is rotated (its path now names a
+    different inode) or truncated, the watcher drains what is left, calls
+    ``on_tail_reset(reason)`` on every subscriber and follows the new content
+    from offset 0.
+
+    Watchers are created off the IOLoop (opening one reads the end of the
+    file), and every check reads and stats the file on the "read" executor;
+    only publishing to subscribers happens on the IOLoop.
+    """
+
+    def __init__(self, path: str, key, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 interval: int = DEFAULT_POLL_INTERVAL, backend: str = "auto"):
+        self.path = path
+        self.key = key
+        self.hub = None
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self.backend = backend
+        self.subscribers = set()
+        self.filters = {}
+        self.file = open(path, "rb")
+        self.identity = file_identity(os.fstat(self.file.fileno()))
+        self.offset = self.file.seek(0, os.SEEK_END)
+        self.pending = b""
+        self.periodic = None
+        self.inotify = None
+        self.file_watch = None
+        self.dir_watch = None
+        self.check_scheduled = False
+        self.check_lock = tornado.locks.Lock()
+        self.checking = False
+        self.closed = False
+        self._seed()
+
+    def _seed(self) -> None:
+        # Prime the buffer with the end of the file, starting at a line boundary
+        start = max(self.offset - self.buffer_size, 0)
+        self.file.seek(start)
+        data = self.file.read(self.offset - start)
+        if start > 0:
+            cut = data.find(b"\n") + 1
+            data = data[cut:] if cut else b""
+        self.buffer = bytearray(data)
+        self.buffer_start = self.offset - len(data)
+        self.file.seek(self.offset)
+
+    def start(self) -> None:
+        inotify = Inotify.get() if self.backend != "poll" else None
+        if inotify is not None:
+            try:
+                self.dir_watch = inotify.add_watch(os.path.dirname(self.path), DIR_EVENTS, self._on_dir_event)
+                self.file_watch = inotify.add_watch(self.path, FILE_EVENTS, self._on_file_event)
+                self.inotify = inotify
+                return
+            except OSError as e:
+                logger.info("Cannot watch %s with inotify, polling instead: %s", self.path, e)
+                self._unwatch()
+        self.periodic = tornado.ioloop.PeriodicCallback(self.check, self.interval)
+        self.periodic.start()
+
+    def _unwatch(self) -> None:
+        inotify = self.inotify or Inotify.get()
+        for handle in (self.file_watch, self.dir_watch):
+            if handle is not None:
+                inotify.remove_watch(handle)
+        self.file_watch = self.dir_watch = None
+
+    def close(self) -> None:
+        self.closed = True
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+        if self.inotify is not None:
+            self._unwatch()
+            self.inotify = None
+        # A check reading on the executor closes the file when it is done with it
+        if not self.checking:
+            self.file.close()
+
+    def _on_file_event(self, mask, name, cookie) -> None:
+        self.schedule_check()
+
+    def _on_dir_event(self, mask, name, cookie) -> None:
+        if name == os.path.basename(self.path) or mask & IN_Q_OVERFLOW:
+            self.schedule_check()
+
+    def schedule_check(self) -> None:
+        # A burst of writes produces many events; handle them with one check
+        if not self.check_scheduled:
+            self.check_scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.check)
+
+    async def check(self) -> None:
+        """Publish what was appended since the last check and handle rotation and truncation."""
+        self.check_scheduled = False
+        async with self.check_lock:
+            if self.closed:
+                return
+            self.checking = True
+            try:
+                while await self._check_once():
+                    pass
+            finally:
+                self.checking = False
+                if self.closed:
+                    self.file.close()
+
+    def _read(self) -> tuple:
+        # Runs on the executor: new data and, once it is all read, what the path and our handle now name
+        data = self.file.read(MAX_READ_PER_POLL)
+        if len(data) == MAX_READ_PER_POLL:
+            return data, None, None, None
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+        return data, st, os.fstat(self.file.fileno()), self.file.tell()
+
+    async def _check_once(self) -> bool:
+        # True if the file was replaced or truncated, so the new content needs a check of its own
+        current = None
+        while current is None:
+            data, st, current, position = await executors.run("read", self._read)
+            if self.closed:
+                return False
+            self._consume(data)
+        if st is None:
+            # Rotated away and not recreated yet; the directory watch (or the next poll) will notice
+            return False
+        if (st.st_dev, st.st_ino) != (current.st_dev, current.st_ino):
+            return await self._reopen()
+        if current.st_size < position:
+            await self._flush_pending()
+            self.file.seek(0)
+            self._restart("truncated", current)
+            return True
+        return False
+
+    async def _reopen(self) -> bool:
+        try:
+            new_file = await executors.run("read", open, self.path, "rb")
+        except OSError:
+            return False
+        await self._flush_pending()
+        if self.closed:
+            new_file.close()
+            return False
+        self.file.close()
+        self.file = new_file
+        if self.inotify is not None:
+            if self.file_watch is not None:
+                self.inotify.remove_watch(self.file_watch)
+                self.file_watch = None
+            try:
+                self.file_watch = self.inotify.add_watch(self.path, FILE_EVENTS, self._on_file_event)
+            except OSError as e:
+                logger.warning("Lost inotify watch on %s: %s", self.path, e)
+        self._restart("rotated", os.fstat(new_file.fileno()))
+        return True
+
+    def _restart(self, reason: str, st: os.stat_result) -> None:
+        self.offset = 0
+        self.pending = b""
+        self.buffer = bytearray()
+        self.buffer_start = 0
+        self.identity = file_identity(st)
+        if self.hub is not None:
+            self.hub.rekey(self, (st.st_dev, st.st_ino, self.path))
+        for subscriber in list(self.subscribers):
+            subscriber.on_tail_reset(reason)
+
+    async def _flush_pending(self) -> None:
+        # The old file will never finish its last line; send what there is
+        while True:
+            data = await executors.run("read", self.file.read, MAX_READ_PER_POLL)
+            if self.closed:
+                return
+            self._consume(data)
+            if len(data) < MAX_READ_PER_POLL:
+                break
+        if self.pending:
+            data, self.pending = self.pending, b""
+            self.publish(data)
+
+    def view(self) -> "TailView":
+        """A snapshot of what has been seen so far, to read history from off the IOLoop."""
+        # A descriptor of our own: after a rotation the path may name a different file
+        file = os.fdopen(os.dup(self.file.fileno()), "rb")
+        return TailView(self.offset, bytes(self.buffer), self.buffer_start, file)
+
+    def recent_lines(self, count: int) -> bytes:
+        """The last ``count`` lines in the ring buffer, or as many as it holds."""
+        return read_tail(_BytesFile(bytes(self.buffer)), count)[1]
+
+    def history(self, count: int) -> tuple[int, bytes]:
+        """Return ``(offset, data)`` for the last ``count`` complete lines seen so far."""
+        with self.view() as view:
+            return view.history(count)
+
+    def read_since(self, offset: int, limit: int = MAX_RESUME_BYTES) -> tuple[int, bytes]:
+        with self.view() as view:
+            return view.read_since(offset, limit)
+
+    def _consume(self, data: bytes) -> None:
+        # Publish the complete lines in what was just read
+        if not data:
+            return
+        data = self.pending + data
+        cut = data.rfind(b"\n") + 1
+        if not cut and len(data) >= MAX_PARTIAL_LINE:
+            cut = len(data)
+        self.pending = data[cut:]
+        if cut:
+            self.publish(data[:cut])
+
+    def publish(self, data: bytes) -> None:
+        offset = self.offset
+        self.offset += len(data)
+        self._remember(data)
+        for subscriber in list(self.subscribers):
+            subscriber.on_tail_data(offset, data)
+
+    def _remember(self, data: bytes) -> None:
+        self.buffer += data
+        excess = len(self.buffer) - self.buffer_size
+        if excess > 0:
+            # Trim whole lines so the buffer always starts at a line boundary
+            cut = self.buffer.find(b"\n", excess) + 1 or len(self.buffer)
+            del self.buffer[:cut]
+            self.buffer_start += cut
+
+
+DEFAULT_FRAME_SIZE = 64 * 1024
+DEFAULT_FRAME_DELAY = 0.05
+DEFAULT_HIGH_WATER = 4 * 1024 * 1024
+
+
+class FrameCoalescer:
+    """Batches tail data for one connection into frames bounded by size and time.
+
+    Data is sent once ``frame_size`` bytes have accumulated or ``delay``
+    seconds after the first unsent byte, whichever comes first.
+    ``send_frame(offset, data, end)`` gets the file range the frame covers,
+    which may include lines that were filtered out. It returns a Future that
+    resolves once the frame has left the process; if the bytes queued but not
+    yet sent would exceed ``high_water``, new data is dropped and reported
+    through ``send_skipped(offset, count)`` once the client has caught up,
+    whether or not more data follows.
+    """
+
+    def __init__(self, send_frame, send_skipped, frame_size: int = DEFAULT_FRAME_SIZE,
+                 delay: float = DEFAULT_FRAME_DELAY, high_water: int = DEFAULT_HIGH_WATER):
+        self.send_frame = send_frame
+        self.send_skipped = send_skipped
+        self.frame_size = frame_size
+        self.delay = delay
+        self.high_water = high_water
+        self.pending = bytearray()
+        # (index into pending, file offset) where each run of adjacent file bytes starts
+        self.runs = []
+        self.in_flight = 0
+        self.skipped = 0
+        self.skipped_offset = 0
+        self.skipped_end = 0
+        self.timer = None
+
+    def push(self, offset: int, data: bytes, force: bool = False) -> None:
+        if not force and self.in_flight + len(self.pending) + len(data) > self.high_water:
+            if not self.skipped:
+                self.skipped_offset = offset
+            self.skipped += len(data)
+            self.skipped_end = offset + len(data)
+            return
+        if self.skipped:
+            self._report_skipped()
+        # Filtered data leaves out the lines that did not match, so runs need not be adjacent
+        if not self.runs or self._position(len(self.pending)) != offset:
+            self.runs.append((len(self.pending), offset))
+        self.pending += data
+        if len(self.pending) >= self.frame_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = tornado.ioloop.IOLoop.current().call_later(self.delay, self.flush)
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+        while self.pending:
+            # Prefer to end frames on a line boundary
+            cut = len(self.pending)
+            if cut > self.frame_size:
+                cut = self.pending.rfind(b"\n", 0, self.frame_size) + 1 or self.frame_size
+            frame = bytes(self.pending[:cut])
+            offset, end = self._position(0), self._position(cut - 1) + 1
+            del self.pending[:cut]
+            self._drop_runs(cut)
+            future = self.send_frame(offset, frame, end)
+            if future is not None:
+                self.in_flight += len(frame)
+                future.add_done_callback(lambda f, size=len(frame): self._sent(f, size))
+
+    def _position(self, index: int) -> int:
+        # File offset of pending[index]
+        for start, offset in reversed(self.runs):
+            if start <= index:
+                return offset + index - start
+
+    def _drop_runs(self, cut: int) -> None:
+        runs = []
+        for index, offset in self.runs:
+            if index <= cut:
+                runs = [(0, offset + cut - index)]
+            else:
+                runs.append((index - cut, offset))
+        self.runs = runs if self.pending else []
+
+    def _report_skipped(self) -> None:
+        # Whatever was accepted before the drop goes out first
+        self.flush()
+        skipped_offset, count = self.skipped_offset, self.skipped_end - self.skipped_offset
+        self.skipped = 0
+        self.send_skipped(skipped_offset, count)
+
+    def _sent(self, future, size: int) -> None:
+        self.in_flight -= size
+        # Retrieve the exception (if the socket closed) so it is not logged as unhandled
+        if future.exception() is None and self.skipped and self.in_flight + len(self.pending) < self.high_water:
+            # The file may have gone quiet since the drop, so don't wait for more data to report it
+            self._report_skipped()
+
+    def close(self) -> None:
+        if self.timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+        self.pending.clear()
+        self.runs = []
+        self.skipped = 0
+
+
+class _BytesFile:
+    # Minimal seek/read wrapper so read_tail can scan the in-memory buffer
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        self.pos = len(self.data) + pos if whence == os.SEEK_END else pos
+        return self.pos
+
+    def read(self, size: int) -> bytes:
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+class TailView:
+    """A watcher's data up to ``end``, as it was when the view was taken.
+
+    Views are taken on the IOLoop and can then be read from any thread, so
+    history and resumes, which may have to go back to the disk, are served
+    from an executor. The end of the data comes from a copy of the watcher's
+    ring buffer; anything older is read from ``file``, a handle of the view's
+    own, or for a compressed file from a decompressing reader of ``path``
+    opened on first use.
+    """
+
+    def __init__(self, end: int, buffer: bytes, buffer_start: int, file=None, path: str | None = None):
+        self.end = end
+        self.buffer = buffer
+        self.buffer_start = buffer_start
+        self.file = file
+        self.path = path
+
+    def __enter__(self) -> "TailView":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+    def _file(self):
+        if self.file is None:
+            self.file = open_uncompressed(self.path)[0]
+        return self.file
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        size = min(size, self.end - offset)
+        if offset >= self.buffer_start:
+            return self.buffer[offset - self.buffer_start:offset - self.buffer_start + size]
+        f = self._file()
+        f.seek(offset)
+        return f.read(size)
+
+    def history(self, count: int, end: int | None = None) -> tuple[int, bytes]:
+        """Return ``(offset, data)`` for the last ``count`` complete lines before ``end`` (the view's end)."""
+        end = self.end if end is None else end
+        if end >= self.buffer_start:
+            buffer = self.buffer[:end - self.buffer_start]
+            # The buffer always starts at a line boundary, so `count` newlines are enough
+            if buffer.count(b"\n") >= count or self.buffer_start == 0:
+                offset, data = read_tail(_BytesFile(buffer), count)
+                return self.buffer_start + offset, data
+        return read_tail(self._file(), count, end)
+
+    def read_since(self, offset: int, limit: int = MAX_RESUME_BYTES) -> tuple[int, bytes]:
+        """Return ``(start, data)`` covering ``offset`` up to the view's end.
+
+        At most ``limit`` bytes are returned; if more was written since
+        ``offset``, ``start`` is moved forward to a line boundary and the bytes
+        in between are left out.
+        """
+        start = max(offset, self.end - limit)
+        data = self.read_at(start, self.end - start)
+        if start > offset:
+            cut = data.find(b"\n") + 1
+            start, data = start + cut, data[cut:]
+        return start, data
+
+
+class CompressedTail:
+    """Stands in for a TailWatcher on a compressed file, such as a rotated ``app.log.1.gz``.
+
+    Compressed logs are written once and not appended to, so there is
+    nothing to follow: history and resumes are read from the decompressed
+    data, with offsets into it, and no live data is ever published.
+    """
+
+    def __init__(self, path: str, key):
+        self.path = path
+        self.key = key
+        self.hub = None
+        self.subscribers = set()
+        self.filters = {}
+        self.file, self.offset = open_uncompressed(path)
+        self.identity = file_identity(os.fstat(self.file.fileno()))
+
+    def start(self) -> None:
+        pass
+
+    def schedule_check(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.file.close()
+
+    def recent_lines(self, count: int) -> bytes:
+        # Nothing is ever published, so no filter needs context for it
+        return b""
+
+    def view(self) -> TailView:
+        # The reader is opened by whoever reads the view; the index it needs is already built
+        return TailView(self.offset, b"", self.offset, path=self.path)
+
+    def history(self, count: int) -> tuple[int, bytes]:
+        with self.view() as view:
+            return view.history(count)
+
+    def read_since(self, offset: int, limit: int = MAX_RESUME_BYTES) -> tuple[int, bytes]:
+        with self.view() as view:
+            return view.read_since(offset, limit)
+
+
+# Most a filtered history will search backwards for matching lines
+MAX_FILTER_SCAN_BYTES = 64 * 1024 * 1024
+FILTER_BLOCK_SIZE = 1024 * 1024
+
+
+class FilteredTail:
+    """A LineFilter applied to a TailWatcher's data once for all subscribers using it.
+
+    It subscribes to the watcher like a connection would and offers the same
+    interface to its own subscribers, except that ``history`` and
+    ``read_since`` return lists of ``(offset, data)`` runs since the selected
+    lines are not adjacent in the file. A user's pattern can be slow on a
+    large block, so live data is matched on the ``scan`` executor, one block
+    at a time in file order; each block goes to the subscribers there were
+    when it arrived, whose history already ends before it.
+    """
+
+    def __init__(self, watcher: TailWatcher, line_filter: LineFilter):
+        self.watcher = watcher
+        self.filter = line_filter
+        self.subscribers = set()
+        # Live data starts where the watcher is now; earlier lines are only context
+        carry = watcher.recent_lines(line_filter.before) if line_filter.before else b""
+        self.state = FilterState(line_filter, watcher.offset, carry)
+        # (offset, data, subscribers) still to be matched; data None marks a reset, with the reason as offset
+        self.queue = deque()
+        self.draining = False
+
+    @property
+    def identity(self) -> str:
+        return self.watcher.identity
+
+    @property
+    def offset(self) -> int:
+        return self.watcher.offset
+
+    def on_tail_data(self, offset: int, data: bytes) -> None:
+        self._enqueue(offset, data)
+
+    def on_tail_reset(self, reason: str) -> None:
+        # Queued too, so it never overtakes data from before it
+        self._enqueue(reason, None)
+
+    def _enqueue(self, offset, data) -> None:
+        self.queue.append((offset, data, set(self.subscribers)))
+        if not self.draining:
+            self.draining = True
+            tornado.ioloop.IOLoop.current().add_callback(self._drain)
+
+    async def _drain(self) -> None:
+        try:
+            while self.queue:
+                offset, data, subscribers = self.queue.popleft()
+                if data is None:
+                    self.state = FilterState(self.filter)
+                    runs = None
+                else:
+                    try:
+                        runs = await executors.run("scan", self.state.feed, offset, data)
+                    except ExecutorBusy:
+                        # Matching here beats losing the block and the filter's place in the file
+                        runs = self.state.feed(offset, data)
+                # Subscribers that left in the meantime get nothing more
+                for subscriber in [s for s in subscribers if s in self.subscribers]:
+                    if runs is None:
+                        subscriber.on_tail_reset(offset)
+                        continue
+                    for run_offset, run in runs:
+                        subscriber.on_tail_data(run_offset, run)
+        finally:
+            self.draining = False
+
+    def view(self) -> "FilteredView":
+        return FilteredView(self.watcher.view(), self.filter)
+
+    def history(self, count: int) -> list[tuple[int, bytes]]:
+        with self.view() as view:
+            return view.history(count)
+
+    def read_since(self, offset: int, limit: int = MAX_RESUME_BYTES) -> tuple[int, list[tuple[int, bytes]]]:
+        with self.view() as view:
+            return view.read_since(offset, limit)
+
+
+class FilteredView:
+    """A TailView seen through a LineFilter; ``history`` and ``read_since`` return runs."""
+
+    def __init__(self, view: TailView, line_filter: LineFilter):
+        self.view = view
+        self.filter = line_filter
+
+    def __enter__(self) -> "FilteredView":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.view.close()
+
+    def history(self, count: int) -> list[tuple[int, bytes]]:
+        """Return the last ``count`` selected lines, with context, as runs."""
+        end = self.view.end
+        if count <= 0 or end <= 0:
+            return []
+        start = self._history_start(count, end)
+        carry = self.view.history(self.filter.before, start)[1] if self.filter.before and start else b""
+        state = FilterState(self.filter, start - len(carry), carry)
+        runs = []
+        pos = start
+        while pos < end:
+            block = self.view.read_at(pos, min(FILTER_BLOCK_SIZE, end - pos))
+            if not block:
+                break
+            if pos + len(block) < end:
+                cut = block.rfind(b"\n") + 1
+                block = block[:cut] if cut else block
+            runs.extend(state.feed(pos, block))
+            pos += len(block)
+        return runs
+
+    def _history_start(self, count: int, end: int) -> int:
+        # Walk backwards in blocks until `count` selected lines have been seen
+        limit = max(end - MAX_FILTER_SCAN_BYTES, 0)
+        pos = end
+        start = end
+        head = b""
+        while pos > limit:
+            size = min(FILTER_BLOCK_SIZE, pos - limit)
+            pos -= size
+            block = self.view.read_at(pos, size) + head
+            # The first line of the block may continue in the previous one
+            cut = block.find(b"\n") + 1 if pos > limit else 0
+            if pos > limit and not cut:
+                head = block
+                continue
+            head, lines = block[:cut], block[cut:]
+            start = pos + cut
+            spans = self.filter.select(lines)
+            for span_start, span_end in reversed(spans):
+                found = lines.count(b"\n", span_start, span_end) or 1
+                if found < count:
+                    count -= found
+                    continue
+                index = span_end
+                for _ in range(count):
+                    index = lines.rfind(b"\n", span_start, index - 1) + 1 or span_start
+                return start + index
+        return start
+
+    def read_since(self, offset: int, limit: int = MAX_RESUME_BYTES) -> tuple[int, list[tuple[int, bytes]]]:
+        start, data = self.view.read_since(offset, limit)
+        return start, FilterState(self.filter, start).feed(start, data)
+
+
+class TailHub:
+    """One TailWatcher per file, shared by every subscriber and torn down with the last one."""
+
+    def __init__(self):
+        self.watchers = {}
+
+    async def subscribe(self, path: str, subscriber, line_filter: LineFilter | None = None,
+                        **options) -> "TailWatcher | FilteredTail":
+        watcher = await self._watcher(path, options)
+        if line_filter is None:
+            watcher.subscribers.add(subscriber)
+            return watcher
+        # Connections with an identical filter share the matching as well as the watcher
+        filtered = watcher.filters.get(line_filter.key)
+        if filtered is None:
+            filtered = watcher.filters[line_filter.key] = FilteredTail(watcher, line_filter)
+            watcher.subscribers.add(filtered)
+        filtered.subscribers.add(subscriber)
+        return filtered
+
+    async def _watcher(self, path: str, options: dict) -> TailWatcher:
+        st = await executors.run("metadata", os.stat, path)
+        key = (st.st_dev, st.st_ino, path)
+        watcher = self.watchers.get(key)
+        if watcher is None:
+            # Opening a watcher reads the end of the file, and for a compressed file indexes all of it once
+            pool = "scan" if needs_indexing(path) else "read"
+            created = await executors.run(pool, self._create, path, key, options)
+            # Another subscriber may have got there first while this one was being built
+            watcher = self.watchers.get(key)
+            if watcher is None:
+                watcher = self.watchers[key] = created
+                watcher.hub = self
+                watcher.start()
+                return watcher
+            created.close()
+        # Anything the watcher hasn't read yet reaches the newcomer as live data, after its history
+        watcher.schedule_check()
+        return watcher
+
+    @staticmethod
+    def _create(path: str, key, options: dict) -> "TailWatcher | CompressedTail":
+        if compression_format(path):
+            return CompressedTail(path, key)
+        return TailWatcher(path, key, **options)
+
+    def unsubscribe(self, watcher: "TailWatcher | FilteredTail", subscriber) -> None:
+        watcher.subscribers.discard(subscriber)
+        if isinstance(watcher, FilteredTail):
+            if not watcher.subscribers:
+                del watcher.watcher.filters[watcher.filter.key]
+                self.unsubscribe(watcher.watcher, watcher)
+            return
+        if not watcher.subscribers and self.watchers.get(watcher.key) is watcher:
+            del self.watchers[watcher.key]
+            watcher.close()
+
+    def rekey(self, watcher: TailWatcher, key) -> None:
+        # Called when a watcher follows its path to a new inode
+        if self.watchers.get(watcher.key) is watcher and key not in self.watchers:
+            del self.watchers[watcher.key]
+            self.watchers[key] = watcher
+            watcher.key = key
+
+
+tail_hub = TailHub()
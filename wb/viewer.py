@@ -0,0 +1,63 @@
+from .compressed import open_uncompressed
+
+DEFAULT_WINDOW_SIZE = 256 * 1024
+# Hard cap on how many bytes a single view request will ever read and decode
+MAX_WINDOW_SIZE = 1024 * 1024
+
+
+def _trim_partial_utf8(data: bytes) -> bytes:
+    # Drop an incomplete multi-byte sequence at the end of a window that could not be cut at a newline
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 != 0x80:
+            expected = 2 if byte >> 5 == 0b110 else 3 if byte >> 4 == 0b1110 else 4 if byte >> 3 == 0b11110 else 1
+            return data[:-i] if expected > i else data
+    return data
+
+
+def read_window(path: str, offset: int | None = None, length: int = DEFAULT_WINDOW_SIZE,
+                backward: bool = False) -> dict:
+    """Read one window of at most ``length`` bytes, aligned to line boundaries.
+
+    Forward windows start at ``offset`` (the start of the file by default);
+    backward windows end at ``offset`` (the end of the file by default). The
+    returned ``start``/``end`` byte offsets let a client request the adjacent
+    windows. Compressed files are read decompressed, with offsets into the
+    uncompressed data.
+    """
+    length = max(1, min(length, MAX_WINDOW_SIZE))
+    f, size = open_uncompressed(path)
+    with f:
+        if backward:
+            end = size if offset is None else max(0, min(offset, size))
+            start = max(end - length, 0)
+            if start > 0:
+                f.seek(start - 1)
+                data = f.read(end - start + 1)
+                at_line_start, data = data[:1] == b"\n", data[1:]
+                newline = data.find(b"\n")
+                # Drop the partial first line unless it is the only thing in the window
+                if not at_line_start and 0 <= newline < len(data) - 1:
+                    start += newline + 1
+                    data = data[newline + 1:]
+            else:
+                f.seek(start)
+                data = f.read(end - start)
+        else:
+            start = 0 if offset is None else max(0, min(offset, size))
+            f.seek(start)
+            data = f.read(length)
+            end = start + len(data)
+            if end < size:
+                newline = data.rfind(b"\n")
+                if newline >= 0:
+                    data = data[:newline + 1]
+                else:
+                    data = _trim_partial_utf8(data)
+                end = start + len(data)
+    return {
+        "start": start,
+        "end": end,
+        "size": size,
+        "text": data.decode("utf-8", errors="replace"),
+    }
@@ -0,0 +1,129 @@
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+import weakref
+
+import tornado.ioloop
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_MASK_ADD = 0x20000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """A shared inotify instance whose fd is registered on the IOLoop.
+
+    Callbacks are invoked on the IOLoop as ``callback(mask, name, cookie)``.
+    Several callbacks may watch the same path; the kernel watch is removed
+    with the last one. ``IN_Q_OVERFLOW`` is delivered to every callback, which
+    should then re-check whatever it is watching.
+    """
+
+    # One instance per IOLoop, since the fd is registered with the loop
+    _instances = weakref.WeakKeyDictionary()
+    _unavailable = False
+
+    @classmethod
+    def get(cls) -> "Inotify | None":
+        """Return the current IOLoop's instance, or None where inotify is not available."""
+        if cls._unavailable:
+            return None
+        io_loop = tornado.ioloop.IOLoop.current()
+        instance = cls._instances.get(io_loop)
+        if instance is None:
+            try:
+                instance = cls._instances[io_loop] = cls()
+            except OSError as e:
+                logger.info("inotify unavailable, falling back to polling: %s", e)
+                cls._unavailable = True
+        return instance
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "libc has no inotify support")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self._init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.callbacks = {}
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.io_loop.add_handler(self.fd, self._on_readable, tornado.ioloop.IOLoop.READ)
+
+    def add_watch(self, path: str, mask: int, callback):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask | IN_MASK_ADD)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.callbacks.setdefault(wd, []).append(callback)
+        return wd, callback
+
+    def remove_watch(self, handle) -> None:
+        wd, callback = handle
+        callbacks = self.callbacks.get(wd)
+        if not callbacks or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.callbacks[wd]
+            # Fails harmlessly if the kernel already dropped the watch (IN_IGNORED)
+            self._rm_watch(self.fd, wd)
+
+    def _on_readable(self, fd, events) -> None:
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                return
+            if not data:
+                return
+            self._dispatch(data)
+
+    def _dispatch(self, data: bytes) -> None:
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                targets = [cb for callbacks in self.callbacks.values() for cb in callbacks]
+            else:
+                targets = list(self.callbacks.get(wd, ()))
+            if mask & IN_IGNORED:
+                self.callbacks.pop(wd, None)
+            for callback in targets:
+                try:
+                    callback(mask, os.fsdecode(name), cookie)
+                except Exception:
+                    logger.exception("inotify callback failed")
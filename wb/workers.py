@@ -0,0 +1,247 @@
+import os
+import time
+import signal
+import datetime
+import asyncio
+import logging
+
+import tornado.httputil
+import tornado.locks
+
+# In-flight requests get this long (seconds) to finish once a worker is told to stop
+DEFAULT_DRAIN_TIMEOUT = 30
+# Workers that exit sooner than this after starting are restarted with a growing delay
+MIN_UPTIME = 5
+MAX_RESTART_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+_SIGNALS = {signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+
+class RequestTracker(tornado.httputil.HTTPServerConnectionDelegate):
+    """Wraps an application and keeps track of the requests it has not finished answering.
+
+    A request counts from its headers until its response is finished, the
+    client goes away or the connection is handed over to a WebSocket, so
+    idle keep-alive connections never hold up a drain.
+    """
+
+    def __init__(self, delegate: tornado.httputil.HTTPServerConnectionDelegate):
+        self.delegate = delegate
+        self.active = set()
+        self.idle = tornado.locks.Condition()
+
+    def start_request(self, server_conn, request_conn):
+        connection = _TrackedConnection(self, request_conn)
+        return _TrackedRequest(self, connection, self.delegate.start_request(server_conn, connection))
+
+    def on_close(self, server_conn):
+        self.delegate.on_close(server_conn)
+
+    def begin(self, connection) -> None:
+        self.active.add(connection)
+
+    def end(self, connection) -> None:
+        self.active.discard(connection)
+        if not self.active:
+            self.idle.notify_all()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Wait until no request is in flight; False if ``timeout`` seconds passed first."""
+        deadline = time.monotonic() + timeout
+        while self.active:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self.idle.wait(timeout=datetime.timedelta(seconds=remaining)):
+                return not self.active
+        return True
+
+
+class _TrackedRequest(tornado.httputil.HTTPMessageDelegate):
+    def __init__(self, tracker: RequestTracker, connection: "_TrackedConnection", delegate):
+        self.tracker = tracker
+        self.connection = connection
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.tracker.begin(self.connection)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        # Only the request body is complete; the response may still be streaming
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        self.tracker.end(self.connection)
+        return self.delegate.on_connection_close()
+
+
+class _TrackedConnection:
+    """Proxies an HTTP1Connection, ending the request when its response is done."""
+
+    def __init__(self, tracker: RequestTracker, connection):
+        self._tracker = tracker
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def finish(self):
+        try:
+            return self._connection.finish()
+        finally:
+            self._tracker.end(self)
+
+    def detach(self):
+        # Upgraded to a WebSocket; those are closed separately when draining
+        self._tracker.end(self)
+        return self._connection.detach()
+
+    def set_close_callback(self, callback):
+        if callback is None:
+            return self._connection.set_close_callback(None)
+
+        def closed():
+            self._tracker.end(self)
+            callback()
+        return self._connection.set_close_callback(closed)
+
+
+async def drain(server, tracker: RequestTracker, timeout: float = DEFAULT_DRAIN_TIMEOUT) -> bool:
+    """Stop accepting connections, then let in-flight requests finish for up to ``timeout`` seconds.
+
+    Returns False if some requests were still running and had to be cut off.
+    """
+    server.stop()
+    finished = await tracker.wait_idle(timeout)
+    if not finished:
+        logger.warning("Closing %d requests still running after %ss", len(tracker.active), timeout)
+    try:
+        # Idle keep-alive connections, and whatever did not finish in time
+        await asyncio.wait_for(server.close_all_connections(), 1)
+    except asyncio.TimeoutError:
+        pass
+    return finished
+
+
+class Supervisor:
+    """Runs ``count`` worker processes forked from this one and keeps them running.
+
+    ``worker(index)`` is called in each child and must not return until the
+    worker is done; the listening sockets are bound before forking, so all
+    workers accept from the same queue. Crashed workers are restarted, with a
+    delay when they keep crashing right after starting. SIGHUP starts a fresh
+    set of workers and tells the old ones to drain; SIGTERM and SIGINT drain
+    all workers and exit.
+    """
+
+    def __init__(self, count: int, worker, reload=None, drain_timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        self.count = count
+        self.worker = worker
+        self.reload = reload
+        self.drain_timeout = drain_timeout
+        self.workers = {}  # pid -> (index, start time)
+        self.retiring = set()
+        self.failures = [0] * count
+        self.pending = {}  # index -> time to restart it at
+        self.stopping = False
+
+    def spawn(self, index: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, _SIGNALS)
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                self.worker(index)
+                code = 0
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                os._exit(code)
+        self.workers[pid] = (index, time.monotonic())
+        logger.info("Started worker %d (pid %d)", index, pid)
+        return pid
+
+    def run(self) -> int:
+        previous = signal.pthread_sigmask(signal.SIG_BLOCK, _SIGNALS)
+        try:
+            for index in range(self.count):
+                self.spawn(index)
+            deadline = None
+            while self.workers or self.pending:
+                now = time.monotonic()
+                for index, when in list(self.pending.items()):
+                    if when <= now:
+                        del self.pending[index]
+                        self.spawn(index)
+                waits = [when - now for when in self.pending.values()]
+                if deadline is not None:
+                    waits.append(deadline - now)
+                info = signal.sigtimedwait(_SIGNALS, max(min(waits, default=1.0), 0))
+                if info is None:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        self.signal_all(signal.SIGKILL)
+                        deadline = None
+                elif info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                    if not self.stopping:
+                        logger.info("Stopping %d workers", len(self.workers))
+                        self.stopping = True
+                        self.pending.clear()
+                        self.signal_all(signal.SIGTERM)
+                        deadline = time.monotonic() + self.drain_timeout + 5
+                elif info.si_signo == signal.SIGHUP and not self.stopping:
+                    self.restart_all()
+                self.reap()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+        return 0
+
+    def restart_all(self) -> None:
+        if self.reload is not None:
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Reload failed; keeping the current workers")
+                return
+        old = [pid for pid in self.workers if pid not in self.retiring]
+        for index in range(self.count):
+            self.pending.pop(index, None)
+            self.spawn(index)
+        # The new workers already accept from the shared sockets while the old ones finish
+        for pid in old:
+            self.retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    def signal_all(self, signum: int) -> None:
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self) -> None:
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+            index, started = self.workers.pop(pid)
+            if pid in self.retiring or self.stopping:
+                self.retiring.discard(pid)
+                continue
+            logger.warning("Worker %d (pid %d) exited with status %d", index, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_UPTIME:
+                self.failures[index] += 1
+            else:
+                self.failures[index] = 0
+            delay = min(2 ** self.failures[index] - 1, MAX_RESTART_DELAY)
+            self.pending[index] = time.monotonic() + delay